@@ -0,0 +1,225 @@
+"""
+Bragi draws Heimdall's graphs.
+
+Bragi runs as a process of its own, so that matplotlib is imported once
+rather than by every room's Heimdall, and draws every graph on the same
+warm figure, which is cleared after each one. Heimdall sends it a title and
+a series of dates and counts, and gets a PNG back as bytes, so graphs never
+touch the disk. Several series can be drawn as panels of one graph, so that
+a command only needs one image. Graphs are kept by a digest of what's drawn
+on them, along with the URL each was uploaded to once a room has uploaded
+it, so an identical graph, whichever room asks for it, is only drawn and
+uploaded once.
+"""
+
+import hashlib
+import io
+import logging
+import queue as queue_module
+import threading
+from collections import OrderedDict, namedtuple
+
+
+# A drawn graph: its PNG bytes, the digest it's kept under, and the URL it
+# was uploaded to, or None if it hasn't been yet
+Graph = namedtuple('Graph', ['png', 'key', 'url'])
+
+
+def digest(panels):
+    """Returns a key identifying a graph by the titles and series of its (title, dates, counts) panels"""
+    # Imported here, like matplotlib, so that processes which only send requests don't load NumPy for Bragi
+    import numpy as np
+
+    key = hashlib.sha256()
+    for title, dates, counts in panels:
+        key.update(f"{len(title)}:{title}".encode())
+        for series in (dates, counts):
+            series = np.ascontiguousarray(series)
+            key.update(f"{series.dtype.str}{series.shape}".encode())
+            key.update(series.tobytes())
+    return key.hexdigest()
+
+
+class GraphCache:
+    """Keeps values, such as graphs or the URLs they were uploaded to, under a key, dropping the least recently used once their lengths add up to more than `size`"""
+
+    def __init__(self, size=32 * 1024 * 1024):
+        self.size = size
+        self.used = 0
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.values:
+                return None
+            self.values.move_to_end(key)
+            return self.values[key]
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.values:
+                self.used -= len(self.values.pop(key))
+            self.values[key] = value
+            self.used += len(value)
+            while self.used > self.size and len(self.values) > 1:
+                self.used -= len(self.values.popitem(last=False)[1])
+
+
+class Renderer:
+    """Draws line graphs on a single reusable figure with the Agg backend, keeping up to `cache_size` bytes of them to hand back when asked for the same graph again, and up to `urls_size` bytes of the URLs they were uploaded to"""
+
+    def __init__(self, cache_size=32 * 1024 * 1024, urls_size=1024 * 1024):
+        # Imported here so that only the process doing the drawing pays for matplotlib
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+        from matplotlib.ticker import MaxNLocator
+
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.width, self.height = self.figure.get_size_inches()
+        self.locator = MaxNLocator
+        self.graphs = GraphCache(cache_size)
+        self.urls = GraphCache(urls_size)
+
+    def render(self, panels):
+        """Returns a Graph of counts against dates for each (title, dates, counts) panel, one above the other"""
+        key = digest(panels)
+        png = self.graphs.get(key)
+        if png is None:
+            png = self.draw(panels)
+            self.graphs.put(key, png)
+        return Graph(png, key, self.urls.get(key))
+
+    def uploaded(self, key, url):
+        """Records the URL the graph kept under `key` was uploaded to"""
+        self.urls.put(key, url)
+
+    def draw(self, panels):
+        try:
+            self.figure.set_size_inches(self.width, self.height * len(panels))
+            axes = self.figure.subplots(len(panels), squeeze=False)[:, 0]
+            for ax, (title, dates, counts) in zip(axes, panels):
+                ax.set_title(title)
+                ax.plot(dates, counts)
+                ax.xaxis.set_major_locator(self.locator(10))
+                ax.set_ylim(bottom=0)
+
+            if len(panels) == 1:
+                self.figure.autofmt_xdate()
+            else:
+                # autofmt_xdate would hide the dates on every panel but the bottom one, and the panels' dates differ
+                for ax in axes:
+                    ax.tick_params(axis='x', labelrotation=30)
+                self.figure.tight_layout()
+
+            png = io.BytesIO()
+            self.figure.savefig(png, format='png')
+            return png.getvalue()
+        finally:
+            self.figure.clear()
+
+
+class Canvas:
+    """Gets graphs drawn for a producer, such as a room's Heimdall.
+
+    Given Bragi's request queue and the producer's reply queue, graphs are
+    drawn by Bragi. Without them, they're drawn in this process, and
+    matplotlib is only imported when the first one is. Threads share a
+    Canvas, drawing one graph at a time."""
+
+    def __init__(self, producer, requests=None, replies=None, timeout=60):
+        self.producer = producer
+        self.requests = requests
+        self.replies = replies
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.ticket = 0
+        self.renderer = None
+
+    def draw(self, title, dates, counts):
+        """Returns a Graph of counts against dates"""
+        return self.draw_panels([(title, dates, counts)])
+
+    def draw_panels(self, panels):
+        """Returns a Graph with a panel for each (title, dates, counts)"""
+        with self.lock:
+            if self.requests is None:
+                if self.renderer is None:
+                    self.renderer = Renderer()
+                return self.renderer.render(panels)
+
+            self.ticket += 1
+            self.requests.put((self.producer, self.ticket, panels))
+            while True:
+                try:
+                    ticket, graph, error = self.replies.get(timeout=self.timeout)
+                except queue_module.Empty:
+                    raise TimeoutError(f"No reply from Bragi for graph {self.ticket}")
+
+                # Replies to graphs that timed out earlier are dropped
+                if ticket == self.ticket:
+                    break
+
+            if error is not None:
+                raise RuntimeError(f"Bragi couldn't draw graph {self.ticket}: {error}")
+            return graph
+
+    def uploaded(self, graph, url):
+        """Records the URL a graph was uploaded to, so that it isn't uploaded again by any producer"""
+        if self.requests is None:
+            with self.lock:
+                if self.renderer is not None:
+                    self.renderer.uploaded(graph.key, url)
+        else:
+            # Bragi doesn't reply to these, so there's nothing to wait for
+            self.requests.put((graph.key, url))
+
+
+class Bragi:
+    """Draws the graphs requested on `queue`.
+
+    Each request is a (producer, ticket, panels) tuple, and
+    Bragi answers it by putting (ticket, graph, error) on the producer's queue
+    in `replies`. `graph` is a Graph, or None if drawing it failed, in which
+    case `error` describes why. A (key, url) request records the URL the
+    graph kept under `key` was uploaded to, and isn't answered."""
+
+    def __init__(self, queue, **kwargs):
+        self.queue = queue
+        self.replies = kwargs['replies'] if 'replies' in kwargs else {}
+        self.renderer = Renderer(kwargs['cache_size'] if 'cache_size' in kwargs else 32 * 1024 * 1024, kwargs['urls_size'] if 'urls_size' in kwargs else 1024 * 1024)
+
+        log_format = logging.Formatter(f'\n\n--------------------\n%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        self.logger = logging.getLogger(__name__)
+        handler = logging.FileHandler('Bragi.log')
+        handler.setFormatter(log_format)
+        self.logger.addHandler(handler)
+
+    def step(self):
+        """Waits for one request and answers it"""
+        request = self.queue.get()
+        if len(request) == 2:
+            self.renderer.uploaded(*request)
+            return
+
+        producer, ticket, panels = request
+        try:
+            graph, error = self.renderer.render(panels), None
+        except Exception as e:
+            self.logger.exception(f"Failed to draw {', '.join(panel[0] for panel in panels)} for {producer}")
+            graph, error = None, repr(e)
+
+        if producer in self.replies:
+            self.replies[producer].put((ticket, graph, error))
+        else:
+            self.logger.warning(f"No reply queue for producer {producer}")
+
+    def main(self):
+        while True:
+            self.step()
+
+
+def main(queue, **kwargs):
+    bragi = Bragi(queue, **kwargs)
+    bragi.main()
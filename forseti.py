@@ -1,33 +1,819 @@
-import multiprocessing
+import json
+import logging
+import os
+import pickle
+import queue as queue_module
 import sqlite3
+import struct
+import time
 
 
-class Forseti:
-    def __init__(self, queue):
+# Typed write operations. Producers send one of these numbers in place of
+# the SQL text, which keeps queued items small and means each operation is
+# always the same statement, so sqlite3 compiles it once and reuses it from
+# the connection's statement cache.
+INSERT_MESSAGE = 1
+INSERT_MESSAGES_BULK = 2
+ALIAS_UPSERT = 3
+ALIAS_DELETE = 4
+ALIAS_REMASTER = 5
+NOTIFICATION_INSERT = 6
+NOTIFICATION_DELIVERED = 7
+GROUP_UPSERT = 8
+GROUP_DELETE = 9
+MESSAGE_DAYS_ADD = 10
+COUNTER_ADD = 11
+POSTERS_ADD = 12
+POSTERS_RESOLVE = 13
+POSTERS_REMASTER = 14
+REPLY_EDGES_TO_PARENT = 15
+REPLY_EDGES_FROM_REPLIES = 16
+ALIAS_INSERT = 17
+
+# Named databases that writes can be routed to
+HEIMDALL = 'heimdall'
+YGGDRASIL = 'yggdrasil'
+
+DATABASES = {
+    HEIMDALL: '_heimdall.db',
+    YGGDRASIL: 'yggdrasil.db',
+}
+
+# Heim's message ids are 64 bit numbers written as 13 base 36 digits. Those
+# starting with a 0 fit in SQLite's signed integers, so the compact layout
+# stores them as numbers, and any other id as it was. The conversions are
+# plain SQL so that anything reading the database can use them.
+ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def encode_id(column):
+    """Returns an SQL expression converting the message id in `column` to the form the compact layout stores"""
+    digits = ' + '.join(f"(instr('{ALPHABET}', substr({column}, {i}, 1)) - 1) * {36 ** (13 - i)}" for i in range(2, 14))
+    return f"CASE WHEN typeof({column}) = 'text' AND length({column}) = 13 AND substr({column}, 1, 1) = '0' AND NOT {column} GLOB '*[^0-9a-z]*' THEN {digits} ELSE {column} END"
+
+
+def decode_id(column):
+    """Returns an SQL expression converting a message id stored in the compact layout back to text"""
+    digits = ' || '.join(f"substr('{ALPHABET}', {column} / {36 ** (12 - i)} % 36 + 1, 1)" for i in range(1, 13))
+    return f"CASE WHEN typeof({column}) = 'integer' THEN '0' || {digits} ELSE {column} END"
+
+
+def word_count(column):
+    """Returns an SQL expression counting the words in `column` as str.split() does, for ASCII whitespace.
+
+    Runs of whitespace are collapsed to a single space by marking every
+    space and dropping the marks that follow a space, which leaves one space
+    fewer than there are words."""
+    spaced = f"COALESCE({column}, '')"
+    for character in [9, 10, 11, 12, 13]:
+        spaced = f"replace({spaced}, char({character}), ' ')"
+    collapsed = f"trim(replace(replace(replace({spaced}, ' ', ' ' || char(1)), char(1) || ' ', ''), char(1), ''))"
+    return f"CASE WHEN {collapsed} = '' THEN 0 ELSE length({collapsed}) - length(replace({collapsed}, ' ', '')) + 1 END"
+
+
+def is_compact(cursor):
+    """Returns whether the database has the optional compact layout (see mimir.py)"""
+    cursor.execute('''SELECT type FROM sqlite_master WHERE name = 'messages' ''')
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'view'
+
+
+STATEMENTS = {
+    INSERT_MESSAGE: '''INSERT INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+    INSERT_MESSAGES_BULK: '''INSERT OR IGNORE INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+    ALIAS_UPSERT: '''INSERT OR REPLACE INTO aliases VALUES(?, ?, ?)''',
+    ALIAS_INSERT: '''INSERT OR IGNORE INTO aliases VALUES(?, ?, ?)''',
+    ALIAS_DELETE: '''DELETE FROM aliases WHERE normalias=?''',
+    ALIAS_REMASTER: '''UPDATE aliases SET master=? WHERE master=?''',
+    NOTIFICATION_INSERT: '''INSERT INTO notifications VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+    NOTIFICATION_DELIVERED: '''UPDATE notifications SET delivered=1, id=? WHERE globalid IS ?''',
+    GROUP_UPSERT: '''INSERT OR REPLACE INTO groups VALUES (?, ?)''',
+    GROUP_DELETE: '''DELETE FROM groups WHERE groupname IS ?''',
+    MESSAGE_DAYS_ADD: f'''INSERT INTO message_days VALUES(?1, ?2, ?3, 1, {word_count('?4')}, COALESCE(length(?4), 0), ?5 IS '')
+                          ON CONFLICT(room, normname, day) DO UPDATE SET count = count + 1, words = words + excluded.words, characters = characters + excluded.characters, top_level = top_level + excluded.top_level''',
+    COUNTER_ADD: '''INSERT INTO counters VALUES(?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value''',
+    POSTERS_ADD: '''INSERT INTO posters VALUES(?1, ?2, ?3, COALESCE((SELECT master FROM aliases WHERE normalias = ?2), ?3), ?4) ON CONFLICT(room, normname, sendername) DO UPDATE SET count = count + excluded.count''',
+    POSTERS_RESOLVE: '''UPDATE posters SET name = COALESCE((SELECT master FROM aliases WHERE normalias = posters.normname), sendername) WHERE normname = ?''',
+    POSTERS_REMASTER: '''UPDATE posters SET name = ?1 WHERE normname IN (SELECT normalias FROM aliases WHERE master = ?1)''',
+    REPLY_EDGES_TO_PARENT: '''INSERT INTO reply_edges SELECT ?1, ?2, normname, sendername, ?5, 1 FROM messages WHERE room IS ?1 AND id = ?3 AND ?3 IS NOT ?4
+                              ON CONFLICT(room, replier, normname, sendername, day) DO UPDATE SET count = count + excluded.count''',
+    REPLY_EDGES_FROM_REPLIES: '''INSERT INTO reply_edges SELECT ?1, normname, ?3, ?2, CAST(time / 86400 AS INT), COUNT(*) FROM messages WHERE room IS ?1 AND parent = ?4 AND id IS NOT ?4 GROUP BY +normname, 5
+                                 ON CONFLICT(room, replier, normname, sendername, day) DO UPDATE SET count = count + excluded.count''',
+}
+
+# Lookups by message id through the compact layout's view can't use an
+# index, so these go to its tables instead
+COMPACT_STATEMENTS = {
+    REPLY_EDGES_TO_PARENT: f'''INSERT INTO reply_edges SELECT ?1, ?2, s.normname, s.sendername, ?5, 1 FROM message_rows m JOIN senders s ON s.id = m.sender
+                               WHERE m.room = (SELECT id FROM rooms WHERE name IS ?1) AND m.id = {encode_id('?3')} AND ?3 IS NOT ?4
+                               ON CONFLICT(room, replier, normname, sendername, day) DO UPDATE SET count = count + excluded.count''',
+    REPLY_EDGES_FROM_REPLIES: f'''INSERT INTO reply_edges SELECT ?1, s.normname, ?3, ?2, CAST(m.time / 86400 AS INT), COUNT(*) FROM message_rows m JOIN senders s ON s.id = m.sender
+                                  WHERE m.room = (SELECT id FROM rooms WHERE name IS ?1) AND m.parent = {encode_id('?4')} AND m.id IS NOT {encode_id('?4')} GROUP BY s.normname, 5
+                                  ON CONFLICT(room, replier, normname, sendername, day) DO UPDATE SET count = count + excluded.count''',
+}
+
+# Message inserts are run a row at a time, so that the rollups are only
+# counted for the messages that were actually new. A reply and the message
+# it replies to can arrive in either order, so each new message adds an
+# edge to the reply graph for its parent, if that's already stored, and for
+# any replies to it that are.
+MESSAGE_INSERTS = (INSERT_MESSAGE, INSERT_MESSAGES_BULK)
+
+# Every alias write bumps the 'aliases' counter, which tells processes
+# holding a copy of the aliases that it needs reading again
+ALIAS_WRITES = (ALIAS_UPSERT, ALIAS_INSERT, ALIAS_DELETE, ALIAS_REMASTER)
+
+
+def resolve_posters(operation, row):
+    """Returns the write that re-resolves the names in `posters` after an alias write, which only touches the rows for the aliases involved"""
+    if operation in (ALIAS_UPSERT, ALIAS_INSERT):
+        return POSTERS_RESOLVE, (row[2], )
+    elif operation == ALIAS_DELETE:
+        return POSTERS_RESOLVE, (row[0], )
+    return POSTERS_REMASTER, (row[0], )
+
+
+def resolve(operation, values):
+    """Returns the (query, mode) that an operation runs as.
+
+    `operation` is either one of the typed operations above or, for one-off
+    statements such as schema changes, the SQL itself. A list of values
+    means the statement is run once per row.
+
+    >>> resolve(ALIAS_DELETE, ('normalias',))
+    ('DELETE FROM aliases WHERE normalias=?', 'execute')
+    >>> resolve('DELETE FROM aliases', [()])
+    ('DELETE FROM aliases', 'executemany')
+    """
+    if isinstance(operation, int):
+        query = STATEMENTS[operation]
+    else:
+        query = operation
+    mode = 'executemany' if isinstance(values, list) else 'execute'
+    return query, mode
+
+
+def run(cursor, operation, values, compact=None):
+    """Runs a write on `cursor`, keeping the rollups of the messages table (message_days, posters and reply_edges) and the counters up to date, and returns the number of rows it changed.
+
+    For message inserts, that's the number of messages inserted. `compact`
+    says whether the database has the compact layout, and is looked up
+    when not given, which costs a query per call."""
+    query, mode = resolve(operation, values)
+    if operation not in MESSAGE_INSERTS:
+        changes_before = cursor.connection.total_changes
+        if mode == 'execute':
+            cursor.execute(query, values)
+        else:
+            cursor.executemany(query, values)
+        rows = cursor.connection.total_changes - changes_before
+
+        if operation in ALIAS_WRITES:
+            for row in (values if mode == 'executemany' else [values]):
+                update, parameters = resolve_posters(operation, row)
+                cursor.execute(STATEMENTS[update], parameters)
+            cursor.execute(STATEMENTS[COUNTER_ADD], ('aliases', 1))
+        return rows
+
+    if compact is None:
+        compact = is_compact(cursor)
+    statements = COMPACT_STATEMENTS if compact else STATEMENTS
+    inserted = 0
+    posters = {}
+    for row in (values if mode == 'executemany' else [values]):
+        changes_before = cursor.connection.total_changes
+        cursor.execute(query, row)
+        if cursor.connection.total_changes > changes_before:
+            inserted += 1
+            # Rows are (content, id, parent, senderid, sendername, normname, time, room, globalid)
+            day = int(float(row[6]) // 86400)
+            cursor.execute(STATEMENTS[MESSAGE_DAYS_ADD], (row[7], row[5], day, row[0], row[2]))
+            key = (row[7], row[5], row[4])
+            posters[key] = posters[key] + 1 if key in posters else 1
+
+            if row[2]:
+                cursor.execute(statements[REPLY_EDGES_TO_PARENT], (row[7], row[5], row[2], row[1], day))
+            cursor.execute(statements[REPLY_EDGES_FROM_REPLIES], (row[7], row[4], row[5], row[1]))
+
+    if posters:
+        cursor.executemany(STATEMENTS[POSTERS_ADD], [(*key, count) for key, count in posters.items()])
+    return inserted
+
+
+class Spool:
+    """An append-only file of writes.
+
+    Forseti appends every write it takes off the queue before it is run, and
+    producers using the 'spill' policy append writes that don't fit on a full
+    queue. Each write is stored as a length-prefixed pickle, and the file is
+    fsynced every `sync_every` records or `sync_interval` seconds, whichever
+    comes first. If Forseti is stopped with writes still waiting to be
+    committed, they are replayed from here when it starts again. Not every
+    write leaves the same state when run twice (alias writes don't), so each
+    commit records in its database how far into the spool the writes it
+    committed go, and only the records after that are replayed. A record cut
+    short by a crash marks the end of the spool, and is cut off when the
+    spool is next opened, so that later records follow on from the last
+    complete one."""
+
+    header = struct.Struct('>I')
+
+    def __init__(self, file, sync_every=1000, sync_interval=1):
+        self.file = file
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.records = 0
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        if os.path.exists(self.file):
+            self.cut_torn_tail()
+        self.f = open(self.file, 'ab', buffering=0)
+        self.size = os.path.getsize(self.file)
+
+    def cut_torn_tail(self):
+        """Truncates the file to the end of its last complete record"""
+        end = 0
+        for end, record in self.read():
+            pass
+        if end < os.path.getsize(self.file):
+            with open(self.file, 'r+b') as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+
+    def append(self, record):
+        """Appends a record and returns the offset just past it"""
+        record = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        self.f.write(self.header.pack(len(record)) + record)
+        self.size += self.header.size + len(record)
+        self.records += 1
+        self.unsynced += 1
+
+        if self.unsynced >= self.sync_every or time.monotonic() - self.last_sync >= self.sync_interval:
+            self.sync()
+        return self.size
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.f.fileno())
+            self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def read(self, offset=0):
+        """Yields (end, record) for every complete record from `offset` on, in the order they were appended.
+
+        `end` is the offset just past the record, to resume reading from."""
+        with open(self.file, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(self.header.size)
+                if len(header) < self.header.size:
+                    return
+                length = self.header.unpack(header)[0]
+                record = f.read(length)
+                if len(record) < length:
+                    return
+                try:
+                    yield f.tell(), pickle.loads(record)
+                except Exception:
+                    return
+
+    def truncate(self):
+        """Empties the spool, once everything in it has been dealt with"""
+        self.f.truncate(0)
+        os.fsync(self.f.fileno())
+        self.size = 0
+        self.records = 0
+        self.unsynced = 0
+
+
+class WriteQueue:
+    """The producer's end of a bounded Forseti queue.
+
+    Every write is sent as (target, operation, values, producer, ticket,
+    enqueued), so that Forseti can report per-producer throughput and how
+    long writes wait to be committed. When the queue is full, `policy`
+    decides what happens:
+
+    - 'block' waits for room, slowing the producer down to Forseti's pace.
+    - 'coalesce' holds writes back in memory, merging runs of single message
+      inserts into bulk inserts, and sends them once there is room.
+    - 'spill' appends writes that don't fit to the `spill` file and feeds
+      them back, in order, once there is room.
+
+    Writes that are held back always go out before newer ones, and a write
+    whose producer is waiting on a reply is always sent straight away."""
+
+    def __init__(self, queue, producer, policy='block', spill=None):
         self.queue = queue
-        self.file = '_heimdall.db'
-        self.conn = sqlite3.connect(self.file)
+        self.producer = producer
+        self.policy = policy
+        self.backlog = []
+        self.spill = None
+        self.spill_offset = 0
+
+        if self.policy == 'spill':
+            self.spill = Spool(spill if spill is not None else f"_spill_{producer}.spool", sync_interval=60)
+            # Anything spilled by a previous run still needs to be sent
+            self.spill.records = sum(1 for record in self.spill.read())
+
+    def put(self, target, operation, values, ticket=None):
+        incoming = (target, operation, values, self.producer, ticket, time.time())
+
+        if ticket is not None or self.policy == 'block':
+            self.flush(block=True)
+            self.queue.put(incoming)
+            return
+
+        if self.flush():
+            try:
+                self.queue.put_nowait(incoming)
+                return
+            except queue_module.Full:
+                pass
+
+        self.hold(incoming)
+
+    def hold(self, incoming):
+        """Keeps a write that didn't fit, to be sent by a later flush"""
+        if self.policy == 'spill':
+            self.spill.append(incoming)
+            return
+
+        if self.backlog and incoming[1] == INSERT_MESSAGE:
+            last = self.backlog[-1]
+            if last[0] == incoming[0] and last[1] in [INSERT_MESSAGE, INSERT_MESSAGES_BULK]:
+                rows = last[2] if last[1] == INSERT_MESSAGES_BULK else [last[2]]
+                self.backlog[-1] = (last[0], INSERT_MESSAGES_BULK, rows + [incoming[2]], last[3], None, last[5])
+                return
+        self.backlog.append(incoming)
+
+    def flush(self, block=False):
+        """Sends as many held-back writes as will fit, returning True once none are left"""
+        while self.backlog:
+            try:
+                self.queue.put(self.backlog[0], block=block)
+            except queue_module.Full:
+                return False
+            del self.backlog[0]
+
+        if self.spill is None or self.spill.records == 0:
+            return True
+
+        for end, incoming in self.spill.read(self.spill_offset):
+            try:
+                self.queue.put(incoming, block=block)
+            except queue_module.Full:
+                return False
+            self.spill_offset = end
+            self.spill.records -= 1
+
+        self.spill.truncate()
+        self.spill_offset = 0
+        return True
+
+
+class Metrics:
+    """Counts what Forseti has committed, and periodically writes it out as JSON.
+
+    Reports queue depth, how long writes waited between being queued and
+    being committed, and how many writes and rows each producer sent."""
+
+    def __init__(self, file, interval):
+        self.file = file
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.started = time.monotonic()
+        self.writes = 0
+        self.latency_total = 0
+        self.latency_max = 0
+        self.producers = {}
+
+    def record(self, incoming, rows):
+        if len(incoming) < 6:
+            return
+
+        latency = time.time() - incoming[5]
+        self.writes += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+        if incoming[3] not in self.producers:
+            self.producers[incoming[3]] = {'writes': 0, 'rows': 0}
+        self.producers[incoming[3]]['writes'] += 1
+        self.producers[incoming[3]]['rows'] += rows
+
+    def is_due(self):
+        return time.monotonic() - self.started >= self.interval
+
+    def export(self, queue):
+        """Writes the metrics for the period just ended, then starts a new one"""
+        elapsed = time.monotonic() - self.started
+        try:
+            depth = queue.qsize()
+        except NotImplementedError:
+            depth = None
+
+        for producer in self.producers.values():
+            producer['writes_per_second'] = round(producer['writes'] / elapsed, 2)
+            producer['rows_per_second'] = round(producer['rows'] / elapsed, 2)
+
+        metrics = {
+            'time': time.time(),
+            'period': round(elapsed, 2),
+            'queue_depth': depth,
+            'writes': self.writes,
+            'latency': {
+                'mean': round(self.latency_total / self.writes, 4) if self.writes else None,
+                'max': round(self.latency_max, 4),
+            },
+            'producers': self.producers,
+        }
+
+        with open(self.file + '.tmp', 'w') as f:
+            f.write(json.dumps(metrics, indent=4))
+        os.replace(self.file + '.tmp', self.file)
+        self.reset()
+        return metrics
+
+
+class Target:
+    """A database Forseti writes to, with its own connection and commit policy.
+
+    Writes are run as they arrive inside an open transaction, which is
+    committed once `batch_size` writes are pending or `batch_time` seconds
+    have passed since the first of them."""
+
+    def __init__(self, name, file, batch_size, batch_time):
+        self.name = name
+        self.file = file
+        self.batch_size = batch_size
+        self.batch_time = batch_time
+        self.pending = []
+        self.opened = None
+        self.last_checkpoint = 0
+        self.last_optimize = time.monotonic()
+        self.last_vacuum = 0
+        self.compact = None
+        self.spooled = None
+
+        # Transactions are managed by hand so that a whole batch shares one commit
+        self.conn = sqlite3.connect(self.file, isolation_level=None)
         self.c = self.conn.cursor()
+        # Takes effect on a new database, or an existing one at its next VACUUM (see `python mimir.py --incremental-vacuum`), so that maintenance can give free pages back a few at a time
+        self.c.execute("PRAGMA auto_vacuum=INCREMENTAL;")
         self.c.execute("PRAGMA journal_mode=WAL;")
         if self.c.fetchall()[0][0] != "wal":
             print("Error enabling write-ahead lookup!")
 
-    def main(self):
-        while True:
-            incoming = self.queue.get()
+    def is_compact(self):
+        """Returns whether the database has the compact layout, which is only looked up again after a schema change"""
+        if self.compact is None:
+            self.compact = is_compact(self.c)
+        return self.compact
 
-            query, values, mode = incoming[0], incoming[1], incoming[2]
-            try:
-                if mode == 'execute':
-                    self.c.execute(query, values)
-                elif mode == 'executemany':
-                    self.c.executemany(query, values)
-            except:
-                pass
+    def spool_position(self, spool):
+        """Returns how far into `spool` the writes committed to this database go"""
+        self.c.execute('''CREATE TABLE IF NOT EXISTS spool_positions(spool text PRIMARY KEY, position integer)''')
+        self.c.execute('''SELECT position FROM spool_positions WHERE spool = ?''', (spool, ))
+        row = self.c.fetchone()
+        return row[0] if row is not None else 0
+
+    def wal_size(self):
+        try:
+            return os.path.getsize(self.file + '-wal')
+        except FileNotFoundError:
+            return 0
+
+    def deadline(self):
+        """Returns the time by which the open transaction must be committed, or None if nothing is pending"""
+        if not self.pending:
+            return None
+        return self.opened + self.batch_time
+
+    def is_due(self, now):
+        return len(self.pending) > 0 and (len(self.pending) >= self.batch_size or now >= self.deadline())
+
+
+class Forseti:
+    """Forseti is the single writer for the databases.
+
+    Writes arrive on the queue as (target, operation, values) tuples, where
+    `target` names one of the databases in `targets` and the operation is
+    as described in `resolve`. Rather than committing after every statement,
+    each target collects writes into an open transaction and commits them
+    together once it holds `batch_size` of them or `batch_time` seconds have
+    passed since the first. Each write runs inside its own savepoint, so a
+    statement that fails is rolled back on its own without taking the rest
+    of the batch with it. A `batch_size` of 1 restores the old
+    commit-per-statement behaviour. Message inserts update the per-day
+    rollups inside the same savepoint (see `run`).
+
+    `targets` maps target names either to a file or to a dict with `file`
+    and, optionally, its own `batch_size` and `batch_time`, so that
+    latency-sensitive databases can commit sooner than bulk ones. A target
+    can equally be given a Forseti process of its own.
+
+    Producers that need to know what happened to a write append their name
+    and a ticket to the item: (target, operation, values, producer, ticket).
+    Once the transaction holding that write has been committed, Forseti puts
+    a (ticket, rows, error) tuple on the producer's reply queue, as passed in
+    `replies`. `rows` is the number of rows the write changed and `error` is
+    the exception it raised, or None. Producers writing through a WriteQueue
+    also send the time the write was queued, and if `metrics` names a file,
+    Forseti writes its queue depth, commit latency and per-producer
+    throughput there every `metrics_interval` seconds.
+
+    If `spool` names a file, every write is appended to it before it is run
+    and replayed from it on startup (see Spool), and the targets relax to
+    `PRAGMA synchronous=NORMAL`. The spool is emptied whenever Forseti is
+    idle and a checkpoint shows every target's log is in its database.
+    Producers waiting on a reply are only answered once the spool is synced.
+
+    When the queue has been empty for `idle_time` seconds, Forseti also runs
+    maintenance on its targets, one task per idle gap so that a burst of
+    writes never waits behind more than one: a passive checkpoint once the
+    WAL passes `checkpoint_size` bytes (a truncating one past
+    `truncate_size`), `PRAGMA optimize` every `optimize_interval` seconds,
+    and, for databases with incremental auto-vacuum (every database Forseti
+    creates, see Target), an incremental vacuum
+    of up to `vacuum_pages` pages every `vacuum_interval` seconds. Each run
+    is logged with its timing. Pass maintenance=False to turn it off.
+    """
+
+    def __init__(self, queue, **kwargs):
+        self.queue = queue
+        batch_size = kwargs['batch_size'] if 'batch_size' in kwargs else 500
+        batch_time = kwargs['batch_time'] if 'batch_time' in kwargs else 0.1
+        targets = kwargs['targets'] if 'targets' in kwargs else {HEIMDALL: DATABASES[HEIMDALL]}
+        self.replies = kwargs['replies'] if 'replies' in kwargs else {}
+        spool = kwargs['spool'] if 'spool' in kwargs else None
+        self.spool_limit = kwargs['spool_limit'] if 'spool_limit' in kwargs else 100000
+        self.idle_time = kwargs['idle_time'] if 'idle_time' in kwargs else 1
+        metrics = kwargs['metrics'] if 'metrics' in kwargs else None
+        metrics_interval = kwargs['metrics_interval'] if 'metrics_interval' in kwargs else 60
+        self.metrics = Metrics(metrics, metrics_interval) if metrics is not None else None
+        self.maintenance = kwargs['maintenance'] if 'maintenance' in kwargs else True
+        self.checkpoint_size = kwargs['checkpoint_size'] if 'checkpoint_size' in kwargs else 16 * 1024 * 1024
+        self.truncate_size = kwargs['truncate_size'] if 'truncate_size' in kwargs else 256 * 1024 * 1024
+        self.checkpoint_interval = kwargs['checkpoint_interval'] if 'checkpoint_interval' in kwargs else 60
+        self.optimize_interval = kwargs['optimize_interval'] if 'optimize_interval' in kwargs else 6 * 60 * 60
+        self.vacuum_interval = kwargs['vacuum_interval'] if 'vacuum_interval' in kwargs else 10 * 60
+        self.vacuum_pages = kwargs['vacuum_pages'] if 'vacuum_pages' in kwargs else 1000
+
+        log_format = logging.Formatter(f'\n\n--------------------\n%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+        handler = logging.FileHandler('Forseti.log')
+        handler.setFormatter(log_format)
+        self.logger.addHandler(handler)
+
+        self.targets = {}
+        for name, config in targets.items():
+            if isinstance(config, str):
+                config = {'file': config}
+            self.targets[name] = Target(name,
+                                        config['file'],
+                                        config['batch_size'] if 'batch_size' in config else batch_size,
+                                        config['batch_time'] if 'batch_time' in config else batch_time)
+
+        self.spool = None
+        if spool is not None:
+            self.spool = Spool(spool)
+            for target in self.targets.values():
+                target.c.execute("PRAGMA synchronous=NORMAL;")
+            self.replay()
+
+    def replay(self):
+        """Runs every write left in the spool by a previous run that its target hasn't committed, and commits them"""
+        # A position past the end of the spool was recorded before the spool was emptied
+        positions = {name: target.spool_position(self.spool.file) for name, target in self.targets.items()}
+        positions = {name: position if position <= self.spool.size else 0 for name, position in positions.items()}
+
+        records = 0
+        replayed = 0
+        for end, incoming in self.spool.read():
+            records += 1
+            if incoming[0] in positions and end <= positions[incoming[0]]:
+                continue
+            self.write(incoming, end)
+            replayed += 1
+
+        for target in self.targets.values():
+            if target.pending:
+                self.commit(target)
+
+        self.spool.records = records
+        if replayed:
+            self.logger.warning(f"Replayed {replayed} writes from {self.spool.file}")
+
+    def receive(self, incoming):
+        """Spools a write taken from the queue, then runs it"""
+        end = None
+        if self.spool is not None:
+            # Whoever is waiting on the reply won't be after a restart, so only the write itself is kept
+            end = self.spool.append(tuple(incoming[:3]))
+        self.write(incoming, end)
+
+    def write(self, incoming, end=None):
+        """Runs a single write in its target's open transaction, inside a savepoint so that only it is rolled back if it fails.
 
-            self.conn.commit()
+        `end` is the offset just past the write in the spool, if it was spooled."""
+        name, operation, values = incoming[0], incoming[1], incoming[2]
+
+        if name not in self.targets:
+            self.logger.warning(f"Write to unknown target {name}")
+            self.acknowledge(incoming, 0, KeyError(name))
+            return
+
+        target = self.targets[name]
+        if not target.pending:
+            target.c.execute('BEGIN')
+            target.opened = time.monotonic()
+
+        rows = 0
+        error = None
+
+        target.c.execute('SAVEPOINT item')
+        try:
+            rows = run(target.c, operation, values, target.is_compact() if operation in MESSAGE_INSERTS else None)
+        except sqlite3.IntegrityError as e:
+            # Duplicate messages are expected whenever logs overlap, so these aren't worth a traceback
+            target.c.execute('ROLLBACK TO item')
+            self.logger.debug(f"Integrity error on operation {operation} in {name}")
+            error = e
+        except Exception as e:
+            target.c.execute('ROLLBACK TO item')
+            self.logger.exception(f"Error running operation {operation} in {name}")
+            error = e
+        finally:
+            target.c.execute('RELEASE item')
+
+        # Raw SQL is how the schema is changed, as when moving to the compact layout, so the layout has to be looked up again
+        if isinstance(operation, str):
+            target.compact = None
+
+        target.pending.append((incoming, rows, error))
+        if end is not None:
+            target.spooled = end
+
+    def commit(self, target):
+        """Commits a target's open transaction, then reports back to any producer that asked"""
+        results = target.pending
+        target.pending = []
+
+        try:
+            if self.spool is not None and target.spooled is not None:
+                # Recorded in the same transaction as the writes, so that a replay starts just past them
+                target.c.execute('''INSERT OR REPLACE INTO spool_positions VALUES(?, ?)''', (self.spool.file, target.spooled))
+            target.c.execute('COMMIT')
+        except sqlite3.Error as e:
+            self.logger.exception(f"Failed to commit a batch of {len(results)} writes to {target.name}")
+            target.c.execute('ROLLBACK')
+            results = [(incoming, 0, e) for incoming, rows, error in results]
+
+        if self.spool is not None and any(len(incoming) > 4 and incoming[4] is not None for incoming, rows, error in results):
+            self.spool.sync()
+
+        for incoming, rows, error in results:
+            self.acknowledge(incoming, rows, error)
+            if self.metrics is not None:
+                self.metrics.record(incoming, rows)
+
+    def commit_due(self):
+        """Commits every target whose batch is full or out of time"""
+        now = time.monotonic()
+        for target in self.targets.values():
+            if target.is_due(now):
+                self.commit(target)
+
+    def write_batch(self, batch):
+        """Writes every item in the batch and commits them straight away"""
+        for incoming in batch:
+            self.receive(incoming)
+        for target in self.targets.values():
+            if target.pending:
+                self.commit(target)
+
+    def acknowledge(self, incoming, rows, error):
+        """Sends the outcome of a write to its producer, if the producer asked for one"""
+        if len(incoming) < 5 or incoming[4] is None:
+            return
+
+        producer, ticket = incoming[3], incoming[4]
+        if producer in self.replies:
+            self.replies[producer].put((ticket, rows, error))
+        else:
+            self.logger.warning(f"No reply queue for producer {producer}")
+
+    def timeout(self):
+        """Returns how long to wait for the next write before a pending batch falls due, or before idle work is due"""
+        deadlines = [target.deadline() for target in self.targets.values() if target.pending]
+        if not deadlines:
+            return self.idle_time if self.has_idle_work() else None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def has_idle_work(self):
+        return (self.spool is not None and self.spool.records > 0) or self.metrics is not None or self.maintenance
+
+    def checkpoint_spool(self):
+        """Empties the spool if every target's log has been checkpointed into its database"""
+        for target in self.targets.values():
+            target.c.execute("PRAGMA wal_checkpoint(PASSIVE);")
+            busy, log, checkpointed = target.c.fetchone()
+            if log != checkpointed:
+                return False
+
+        self.spool.truncate()
+        for target in self.targets.values():
+            target.c.execute('''DELETE FROM spool_positions WHERE spool = ?''', (self.spool.file, ))
+            target.spooled = None
+        return True
+
+    def step(self):
+        """Waits for one write, runs it, and commits whatever has fallen due"""
+        idle = False
+        try:
+            self.receive(self.queue.get(timeout=self.timeout()))
+        except queue_module.Empty:
+            idle = True
+        self.commit_due()
+
+        if self.metrics is not None and self.metrics.is_due():
+            self.metrics.export(self.queue)
+
+        if any(target.pending for target in self.targets.values()):
+            return
+        if self.spool is not None and (idle or self.spool.records >= self.spool_limit) and self.spool.records > 0:
+            self.checkpoint_spool()
+        if idle and self.maintenance:
+            self.maintain()
+
+    def maintain(self):
+        """Runs the first maintenance task that is due, unless writes have started arriving again"""
+        for target in self.targets.values():
+            for task in [self.checkpoint, self.optimize, self.vacuum]:
+                if not self.queue.empty():
+                    return
+                if task(target):
+                    return
+
+    def checkpoint(self, target):
+        """Checkpoints the target's WAL once it has grown, truncating it if it has grown a lot"""
+        size = target.wal_size()
+        if size < self.checkpoint_size or time.monotonic() - target.last_checkpoint < self.checkpoint_interval:
+            return False
+
+        mode = 'TRUNCATE' if size >= self.truncate_size else 'PASSIVE'
+        start = time.monotonic()
+        target.c.execute(f"PRAGMA wal_checkpoint({mode});")
+        busy, log, checkpointed = target.c.fetchone()
+        target.last_checkpoint = time.monotonic()
+
+        self.logger.info(f"{mode} checkpoint of {target.file}: {checkpointed} of {log} frames from a {size / 1024 / 1024:.1f}MB WAL{' (busy)' if busy else ''} in {target.last_checkpoint - start:.3f}s")
+        return True
+
+    def optimize(self, target):
+        """Lets SQLite refresh the statistics its query planner uses"""
+        if time.monotonic() - target.last_optimize < self.optimize_interval:
+            return False
+
+        start = time.monotonic()
+        # Bounds the work ANALYZE does on each index, so that this stays cheap on large databases
+        target.c.execute("PRAGMA analysis_limit=1000;")
+        target.c.execute("PRAGMA optimize;")
+        target.last_optimize = time.monotonic()
+
+        self.logger.info(f"Optimized {target.file} in {target.last_optimize - start:.3f}s")
+        return True
+
+    def vacuum(self, target):
+        """Returns a bounded number of free pages to the filesystem, for databases using incremental auto-vacuum"""
+        if time.monotonic() - target.last_vacuum < self.vacuum_interval:
+            return False
+        target.last_vacuum = time.monotonic()
+
+        target.c.execute("PRAGMA auto_vacuum;")
+        if target.c.fetchone()[0] != 2:
+            return False
+        target.c.execute("PRAGMA freelist_count;")
+        free = target.c.fetchone()[0]
+        if free == 0:
+            return False
+
+        start = time.monotonic()
+        # Each step of the pragma frees one page, and execute only steps it once
+        target.c.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages});")
+
+        self.logger.info(f"Vacuumed {min(free, self.vacuum_pages)} of {free} free pages from {target.file} in {time.monotonic() - start:.3f}s")
+        return True
+
+    def main(self):
+        while True:
+            self.step()
 
 
-def main(queue):
-    forseti = Forseti(queue)
+def main(queue, **kwargs):
+    forseti = Forseti(queue, **kwargs)
     forseti.main()
@@ -8,33 +8,38 @@ curiosity, it should be able to track the movements of spammers and other
 known-problematic individuals.
 """
 
+import time
+
+# Taken before anything else is imported, so that --profile-startup can report how long importing took
+IMPORT_STARTED = time.perf_counter()
+
 import argparse
+import bisect
 import calendar
-import codecs
+import copy
 import json
 import logging
-import multiprocessing as mp
-import operator
 import os
-import random
-import re
+import queue
 import signal
 import sqlite3
-import string
 import sys
-import time
-from datetime import date, datetime
-from datetime import time as dttime
-from datetime import timedelta
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from logging import DEBUG, FileHandler
-from typing import Dict, List, Tuple, Union
+from typing import Dict, Tuple, Union
 
 import karelia
-import matplotlib.pyplot as plt
-from websocket._exceptions import WebSocketConnectionClosedException
 
+import bragi
+import forseti
 import loki
-import pyimgur
+import mimir
+import skirnir
+
+IMPORT_TIME = time.perf_counter() - IMPORT_STARTED
 
 test_funcs = []
 prod_funcs = []
@@ -75,6 +80,287 @@ class DebugFileHandler(FileHandler):
         FileHandler.emit(self, record)
 
 
+class Leaderboard:
+    """Ranks the posters in a room by the number of messages they've sent.
+
+    Posters are counted under their master nick if they have aliases, and
+    under the name they posted as otherwise. The ranking is kept as a list
+    of (-count, name) in sorted order alongside each name's count, so that
+    finding a name's position, or the name at a position, is a binary
+    search. Ties go to the name that sorts first.
+
+    Messages are counted per (sendername, normname), so that an alias
+    change moves exactly the messages it affects from one name to another.
+    The counts, and the name each sender is ranked under, are loaded from
+    the posters table, and Heimdall passes every write it makes to `apply`,
+    which keeps the ranking up to date. Commands read the ranking from
+    worker threads while the main loop applies writes to it, so both hold
+    `lock`."""
+
+    def __init__(self, room, normalise):
+        self.room = room
+        self.normalise = normalise
+        self.senders = {}
+        self.masters = {}
+        self.counts = {}
+        self.ranking = []
+        self.names = {}
+        self.aliases_version = None
+        self.lock = threading.Lock()
+
+    def load(self, cursor):
+        cursor.execute('''SELECT normalias, master FROM aliases''')
+        self.masters = dict(cursor.fetchall())
+
+        cursor.execute('''SELECT sendername, normname, name, count FROM posters WHERE room IS ?''', (self.room, ))
+        for sendername, normname, name, count in cursor.fetchall():
+            if normname not in self.senders:
+                self.senders[normname] = {}
+            self.senders[normname][sendername] = count
+            self.counts[name] = self.counts[name] + count if name in self.counts else count
+
+        self.ranking = sorted((-count, name) for name, count in self.counts.items())
+        for name in self.counts:
+            self.index_name(name)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.ranking)
+
+    def name_of(self, sendername, normname):
+        return self.masters[normname] if normname in self.masters else sendername
+
+    def index_name(self, name):
+        normname = self.normalise(name)
+        if normname not in self.names:
+            self.names[normname] = set()
+        self.names[normname].add(name)
+
+    def add(self, name, count):
+        """Adds `count` messages, which may be negative, to a name's total"""
+        total = count
+        if name in self.counts:
+            total += self.counts[name]
+            del self.ranking[bisect.bisect_left(self.ranking, (-self.counts[name], name))]
+            del self.counts[name]
+            self.names[self.normalise(name)].discard(name)
+
+        if total > 0:
+            self.counts[name] = total
+            bisect.insort(self.ranking, (-total, name))
+            self.index_name(name)
+
+    def position(self, normnick):
+        """Returns the position of the highest ranked name that normalises to `normnick`, or None"""
+        with self.lock:
+            if normnick not in self.names or not self.names[normnick]:
+                return None
+            return min(bisect.bisect_left(self.ranking, (-self.counts[name], name)) for name in self.names[normnick]) + 1
+
+    def at(self, position):
+        """Returns the (count, name) at a position, counting from 1"""
+        with self.lock:
+            count, name = self.ranking[position - 1]
+        return -count, name
+
+    def top(self, number):
+        with self.lock:
+            return [(-count, name) for count, name in self.ranking[:number]]
+
+    def apply(self, operation, values):
+        """Updates the ranking for a write that has been made to the database"""
+        with self.lock:
+            self.apply_rows(operation, values if isinstance(values, list) else [values])
+
+    def apply_rows(self, operation, rows):
+        if operation == forseti.INSERT_MESSAGE:
+            for row in rows:
+                if row[7] == self.room:
+                    self.count_message(row[4], row[5], 1)
+        elif operation == forseti.ALIAS_UPSERT:
+            for master, alias, normalias in rows:
+                self.remaster({normalias: master})
+        elif operation == forseti.ALIAS_INSERT:
+            for master, alias, normalias in rows:
+                if normalias not in self.masters:
+                    self.remaster({normalias: master})
+        elif operation == forseti.ALIAS_DELETE:
+            for normalias, in rows:
+                self.remaster({normalias: None})
+        elif operation == forseti.ALIAS_REMASTER:
+            for new_master, old_master in rows:
+                self.remaster({normalias: new_master for normalias, master in self.masters.items() if master == old_master})
+
+    def count_message(self, sendername, normname, count):
+        if normname not in self.senders:
+            self.senders[normname] = {}
+        senders = self.senders[normname]
+        senders[sendername] = senders[sendername] + count if sendername in senders else count
+        self.add(self.name_of(sendername, normname), count)
+
+    def remaster(self, changes):
+        """Moves the messages of everyone whose master nick changes, given as {normalias: new master, or None if they no longer have one}"""
+        for normalias, master in changes.items():
+            senders = self.senders[normalias] if normalias in self.senders else {}
+            for sendername, count in senders.items():
+                self.add(self.name_of(sendername, normalias), -count)
+
+            if master is None:
+                self.masters.pop(normalias, None)
+            else:
+                self.masters[normalias] = master
+
+            for sendername, count in senders.items():
+                self.add(self.name_of(sendername, normalias), count)
+
+
+class StatsCache:
+    """Replies to stats commands, kept until a write could have changed them.
+
+    Heimdall counts the messages it writes to each room and by each sender.
+    A reply is stored with the counts for what it was worked out from, and
+    with the aliases version and the UTC day, and is sent again while none
+    of them have changed and it's less than `max_age` seconds old. The age
+    limit covers writes made by other processes, which aren't counted.
+    Beyond `size` replies, the least recently used are dropped. The main
+    loop and the command workers share it, so every method holds `lock`."""
+
+    def __init__(self, size=128, max_age=300):
+        self.size = size
+        self.max_age = max_age
+        self.replies = OrderedDict()
+        self.rooms = {}
+        self.senders = {}
+        self.lock = threading.Lock()
+
+    def apply(self, operation, values):
+        """Counts the messages in a write that has been made to the database"""
+        with self.lock:
+            if operation in forseti.MESSAGE_INSERTS:
+                for row in (values if isinstance(values, list) else [values]):
+                    room, normname = row[7], row[5]
+                    self.rooms[room] = self.rooms[room] + 1 if room in self.rooms else 1
+                    self.senders[(room, normname)] = self.senders[(room, normname)] + 1 if (room, normname) in self.senders else 1
+            elif operation in forseti.ALIAS_WRITES or isinstance(operation, str):
+                self.replies.clear()
+
+    def stamp(self, room, normnames, aliases_version):
+        """Returns what a reply about `normnames` in `room` depends on, or a reply about the whole room if `normnames` is None"""
+        import norns
+
+        with self.lock:
+            if normnames is None:
+                written = self.rooms[room] if room in self.rooms else 0
+            else:
+                written = tuple(self.senders[(room, normname)] if (room, normname) in self.senders else 0 for normname in normnames)
+        return written, aliases_version, int(time.time() // norns.DAY)
+
+    def get(self, key, stamp):
+        """Returns the reply stored under `key` if it's still current, else None"""
+        with self.lock:
+            if key not in self.replies:
+                return None
+            reply, reply_stamp, stored = self.replies[key]
+            if reply_stamp != stamp or time.monotonic() - stored > self.max_age:
+                del self.replies[key]
+                return None
+            self.replies.move_to_end(key)
+            return reply
+
+    def put(self, key, stamp, reply):
+        with self.lock:
+            self.replies[key] = (reply, stamp, time.monotonic())
+            self.replies.move_to_end(key)
+            while len(self.replies) > self.size:
+                self.replies.popitem(last=False)
+
+
+class CommandPool:
+    """Runs commands on a pool of worker threads, so that the main loop keeps reading and logging messages while they run.
+
+    Each Heimdall serves one room, so `workers` is how many commands can run
+    for the room at once. Each user can have at most `per_user` of them
+    running, and any more wait for one of those to finish, so that one user
+    sending a run of heavy commands can't take every worker. `run` is called
+    with the arguments given to `submit`."""
+
+    def __init__(self, run, workers=4, per_user=1):
+        self.run = run
+        self.per_user = per_user
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='heimdall-command')
+        self.lock = threading.Lock()
+        self.running = {}
+        self.waiting = {}
+
+    def submit(self, user, *args):
+        with self.lock:
+            running = self.running[user] if user in self.running else 0
+            if running >= self.per_user:
+                self.waiting.setdefault(user, deque()).append(args)
+                return
+            self.running[user] = running + 1
+        self.executor.submit(self.work, user, args)
+
+    def work(self, user, args):
+        """Runs a command, then any of the same user's commands that were waiting for it to finish"""
+        while args is not None:
+            try:
+                self.run(*args)
+            except:
+                logging.getLogger(__name__).exception("Command failed")
+            with self.lock:
+                if user in self.waiting and self.waiting[user]:
+                    args = self.waiting[user].popleft()
+                else:
+                    args = None
+                    self.waiting.pop(user, None)
+                    self.running[user] -= 1
+                    if self.running[user] == 0:
+                        del self.running[user]
+
+    def shutdown(self):
+        """Waits for every command, including those waiting their turn, to finish"""
+        self.executor.shutdown(wait=True)
+
+
+class Reply:
+    """Stands in for the bot in a command running on a worker thread, so that the command sees the packet it came in and replies to it, whatever the bot has read since"""
+
+    def __init__(self, bot, packet):
+        self.bot = bot
+        self.packet = packet
+
+    def reply(self, message):
+        self.bot.send(message, self.packet.data.id)
+
+    def __getattr__(self, name):
+        return getattr(self.bot, name)
+
+
+class StartupProfile:
+    """Times each stage of startup, from the end of the stage before it, for --profile-startup"""
+
+    def __init__(self):
+        self.stages = [('imports', IMPORT_TIME)]
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        """Records the time since the last mark as `stage`"""
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def report(self):
+        # Unix only, like the peak memory figure it gives
+        import resource
+
+        width = max(len(stage) for stage, taken in self.stages + [('total', 0)])
+        lines = [f"{stage:<{width}} {taken * 1000:9.1f}ms" for stage, taken in self.stages]
+        lines.append(f"{'total':<{width}} {sum(taken for stage, taken in self.stages) * 1000:9.1f}ms")
+        lines.append(f"Peak memory: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB")
+        return "Startup profile:\n" + "\n".join(lines)
+
+
 class Heimdall:
     """Heimdall is the logging and statistics portion of the pantheon.
 
@@ -84,12 +370,18 @@ class Heimdall:
     """
 
     def __init__(self, room: Union[str, Tuple], **kwargs) -> None:
+        self.profile = StartupProfile()
+        self.profile_startup = kwargs['profile_startup'] if 'profile_startup' in kwargs else False
+
         if type(room) == str:
             self.room = room
             self.queue = None
+            self.reply_queue = None
         else:
             self.room = room[0]
-            self.queue = room[1]
+            self.queue = forseti.WriteQueue(room[1], self.room, kwargs['write_policy'] if 'write_policy' in kwargs else 'block')
+            self.reply_queue = room[2] if len(room) > 2 else None
+        self.ticket = 0
 
         log_format = logging.Formatter(f'\n\n--------------------\n%(asctime)s - &{self.room}: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
         self.logger = logging.getLogger(__name__)
@@ -115,6 +407,13 @@ class Heimdall:
         self.prod_funcs = prod_funcs
         self.dcal = kwargs['disconnect_after_log'] if 'disconnect_after_log' in kwargs else False
         self.fill_in = kwargs['fill_in'] if 'fill_in' in kwargs else False
+        self.write_timeout = kwargs['write_timeout'] if 'write_timeout' in kwargs else 60
+        self.stats_cache = StatsCache(kwargs['stats_cache_size'] if 'stats_cache_size' in kwargs else 128, kwargs['stats_max_age'] if 'stats_max_age' in kwargs else 300)
+        self.commands = CommandPool(self.run_command, kwargs['workers'] if 'workers' in kwargs else 4, kwargs['commands_per_user'] if 'commands_per_user' in kwargs else 1)
+        self.worker = threading.local()
+        self.leaderboards = {}
+        self.leaderboards_lock = threading.Lock()
+        self.canvas = bragi.Canvas(self.room, *kwargs['graphs']) if 'graphs' in kwargs and kwargs['graphs'] is not None else bragi.Canvas(self.room)
 
         self.logger.debug('Flags handled successfully')
 
@@ -142,6 +441,7 @@ class Heimdall:
             'messages_delivered': 'data/heimdall/messages_delivered.json'
         }
 
+        self.profile.mark('setup')
         self.show("Loading files... ")
 
         for key in self.files:
@@ -172,63 +472,141 @@ class Heimdall:
                 self.logger.exception("Error creating help text.")
                 self.show(f"Error creating help text - see 'Heimdall &{self.room}.log' for details.")
 
+        # Graphs are only uploaded in production, unless they're being sent to a local directory for testing
+        self.uploads = None
+        self.upload_timeout = kwargs['upload_timeout'] if 'upload_timeout' in kwargs else 30
+        if 'upload_dir' in kwargs and kwargs['upload_dir'] is not None:
+            self.uploads = skirnir.Courier(skirnir.DirectoryBackend(kwargs['upload_dir'], kwargs['upload_url'] if 'upload_url' in kwargs else None))
+
         with open(self.files['imgur'], 'r') as f:
             self.show("Reading imgur key, creating Imgur client...", end=' ')
             try:
                 self.imgur_key: str = json.loads(f.read())[0]
-                self.imgur_client = pyimgur.Imgur(self.imgur_key)
+                if self.prod_env and self.uploads is None:
+                    self.uploads = skirnir.Courier(skirnir.ImgurBackend(self.imgur_key))
                 self.show("done")
             except:
                 self.logger.exception("Failed to create imgur client.")
                 self.show(f"Error reading imgur key - see 'Heimdall &{self.room}.log' for details.")
 
+        self.profile.mark('files')
         self.show("Connecting to database...", end=' ')
         self.connect_to_database()
         if self.force_new_logs:
             self.show("done\nDeleting messages...", end=' ')
             self.write_to_database('''DELETE FROM messages WHERE room IS ?''', values=(self.room, ))
+            self.write_to_database('''DELETE FROM message_days WHERE room IS ?''', values=(self.room, ))
+            self.write_to_database('''DELETE FROM posters WHERE room IS ?''', values=(self.room, ))
+            self.write_to_database('''DELETE FROM reply_edges WHERE room IS ?''', values=(self.room, ))
             self.show("done\nCreating tables...", end=' ')
         self.check_or_create_tables()
         self.show("done")
+        self.profile.mark('database')
 
         self.heimdall.connect(True)
+        self.profile.mark('connect')
         self.show("Getting logs...", end=' ')
         self.get_room_logs()
         self.show("Done.")
+        self.profile.mark('backfill')
 
         try:
-            self.c.execute('''SELECT COUNT(*) FROM messages WHERE room IS ?''', (self.room, ))
+            # Counted from the daily rollup, rather than by reading through every message in the room
+            self.c.execute('''SELECT COALESCE(SUM(count), 0) FROM message_days WHERE room IS ?''', (self.room, ))
             self.total_messages_all_time = self.c.fetchone()[0]
         except:
             self.total_messages_all_time = 0
             self.logger.warning("Apparently no messages in the room.")
+        self.profile.mark('count')
 
         self.conn.close()
         self.heimdall.disconnect()
         self.show("Ready")
 
     def write_to_database(self, statement, **kwargs):
-        """Optionally, pass values=values, mode=mode."""
+        """Optionally, pass values=values, mode=mode, wait=wait.
+
+        `statement` is either one of the typed operations in forseti or an SQL
+        string. With wait=True, returns the number of rows changed once the
+        write has been committed, re-raising any exception it caused. Writes
+        sent to Forseti without a reply queue, or without wait=True, return
+        None."""
         values = kwargs['values'] if 'values' in kwargs else ()
         mode = kwargs['mode'] if 'mode' in kwargs else "execute"
+        wait = kwargs['wait'] if 'wait' in kwargs else False
+        rows = None
+
+        # Forseti tells the two modes apart by whether the values are a list
+        if mode == "execute":
+            values = tuple(values)
+        elif mode == "executemany":
+            values = list(values)
+        else:
+            raise UnknownMode
 
         if self.queue is not None:
-            send = (statement, values, mode,)
-            self.queue.put(send)
+            if wait and self.reply_queue is not None:
+                self.ticket += 1
+                self.queue.put(forseti.HEIMDALL, statement, values, self.ticket)
+                rows = self.wait_for_write(self.ticket)
+            else:
+                self.queue.put(forseti.HEIMDALL, statement, values)
 
         else:
-            if mode == "execute":
-                self.c.execute(statement, values)
-            elif mode == "executemany":
-                self.c.executemany(statement, values)
-            else:
-                raise UnknownMode
+            if self.compact is None:
+                self.compact = forseti.is_compact(self.c)
+            rows = forseti.run(self.c, statement, values, self.compact)
 
         self.conn.commit()
 
+        # Raw SQL is how the schema is changed, so the layout has to be looked up again
+        if isinstance(statement, str):
+            self.compact = None
+
+        self.stats_cache.apply(statement, values)
+        # Held while the rankings are updated, so that a command worker never loads a leaderboard from the database while a write is being applied
+        with self.leaderboards_lock, self.aliases.lock:
+            if isinstance(statement, str) or statement == forseti.INSERT_MESSAGES_BULK:
+                # Only typed writes say what they changed, so anything else means starting the rankings and aliases afresh
+                self.leaderboards.clear()
+                self.aliases.invalidate()
+            else:
+                applied = self.aliases.version
+                self.aliases.apply(statement, values)
+                for leaderboard in self.leaderboards.values():
+                    leaderboard.apply(statement, values)
+                    # Alias writes made here are applied in place, so only those made by other processes mean loading the leaderboard again
+                    if leaderboard.aliases_version == applied:
+                        leaderboard.aliases_version = self.aliases.version
+
+        return rows
+
+    def wait_for_write(self, ticket):
+        """Blocks until Forseti reports on the write with the given ticket"""
+        while True:
+            try:
+                reply_ticket, rows, error = self.reply_queue.get(timeout=self.write_timeout)
+            except queue.Empty:
+                self.logger.warning(f"No reply from Forseti for write {ticket}")
+                return None
+
+            # Replies to writes we have stopped waiting on are stale
+            if reply_ticket != ticket:
+                continue
+            if error is not None:
+                raise error
+            return rows
+
     def connect_to_database(self):
         self.conn = sqlite3.connect(self.database)
         self.c = self.conn.cursor()
+
+        # Heimdall, Loki and the command workers resolve aliases through the same copy of the table, which reads through a connection of its own so that any of their threads can use it
+        self.aliases = loki.Aliases(sqlite3.connect(self.database, check_same_thread=False).cursor())
+        self.loki.aliases = self.aliases
+        with self.leaderboards_lock:
+            self.leaderboards.clear()
+        self.compact = None
         self.check_or_create_tables()
 
     def show(self, *args, **kwargs):
@@ -248,38 +626,29 @@ class Heimdall:
         Tries to create tables. If it fails, assume tables already exist.
         """
 
-        self.write_to_database('''  CREATE TABLE IF NOT EXISTS messages(
-                            content text,
-                            id text,
-                            parent text,
-                            senderid text,
-                            sendername text,
-                            normname text,
-                            time real,
-                            room text,
-                            globalid text
-                        )''')
-        self.write_to_database('''CREATE UNIQUE INDEX IF NOT EXISTS globalid ON messages(globalid)''')
-        self.write_to_database('''CREATE TABLE IF NOT EXISTS aliases(master text, alias text, normalias text)''')
-        self.write_to_database('''CREATE UNIQUE INDEX IF NOT EXISTS master ON aliases(alias)''')
+        # Everything after the original tables is a migration, so that it only runs once against a database. Under Yggdrasil these have already run by the time any room starts, and a database at the latest version needs nothing more, so this returns without waiting on Forseti for any writes
+        migrations = mimir.Mimir(self.c, lambda statement, values: self.write_to_database(statement, values=values, wait=True))
+        if not migrations.pending():
+            return
+        migrations.create_tables()
+        migrations.migrate()
 
     def get_room_logs(self):
         """Create or update logs of the room.
 
         Specifically, request logs in batches of 1000 (the maximum allowed
         by the Heim API), then attempt to store these in the database.
-        Continue to do this until an insert operation fails with an
-        IntegrityError (meaning the insert cannot be performed due to
-        a unique index on the message id column, in which case the logs
+        Continue to do this until an insert operation stores fewer rows than
+        it was given (meaning some of the messages are already present due
+        to the unique index on the message id column, in which case the logs
         we have are up to date) or until the returned list of messages
         has length less than 1000, indicating that the end of the room's
         history has been reached.
         """
         self.heimdall.send({'type': 'log', 'data': {'n': 1000}})
 
-        # Query gets the most recent message sent so that we have something to compare to. If Heimdall is running in stand-alone mode, the sqlite3.IntegrityError that gets raised to signal that the logs are up to date will be received, but if it is writing to the database via Forseti, it has no way to receive that exception, so we have to check manually for that usecase.
+        # Inserts ignore duplicates and report how many rows were stored. In stand-alone mode that comes straight from the cursor, and through Forseti it comes back on the reply queue. Only when writing through Forseti without a reply queue do we have to check manually for the most recent message we already have.
         update_done = False
-        bulk_insert = f'''INSERT OR {'ignore' if self.fill_in else 'FAIL'} INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)'''
 
         while True:
             try:
@@ -318,14 +687,17 @@ class Heimdall:
                                  message['sender']['name']), message['time'],
                              self.room, self.room + message['id']))
 
-                    # Attempts to insert all the messages in bulk. If it fails, it will
-                    # break out of the loop and we will assume that the logs are now
-                    # up to date.
-                    self.c.execute('''SELECT COUNT(*) FROM messages WHERE globalid=?''', (data[0][8],))
-                    if self.c.fetchone()[0] == 1 and not self.fill_in:
-                        self.show("Log update done; most recent message in ther DB has been reached.")
+                    # Attempts to insert all the messages in bulk. If any of them were
+                    # already stored, we will assume that the logs are now up to date.
+                    if self.queue is not None and self.reply_queue is None:
+                        self.c.execute('''SELECT COUNT(*) FROM messages WHERE globalid=?''', (data[0][8],))
+                        if self.c.fetchone()[0] == 1 and not self.fill_in:
+                            self.show("Log update done; most recent message in ther DB has been reached.")
+                            raise UpdateDone
+                    inserted = self.write_to_database(forseti.INSERT_MESSAGES_BULK, values=data, mode="executemany", wait=True)
+                    if inserted is not None and inserted < len(data) and not self.fill_in:
+                        self.show("Log update done; most recent message in the DB has been reached.")
                         raise UpdateDone
-                    self.write_to_database(bulk_insert, values=data, mode="executemany")
 
                     if update_done:
                         raise UpdateDone
@@ -359,7 +731,7 @@ class Heimdall:
                     message['sender']['id'], message['sender']['name'],
                     self.heimdall.normalise_nick(message['sender']['name']),
                     message['time'], self.room, self.room + message['id'])
-        self.write_to_database('''INSERT INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', values=data)
+        self.write_to_database(forseti.INSERT_MESSAGE, values=data)
 
     def next_day(self, day):
         """
@@ -385,29 +757,30 @@ class Heimdall:
         """
         return (datetime.utcfromtimestamp(timestamp).strftime("%Y-%m-%d"))
 
+    def get_leaderboard(self, room):
+        """Returns the Leaderboard for a room, loading it on first use and again after another process changes the aliases.
+
+        Command workers call this too. The leaderboards are loaded and
+        published under `leaderboards_lock`, which the main loop holds while
+        applying each write, so none are missed by a load."""
+        with self.leaderboards_lock:
+            self.aliases.refresh()
+            if room not in self.leaderboards or self.leaderboards[room].aliases_version != self.aliases.version:
+                leaderboard = Leaderboard(room, self.heimdall.normalise_nick)
+                leaderboard.load(self.c)
+                leaderboard.aliases_version = self.aliases.version
+                self.leaderboards[room] = leaderboard
+            return self.leaderboards[room]
+
     def get_position(self, nick):
         """Returns the rank the supplied nick has by number of messages"""
         master_nick = self.heimdall.normalise_nick(self.get_master_nick_of_user(nick))
-        position = 1
-        pairs = self.get_count_user_pairs(self.use_logs)
-        pair = next(pairs)
-        while True:
-            if pair is None:
-                return None
-            elif self.heimdall.normalise_nick(pair[1]) == master_nick:
-                return position
-            position += 1
-            pair = next(pairs)
+        return self.get_leaderboard(self.use_logs).position(master_nick)
 
     def get_master_nick_of_user(self, user):
         """For a given user, returns their 'master nick' if aliases are known for them, else their username"""
-        normnick = self.heimdall.normalise_nick(user)
-        self.c.execute('''SELECT master FROM aliases WHERE normalias = ?''', (normnick,))
-        try:
-            master_nick = self.c.fetchall()[0][0]
-            return master_nick
-        except IndexError:
-            return user
+        master_nick = self.aliases.master_of(self.heimdall.normalise_nick(user))
+        return master_nick if master_nick is not None else user
 
     def get_user_at_position(self, position, room_requested):
         """Returns the user at the specified position"""
@@ -415,65 +788,46 @@ class Heimdall:
         # Check to see they've passed a number
         try:
             position = int(position)
-            assert position != 0
+            assert position > 0
         except:
             return "The position you specified was invalid."
 
-        self.c.execute('''SELECT COUNT(*) FROM (SELECT COUNT(*) AS amount, CASE master IS NULL WHEN TRUE THEN sendername ELSE master END AS name FROM messages LEFT JOIN aliases ON normname=normalias WHERE room=? GROUP BY name ORDER BY amount DESC)''', (room_requested, ))
-        total_posters = self.c.fetchall()[0][0]
+        leaderboard = self.get_leaderboard(room_requested)
+        total_posters = len(leaderboard)
         if position > total_posters:
             return f"Position not found; there have been {total_posters} posters in &{self.use_logs}."
 
-        pairs = self.get_count_user_pairs(room_requested)
-        for i in range(position):
-            name = "".join(next(pairs)[1].split())
+        name = "".join(leaderboard.at(position)[1].split())
 
         return f"The user at position {position} is @{name}."
 
     def graph_data(self, data_x, data_y, title):
-        """Graphs the data passed to it and returns a graph"""
-        f, ax = plt.subplots(1)
-        plt.title(title)
-        ax.plot(data_x, data_y)
-        plt.gcf().autofmt_xdate()
-        ax.xaxis.set_major_locator(plt.MaxNLocator(10))
-        ax.set_ylim(ymin=0)
-        return f
-
-    def save_graph(self, fig):
-        """Saves the provided graph with a random filename"""
-        filename = ''.join(random.choices(string.ascii_uppercase + string.digits, k=10)) + ".png"
-        fig.savefig(filename)
-        return filename
-
-    def upload_and_delete_graph(self, filename):
-        """Uploads passed file to imgur and deletes it"""
-        if self.prod_env:
-            try:
-                url = self.imgur_client.upload_image(filename).link
-            except:
-                self.logger.exception("Imgur upload failed")
-                url = "Imgur upload failed, sorry."
-        else:
-            url = "fake_url_here"
+        """Graphs the data passed to it and returns the bragi.Graph"""
+        return self.canvas.draw(title, data_x, data_y)
+
+    def graph_panels(self, panels):
+        """Graphs each (data_x, data_y, title) passed to it as a panel of one graph and returns the bragi.Graph"""
+        return self.canvas.draw_panels([(title, data_x, data_y) for data_x, data_y, title in panels])
+
+    def upload_graphs(self, graphs):
+        """Uploads graphs concurrently and returns their URLs, reusing the URL Bragi has for any graph that has been uploaded before"""
+        if self.uploads is None:
+            return ["fake_url_here"] * len(graphs)
+
+        urls = [graph.url for graph in graphs]
+        missing = [i for i, url in enumerate(urls) if url is None]
+        for i, url in zip(missing, self.uploads.upload_all([graphs[i].png for i in missing], self.upload_timeout)):
+            if isinstance(url, Exception):
+                self.logger.error(f"Graph upload failed: {url!r}")
+                urls[i] = "Imgur upload failed, sorry."
+            else:
+                self.canvas.uploaded(graphs[i], url)
+                urls[i] = url
 
-        os.remove(filename)
-        return url
+        return urls
 
     def get_aliases(self, user):
-        normnick = self.heimdall.normalise_nick(user)
-
-        self.c.execute('''SELECT master FROM aliases WHERE normalias = ?''', (normnick, ))
-        try:
-            master = self.c.fetchall()[0][0]
-        except:
-            master = normnick
-        self.c.execute('''SELECT alias FROM aliases WHERE master = ?''', (master, ))
-        reply = self.c.fetchall()
-        if not reply:
-            return []
-        else:
-            return [alias[0] for alias in reply]
+        return self.loki.get_aliases(user)
 
     @prod
     def get_user_stats(self):
@@ -485,6 +839,11 @@ class Heimdall:
         if comm[0] != "!stats":
             return
 
+        # NumPy, and norns with it, are only imported once someone asks for stats, so that rooms start without them
+        import numpy as np
+
+        import norns
+
         self.logger.debug(f'Got a stats request from "{self.heimdall.packet.data.sender.name}"')
         options = []
         user = self.heimdall.packet.data.sender.name
@@ -497,8 +856,8 @@ class Heimdall:
                 self.heimdall.reply("Sorry, I didn't understand that. Syntax is !stats (options) or !stats @user (options)")
                 return
 
-        if options == []:
-            options = ['messages', 'engagement', 'text']
+        if options == [] or options == ['combined']:
+            options = ['messages', 'engagement', 'text'] + options
 
         normnick = self.heimdall.normalise_nick(user)
 
@@ -518,9 +877,20 @@ class Heimdall:
             aliases_used = "No aliases used."
             aliases = [normnick]
 
-        # Query gets the number of messages sent. `','.join(['?']*len(aliases))` is used so that there are enough question marks for the number of aliases
-        self.c.execute(f'''SELECT count(*) FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))})''', (self.use_logs, *aliases,))
-        count = self.c.fetchone()[0]
+        # A reply with a ranking in depends on everyone in the room, and one without only on the user's own messages
+        self.aliases.refresh()
+        cache_key = ('stats', self.use_logs, user, tuple(options), tuple(aliases))
+        cache_stamp = self.stats_cache.stamp(self.use_logs, None if 'messages' in options else aliases, self.aliases.version)
+        cached = self.stats_cache.get(cache_key, cache_stamp)
+        if cached is not None:
+            self.logger.debug('Sending cached results')
+            self.heimdall.reply(cached)
+            return
+
+        # Query gets the number of messages, words and characters sent on each day from the daily rollup, in one pass over the user's rows, and everything else about their messages is worked out from those. `','.join(['?']*len(aliases))` is used so that there are enough question marks for the number of aliases
+        self.c.execute(f'''SELECT day, SUM(count), SUM(words), SUM(characters) FROM message_days WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))}) GROUP BY day''', (self.use_logs, *aliases,))
+        rows = np.array(self.c.fetchall(), dtype=np.int64).reshape(-1, 4)
+        count, words, characters = (int(total) for total in rows[:, 1:].sum(axis=0))
 
         if count == 0:
             self.heimdall.reply('User @{} not found.'.format(user.replace(' ', '')))
@@ -530,38 +900,24 @@ class Heimdall:
             self.heimdall.reply("No options specified. Please only use --aliases or -a in conjunction with --messages (or -m), --engagement (-e), --text (-t), or a combination thereof.")
 
         if 'messages' in options:
-            # Query gets the earliest message sent
-            self.c.execute(f'''SELECT * FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))}) ORDER BY time ASC''', (self.use_logs, *aliases,))
-            earliest = self.c.fetchone()
-
-            # Query gets the most recent message sent
-            self.c.execute(f'''SELECT * FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))}) ORDER BY time DESC''', (self.use_logs, *aliases,))
-            latest = self.c.fetchone()
-
-            days = {}
-            self.c.execute(f'''SELECT time, COUNT(*) FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))}) GROUP BY CAST(time / 86400 AS INT)''', (self.use_logs, *aliases,))
-            daily_messages = self.c.fetchall()
-            days = {}
-            dates = [datetime.utcfromtimestamp(int(x)).strftime("%Y-%m-%d") for x in range(int(earliest[6]), int(time.time()), 60 * 60 * 24)]
-
-            for _date in dates:
-                days[_date] = 0
+            # Every day from their first message to today, including those they sent nothing on
+            today = int(time.time() // norns.DAY)
+            days = norns.Series.from_days(rows[:, :2], last=today)
+            first_day, last_day = int(rows[:, 0].min()), int(rows[:, 0].max())
 
-            for message in daily_messages:
-                day = datetime.utcfromtimestamp(message[0]).strftime("%Y-%m-%d")
-                days[day] = message[1]
+            # Query gets the earliest message sent and the time of the most recent, only reading the messages sent on the first and last days. SQLite takes the content from the row with the earliest time
+            self.c.execute(f'''SELECT earliest.content, earliest.time, latest.time FROM
+                                 (SELECT content, MIN(time) AS time FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))}) AND time >= ? AND time < ?) AS earliest,
+                                 (SELECT MAX(time) AS time FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))}) AND time >= ? AND time < ?) AS latest''',
+                           (self.use_logs, *aliases, first_day * norns.DAY, (first_day + 1) * norns.DAY, self.use_logs, *aliases, last_day * norns.DAY, (last_day + 1) * norns.DAY))
+            first_message, first_time, last_time = self.c.fetchone()
 
-            try:
-                messages_today = days[datetime.utcfromtimestamp(datetime.today().timestamp()).strftime("%Y-%m-%d")]
-            except KeyError:
-                messages_today = 0
-
-            days_by_busyness = [(k, days[k]) for k in sorted(days, key=days.get, reverse=True)]
-            busiest_day = days_by_busyness[0]
+            messages_today = days.on(today)
+            busiest_day = days.busiest()
 
             # Calculate when the first message was sent, when the most recent message was sent, and the averate messages per day.
-            first_message_sent = self.date_from_timestamp(earliest[6])
-            last_message_sent = self.date_from_timestamp(latest[6])
+            first_message_sent = self.date_from_timestamp(first_time)
+            last_message_sent = self.date_from_timestamp(last_time)
 
             # number_of_days only takes the average of days between the first message and the most recent message
             number_of_days = (datetime.strptime(last_message_sent, "%Y-%m-%d") - datetime.strptime(first_message_sent, "%Y-%m-%d")).days
@@ -584,47 +940,33 @@ class Heimdall:
             except ZeroDivisionError:
                 avg_messages_per_day = 0
 
-            days = sorted(days.items())
-
-            last_28_days = days[-28:]
+            last_28_days = days.window(max(today - 27, days.first), today)
 
-            title = "Messages by {}, last 28 days".format(user)
-            data_x = [day[0] for day in last_28_days]
-            data_y = [day[1] for day in last_28_days]
-            if not self.prod_env:
-                last_28_url = "url_goes_here"
+            last_28_panel = (last_28_days.dates(), last_28_days.counts, "Messages by {}, last 28 days".format(user))
+            all_time_panel = (days.dates(), days.counts, "Messages by {}, all time".format(user))
+            if self.uploads is None:
+                graph_urls = "url_goes_here" if 'combined' in options else "url_goes_here url_goes_here"
+            elif 'combined' in options:
+                graph_urls = self.upload_graphs([self.graph_panels([all_time_panel, last_28_panel])])[0]
             else:
-                last_28_graph = self.graph_data(data_x, data_y, title)
-                last_28_file = self.save_graph(last_28_graph)
-                last_28_url = self.upload_and_delete_graph(last_28_file)
-
-            title = "Messages by {}, all time".format(user)
-            data_x = [day[0] for day in days]
-            data_y = [day[1] for day in days]
-            if not self.prod_env:
-                all_time_url = "url_goes_here"
-            else:
-                all_time_graph = self.graph_data(data_x, data_y, title)
-                all_time_file = self.save_graph(all_time_graph)
-                all_time_url = self.upload_and_delete_graph(all_time_file)
+                last_28_url, all_time_url = self.upload_graphs([self.graph_data(*last_28_panel), self.graph_data(*all_time_panel)])
+                graph_urls = f"{all_time_url} {last_28_url}"
 
             # Get requester's position.
             position = self.get_position(normnick)
-            self.c.execute(
-                '''SELECT COUNT(normname) FROM (SELECT normname, COUNT(*) as count FROM messages WHERE room IS ? GROUP BY normname) ORDER BY count DESC''',
-                (self.use_logs, ))
+            self.c.execute('''SELECT COUNT(DISTINCT normname) FROM posters WHERE room IS ?''', (self.use_logs, ))
             no_of_posters = self.c.fetchone()[0]
 
             message_results = f"""User:\t\t\t\t\t{user}
 Messages:\t\t\t\t{count}
 Messages Sent Today:\t\t{messages_today}
 First Message Date:\t\t{first_message_sent}
-First Message:\t\t\t{earliest[0]}
+First Message:\t\t\t{first_message}
 Most Recent Message:\t{last_message_sent}
 Average Messages/Day:\t{avg_messages_per_day}
 Busiest Day:\t\t\t\t{busiest_day[0]}, with {busiest_day[1]} messages
 Ranking:\t\t\t\t\t{position} of {no_of_posters}.
-{all_time_url} {last_28_url}
+{graph_urls}
 
 """
 
@@ -637,30 +979,23 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
             engagement_results = ""
 
         if 'text' in options:
-            self.c.execute('''SELECT COUNT(*) from messages WHERE room IS ? AND normname IS ? AND parent IS ?''', (self.use_logs, normnick, '',))
+            self.c.execute('''SELECT COALESCE(SUM(top_level), 0) FROM message_days WHERE room IS ? AND normname IS ?''', (self.use_logs, normnick,))
             tlts = round((self.c.fetchall()[0][0] * 100) / count, 2)
             text_results = f"TLTs %:\t{tlts}\n\n"
-            self.c.execute(f'''SELECT content FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))}) ORDER BY random() LIMIT 1000''', (self.use_logs, *aliases,))
-            messages = [message[0] for message in self.c.fetchall()]
-
-            average_message_words = 0
-            average_message_characters = 0
-            sample_size = len(messages)
 
-            for message in messages:
-                average_message_words += len(message.split())
-                average_message_characters += len(message)
-            average_message_words /= sample_size
-            average_message_characters /= sample_size
+            average_message_words = words / count
+            average_message_characters = characters / count
 
-            text_results += f"Average words per message:\t\t{int(average_message_words)}\nAverage characters per message:\t{int(average_message_characters)}\n(Sample size of {sample_size})\n\n"
+            text_results += f"Average words per message:\t\t{int(average_message_words)}\nAverage characters per message:\t{int(average_message_characters)}\n\n"
 
         else:
             text_results = ""
 
         # Collate and send the lot.
         self.logger.debug('Sending results')
-        self.heimdall.reply(f"""{message_results}{engagement_results}{text_results}{aliases_used}""")
+        reply = f"""{message_results}{engagement_results}{text_results}{aliases_used}"""
+        self.stats_cache.put(cache_key, cache_stamp, reply)
+        self.heimdall.reply(reply)
 
     @test
     def run_queries(self):
@@ -745,9 +1080,15 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
             if comm[0] != "!roomstats":
                 return
 
+            import numpy as np
+
+            import norns
+
             self.logger.debug(f"Got a roomstats request from {self.heimdall.packet.data.sender.name}")
+            combined = '-c' in comm or '--combined' in comm
+            comm = [arg for arg in comm if arg not in ['-c', '--combined']]
             if len(comm) == 2 and comm[1].startswith('&'):
-                self.c.execute('''SELECT COUNT(*) FROM messages WHERE room IS ?''', (comm[1][1:], ))
+                self.c.execute('''SELECT COALESCE(SUM(count), 0) FROM message_days WHERE room IS ?''', (comm[1][1:], ))
                 count = self.c.fetchone()[0]
                 if count == 0:
                     self.heimdall.reply("I do not operate in that room.")
@@ -758,82 +1099,55 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
 
             elif len(comm) == 1:
                 room_requested = self.use_logs
-                self.c.execute('''SELECT count(*) FROM messages WHERE room IS ?''', (self.use_logs, ))
+                self.c.execute('''SELECT COALESCE(SUM(count), 0) FROM message_days WHERE room IS ?''', (self.use_logs, ))
                 count = self.c.fetchone()[0]
 
+            self.aliases.refresh()
+            cache_key = ('roomstats', room_requested, combined)
+            cache_stamp = self.stats_cache.stamp(room_requested, None, self.aliases.version)
+            cached = self.stats_cache.get(cache_key, cache_stamp)
+            if cached is not None:
+                self.logger.debug("Sending cached results.")
+                self.heimdall.reply(cached)
+                return
+
             # Calculate top ten posters of all time
             top_ten = ""
-            posters = self.get_count_user_pairs(room_requested)
-            i = 0
-            for pair in posters:
-                i += 1
+            leaderboard = self.get_leaderboard(room_requested)
+            for i, pair in enumerate(leaderboard.top(10), 1):
                 top_ten += "{:2d}) {:<7}\t{}\n".format(i, int(pair[0]), pair[1])
-                if i == 10:
-                    break
-
-            self.c.execute('''SELECT COUNT(*) FROM (SELECT COUNT(*) AS amount, CASE master IS NULL WHEN TRUE THEN sendername ELSE master END AS name FROM messages LEFT JOIN aliases ON normname=normalias WHERE room=? GROUP BY name ORDER BY amount DESC)''', (room_requested, ))
-            total_posters = self.c.fetchall()[0][0]
-
-            # Get activity over the last 28 days
-            self.c.execute('''SELECT time, COUNT(*) FROM messages WHERE room IS ? GROUP BY CAST(time/86400 AS INT)''', (room_requested, ))
-            messages_by_day = self.c.fetchall()
-
-            lower_bound = self.next_day(time.time()) - (60 * 60 * 24 * 28)
-            self.c.execute('''SELECT time, COUNT(*) FROM messages WHERE room IS ? AND time > ? GROUP BY CAST(time / 86400 AS INT)''', (room_requested, lower_bound,))
-            last_28_days = self.c.fetchall()
-
-            days = last_28_days[:]
-            last_28_days = []
-            for day in days:
-                last_28_days.append((self.next_day(day[0]) - 60 * 60 * 24, day[1],))
-
-            per_day_last_four_weeks = int(sum([count[1] for count in last_28_days]) / 28)
-            last_28_days.sort(key=operator.itemgetter(1))
-
-            title = "[Legacy] Messages in &{}, last 28 days".format(room_requested)
-            data_x = [date.fromtimestamp(int(day[0])) for day in last_28_days]
-            data_y = [day[1] for day in last_28_days]
-            last_28_graph = self.graph_data(data_x, data_y, title)
-            last_28_file = self.save_graph(last_28_graph)
-            legacy_last_28_url = self.upload_and_delete_graph(last_28_file)
-
-            last_28_days.sort(key=operator.itemgetter(0))
-
-            title = "Messages in &{}, last 28 days".format(room_requested)
-            data_x = [date.fromtimestamp(int(day[0])) for day in last_28_days]
-            data_y = [day[1] for day in last_28_days]
-            last_28_graph = self.graph_data(data_x, data_y, title)
-            last_28_file = self.save_graph(last_28_graph)
-            last_28_url = self.upload_and_delete_graph(last_28_file)
-
-            title = "Messages in &{}, all time".format(room_requested)
-            data_x = [date.fromtimestamp(int(day[0])) for day in messages_by_day]
-            data_y = [day[1] for day in messages_by_day]
-            all_time_graph = self.graph_data(data_x, data_y, title)
-            all_time_file = self.save_graph(all_time_graph)
-            all_time_url = self.upload_and_delete_graph(all_time_file)
-
-            if last_28_days is None:
-                self.heimdall.reply(f"There have been {count} posts in &{room_requested}, though none in the last 28 days.\n\nThe top ten posters are:\n{top_ten}\n{all_time_url}")
-                return
 
-            if len(last_28_days) > 0:
-                busiest = (datetime.utcfromtimestamp(last_28_days[-1][0]).strftime("%Y-%m-%d"), last_28_days[0][1])
-                last_28_days.sort(key=operator.itemgetter(0))
+            total_posters = len(leaderboard)
 
-                midnight = calendar.timegm(datetime.utcnow().date().timetuple())
-                messages_today = 0
-                if midnight in [tup[0] for tup in last_28_days]:
-                    messages_today = dict(last_28_days)[midnight]
+            # Get activity over all time and over the 28 days up to today, from the daily rollup
+            today = int(time.time() // norns.DAY)
+            self.c.execute('''SELECT day, SUM(count) FROM message_days WHERE room IS ? GROUP BY day''', (room_requested, ))
+            messages_by_day = norns.Series.from_days(self.c.fetchall(), last=today)
+            last_28_days = messages_by_day.window(today - 27, today)
 
-                busiest_last_28 = f" (the busiest was {busiest[0]} with {busiest[1]} messages sent)"
+            per_day_last_four_weeks = int(last_28_days.total() / 28)
 
+            # The legacy graph plots the days in order of how busy they were
+            by_busyness = np.argsort(last_28_days.counts, kind='stable')
+            panels = [(messages_by_day.dates(), messages_by_day.counts, "Messages in &{}, all time".format(room_requested)),
+                      (last_28_days.dates(), last_28_days.counts, "Messages in &{}, last 28 days".format(room_requested)),
+                      (last_28_days.dates()[by_busyness], last_28_days.counts[by_busyness], "[Legacy] Messages in &{}, last 28 days".format(room_requested))]
+            if combined:
+                graph_urls = self.upload_graphs([self.graph_panels(panels)])[0]
+            else:
+                graph_urls = " ".join(self.upload_graphs([self.graph_data(*panel) for panel in panels]))
+
+            messages_today = last_28_days.on(today)
+            if last_28_days.total() > 0:
+                busiest = last_28_days.busiest()
+                busiest_last_28 = f" (the busiest was {busiest[0]} with {busiest[1]} messages sent)"
             else:
-                messages_today = 0
                 busiest_last_28 = ""
 
             self.logger.debug("Request finished, sending now.")
-            self.heimdall.reply(f"There have been {count} posts in &{room_requested} ({messages_today} today) from {total_posters} posters, averaging {per_day_last_four_weeks} posts per day over the last 28 days{busiest_last_28}.\n\nThe top ten posters are:\n{top_ten}\n{all_time_url} {last_28_url} {legacy_last_28_url}")
+            reply = f"There have been {count} posts in &{room_requested} ({messages_today} today) from {total_posters} posters, averaging {per_day_last_four_weeks} posts per day over the last 28 days{busiest_last_28}.\n\nThe top ten posters are:\n{top_ten}\n{graph_urls}"
+            self.stats_cache.put(cache_key, cache_stamp, reply)
+            self.heimdall.reply(reply)
         except:
             self.logger.exception(f"Exception on roomstats with message {json.dumps(self.heimdall.packet.packet)}")
 
@@ -851,14 +1165,14 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
             aliases = [normnick]
 
         # Get all messages by user
-        self.c.execute(f'''SELECT count(*) FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))})''', (self.use_logs, *aliases,))
+        self.c.execute(f'''SELECT COALESCE(SUM(count), 0) FROM posters WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))})''', (self.use_logs, *aliases,))
         total_count = self.c.fetchall()[0][0]
 
-        # Get the number of parents per user they replied to
-        self.c.execute(f'''SELECT sendername, COUNT(*) AS count FROM messages WHERE room IS ? AND id IN (SELECT parent FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))})) GROUP BY sendername ORDER BY count DESC ''', (self.use_logs, self.use_logs, *aliases,))
-        parents_replied_to = [item for item in self.c.fetchall() if self.heimdall.normalise_nick(item[0]) not in aliases][:10]
+        # Get the number of replies they've made to each other user, from the reply graph
+        self.c.execute(f'''SELECT sendername, SUM(count) AS count FROM reply_edges WHERE room IS ? AND replier IN ({', '.join(['?']*len(aliases))}) AND normname NOT IN ({', '.join(['?']*len(aliases))}) GROUP BY sendername ORDER BY count DESC LIMIT 10''', (self.use_logs, *aliases, *aliases,))
+        parents_replied_to = self.c.fetchall()
 
-        self.c.execute(f'''SELECT count(*) FROM messages WHERE normname IS ? AND parent IN (SELECT id FROM messages WHERE room IS ? AND normname IN ({', '.join(['?']*len(aliases))}))''', (self.heimdall.normalise_nick(user), self.use_logs, *aliases,))
+        self.c.execute(f'''SELECT COALESCE(SUM(count), 0) FROM reply_edges WHERE room IS ? AND replier IS ? AND normname IN ({', '.join(['?']*len(aliases))})''', (self.use_logs, self.heimdall.normalise_nick(user), *aliases,))
         self_replies = self.c.fetchall()[0][0]
 
         table = ""
@@ -869,16 +1183,12 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
 
         return f"{table}"
 
-    def get_count_user_pairs(self, room_requested):
-        """Iterator which yields (posts, user) tuple"""
-        self.c.execute('''SELECT COUNT(*) AS amount, CASE master IS NULL WHEN TRUE THEN sendername ELSE master END AS name FROM messages LEFT JOIN aliases ON normname=normalias WHERE room=? GROUP BY name ORDER BY amount DESC''', (room_requested, ))
-        while True:
-            result = self.c.fetchone()
-            yield result
-
     def get_message(self):
         """Gets messages from heim"""
         self.conn.commit()
+        if self.queue is not None:
+            # Send on anything held back while Forseti's queue was full
+            self.queue.flush()
         message = self.heimdall.parse()
 
         if message == "Killed":
@@ -905,6 +1215,8 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
         ['messages']
         >>> h.parse_options(['-m', '--engagement'])
         ['messages', 'engagement']
+        >>> h.parse_options(['-mc'])
+        ['messages', 'combined']
         """
         options = []
         for arg in options_list:
@@ -916,6 +1228,8 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
                 options.append('engagement')
             elif arg in ['-t', '--text']:
                 options.append('text')
+            elif arg in ['-c', '--combined']:
+                options.append('combined')
             elif arg.startswith('-') and not arg.startswith('--'):
                 if 'a' in arg and 'aliases' not in options_list:
                     options.append('aliases')
@@ -925,6 +1239,8 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
                     options.append('engagement')
                 if 't' in arg and 'text' not in options_list:
                     options.append('text')
+                if 'c' in arg and 'combined' not in options_list:
+                    options.append('combined')
 
         return options
 
@@ -951,15 +1267,7 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
 
             if len(comm) > 0 and len(comm[0]) > 0 and comm[0][0] == "!":
                 self.logger.debug(f'Received message "{message.data.content}" from user "{message.data.sender.name}".')
-                for func in self.prod_funcs:
-                    try:
-                        func(self)
-                    except:
-                        self.logger.exception(f"Exception on message {json.dumps(self.heimdall.packet.packet)}")
-
-                if not self.prod_env:
-                    for func in self.test_funcs:
-                        func(self)
+                self.commands.submit(self.heimdall.normalise_nick(message.data.sender.name), message)
 
                 if comm[0] == '!diag-dump':
                     self.heimdall.reply(f"prod-funcs: {self.prod_funcs}")
@@ -974,9 +1282,7 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
                         new_master = comm[2][1:]
                         aliases = self.loki.get_aliases(old_master)
                         if self.heimdall.normalise_nick(new_master) in [self.heimdall.normalise_nick(alias) for alias in aliases]:
-                            self.c.execute('DELETE FROM aliases WHERE master=?', (old_master,))
-                            new_aliases = [(new_master, nick, self.heimdall.normalise_nick(nick),) for nick in aliases]
-                            self.write_to_database('''INSERT INTO aliases VALUES(?, ?, ?)''', values=new_aliases, mode='executemany')
+                            self.write_to_database(forseti.ALIAS_REMASTER, values=(new_master, old_master,))
                             self.heimdall.reply(f'Remastered @{old_master} aliases to @{new_master}')
                         else:
                             self.heimdall.reply("New master not found in user's aliases")
@@ -986,12 +1292,44 @@ Ranking:\t\t\t\t\t{position} of {no_of_posters}.
                 elif comm[0] == "!err":
                     self.heimdall.reply(1/0)
 
+    def run_command(self, packet):
+        """Runs the command functions for a packet on a worker thread.
+
+        The functions run against a copy of Heimdall with the worker's own
+        read-only connection, and reply to `packet` directly. The alias map,
+        the leaderboards and the stats cache are shared with the main loop."""
+        if not hasattr(self.worker, 'c'):
+            self.worker.conn = sqlite3.connect(f'file:{self.database}?mode=ro', uri=True)
+            self.worker.c = self.worker.conn.cursor()
+            self.worker.loki = copy.copy(self.loki)
+            self.worker.loki.c = self.worker.c
+        self.worker.loki.aliases = self.aliases
+
+        heimdall = copy.copy(self)
+        heimdall.heimdall = Reply(self.heimdall, packet)
+        heimdall.conn, heimdall.c = self.worker.conn, self.worker.c
+        heimdall.loki = self.worker.loki
+
+        for func in self.prod_funcs + ([] if self.prod_env else self.test_funcs):
+            try:
+                func(heimdall)
+            except:
+                self.logger.exception(f"Exception on message {json.dumps(packet.packet)}")
+
     def main(self):
         """Main loop"""
 
         self.heimdall.connect()
+        self.profile.mark('reconnect')
         self.connect_to_database()
+        self.profile.mark('reopen database')
         if self.dcal: sys.exit(0)
+        self.get_leaderboard(self.use_logs)
+        self.profile.mark('leaderboard')
+        if self.profile_startup:
+            self.show(self.profile.report(), override=True)
+            # main() is run again after a crash, which isn't startup
+            self.profile_startup = False
         while True:
             self.parse(self.get_message())
 
@@ -1007,8 +1345,15 @@ def main(room, **kwargs):
     verbose = kwargs['verbose'] if 'verbose' in kwargs else 'False'
     force_prod = kwargs['force_prod'] if 'force_prod' in kwargs else 'False'
     fill_in = kwargs['fill_in'] if 'fill_in' in kwargs else 'False'
+    write_policy = kwargs['write_policy'] if 'write_policy' in kwargs else 'block'
+    workers = kwargs['workers'] if 'workers' in kwargs else 4
+    commands_per_user = kwargs['commands_per_user'] if 'commands_per_user' in kwargs else 1
+    graphs = kwargs['graphs'] if 'graphs' in kwargs else None
+    upload_dir = kwargs['upload_dir'] if 'upload_dir' in kwargs else None
+    upload_url = kwargs['upload_url'] if 'upload_url' in kwargs else None
+    profile_startup = kwargs['profile_startup'] if 'profile_startup' in kwargs else False
 
-    heimdall = Heimdall(room, stealth=stealth, new_logs=new_logs, use_logs=use_logs, verbose=verbose, force_prod=force_prod, fill_in=fill_in)
+    heimdall = Heimdall(room, stealth=stealth, new_logs=new_logs, use_logs=use_logs, verbose=verbose, force_prod=force_prod, fill_in=fill_in, write_policy=write_policy, workers=workers, commands_per_user=commands_per_user, graphs=graphs, upload_dir=upload_dir, upload_url=upload_url, profile_startup=profile_startup)
 
     while True:
         try:
@@ -1042,6 +1387,9 @@ if __name__ == '__main__':
     parser.add_argument("--use-logs", type=str, dest="use_logs")
     parser.add_argument("--dcal", action="store_true", dest="disconnect_after_log")
     parser.add_argument("--fill-in", "-f", action="store_true", dest="fill_in")
+    parser.add_argument("--upload-dir", type=str, dest="upload_dir", help="Write graphs to this directory instead of uploading them")
+    parser.add_argument("--upload-url", type=str, dest="upload_url", help="URL the upload directory is served at")
+    parser.add_argument("--profile-startup", action="store_true", dest="profile_startup", help="Report how long each stage of startup takes")
     args = parser.parse_args()
 
     room = args.room
@@ -1052,4 +1400,7 @@ if __name__ == '__main__':
     force_prod = args.force_prod
     disconnect_after_log = args.disconnect_after_log
     fill_in = args.fill_in
-    main(room, stealth=stealth, new_logs=new_logs, use_logs=use_logs, verbose=verbose, force_prod=force_prod, disconnect_after_log=disconnect_after_log, fill_in=fill_in)
+    upload_dir = args.upload_dir
+    upload_url = args.upload_url
+    profile_startup = args.profile_startup
+    main(room, stealth=stealth, new_logs=new_logs, use_logs=use_logs, verbose=verbose, force_prod=force_prod, disconnect_after_log=disconnect_after_log, fill_in=fill_in, upload_dir=upload_dir, upload_url=upload_url, profile_startup=profile_startup)
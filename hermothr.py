@@ -13,6 +13,8 @@ import time
 
 import karelia
 
+import forseti
+
 
 class Hermothr:
     """The Hermothr object is a self-contained instance of the hermothr bot, connected to a single room"""
@@ -22,7 +24,7 @@ class Hermothr:
             self.queue = None
         else:
             self.room = room[0]
-            self.queue = room[1]
+            self.queue = forseti.WriteQueue(room[1], f"hermothr_{self.room}")
 
         self.test = True if ('test' in kwargs and kwargs['test']) or room == "test_data" else False
         self.conn = sqlite3.connect('data/hermothr/test_data.db') if self.test else sqlite3.connect('yggdrasil.db')
@@ -91,20 +93,26 @@ Use !grouplist to see all the groups and their members, or !grouplist *group to
             self.hermothr.stockResponses['longHelp'] += "\nThis is a testing instance and may not be reliable."
 
     def write_to_database(self, statement, **kwargs):
+        """`statement` is either one of the typed operations in forseti or an SQL string"""
         values = kwargs['values'] if 'values' in kwargs else ()
         mode = kwargs['mode'] if 'mode' in kwargs else "execute"
 
+        if mode == "execute":
+            values = tuple(values)
+        elif mode == "executemany":
+            values = list(values)
+        else:
+            return
+
         if self.queue is not None:
-            send = (statement, values, mode,)
-            self.queue.put(send)
+            self.queue.put(forseti.YGGDRASIL, statement, values)
 
         else:
+            query, mode = forseti.resolve(statement, values)
             if mode == "execute":
-                self.c.execute(statement, values)
-            elif mode == "executemany":
-                self.c.execute_many(statement, values)
+                self.c.execute(query, values)
             else:
-                pass
+                self.c.executemany(query, values)
             self.conn.commit()
 
     def list_groups(self):
@@ -248,7 +256,7 @@ Use !grouplist to see all the groups and their members, or !grouplist *group to
                         not_grouped.append(nick)
 
             members = ','.join(members)
-            self.write_to_database('''INSERT OR REPLACE INTO groups VALUES (?, ?)''', values=(group_name, members))
+            self.write_to_database(forseti.GROUP_UPSERT, values=(group_name, members))
 
             if "!notify" in self.not_commands:
                 if grouped == [] and not_grouped == []:
@@ -288,9 +296,9 @@ Use !grouplist to see all the groups and their members, or !grouplist *group to
                         not_ungrouped.append(nick)
 
             if members == []:
-                self.write_to_database('''DELETE FROM groups WHERE groupname IS ?''', values=(group_name,))
+                self.write_to_database(forseti.GROUP_DELETE, values=(group_name,))
             else:
-                self.write_to_database('''UPDATE groups SET members=? WHERE groupname IS ?''', values=(','.join(members), group_name,))
+                self.write_to_database(forseti.GROUP_UPSERT, values=(group_name, ','.join(members),))
             
             if "!notify" in self.not_commands:
                 if ungrouped == [] and not_ungrouped == []:
@@ -328,7 +336,7 @@ Use !grouplist to see all the groups and their members, or !grouplist *group to
                 content = packet['data']['content']
                 message_id = packet['data']['id']
                 globalid = self.thought_delivered[content]
-                self.write_to_database('''UPDATE notifications SET delivered=1, id=? WHERE globalid IS ?''', values=(message_id, globalid))
+                self.write_to_database(forseti.NOTIFICATION_DELIVERED, values=(message_id, globalid))
                 self.c.execute('''SELECT COUNT(*) FROM notifications WHERE room IS ? AND delivered IS 1''', (self.room,))
                 self.gen_help_messages(self.c.fetchone()[0])
                 del self.thought_delivered[packet['data']['content']]
@@ -374,7 +382,7 @@ Use !grouplist to see all the groups and their members, or !grouplist *group to
                                                             all_recipients),
                                         0,
                                         '')
-                        self.write_to_database('''INSERT INTO notifications VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', values=write_packet)
+                        self.write_to_database(forseti.NOTIFICATION_INSERT, values=write_packet)
 
                     return "/me will notify {}.".format(names_as_string)
 
@@ -404,7 +412,7 @@ Use !grouplist to see all the groups and their members, or !grouplist *group to
                                                         all_recipients),
                                     0,
                                     '')
-                    self.write_to_database('''INSERT INTO notifications VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', values=write_packet)
+                    self.write_to_database(forseti.NOTIFICATION_INSERT, values=write_packet)
                     return "Will do."
 
             elif split_content[0] in ["!group", "!tgroup"] and len(split_content) > 1:
@@ -1,5 +1,113 @@
 from karelia import Packet
 import sqlite3
+import threading
+
+import forseti
+
+
+class Aliases:
+    """An in-process copy of the aliases table, mapping each normalised alias to its master nick and each master nick to its aliases.
+
+    It's read from the database on first use, and `apply` keeps it up to
+    date with each alias write as it's made. Forseti bumps the 'aliases'
+    counter in the counters table with every alias write, so changes made
+    by other processes are picked up by reading the table again whenever
+    the counter has moved past the writes applied here, which costs one
+    lookup per use. Heimdall's command workers share one copy with its main
+    loop, so that they all count the same writes, and everything that reads
+    or changes it holds `lock`. `cursor` must be usable from any of those
+    threads."""
+
+    def __init__(self, cursor):
+        self.c = cursor
+        self.lock = threading.RLock()
+        self.loaded = False
+        self.version = None
+        self.rows = {}
+        self.by_normalias = {}
+        self.by_master = {}
+
+    def counter(self):
+        try:
+            self.c.execute('''SELECT value FROM counters WHERE name = 'aliases' ''')
+        except sqlite3.OperationalError:
+            return None
+        row = self.c.fetchone()
+        return row[0] if row is not None else 0
+
+    def refresh(self):
+        """Reads the aliases table again if it has been changed since it was last read"""
+        with self.lock:
+            version = self.counter()
+            # Until Forseti commits them, this process's own writes are counted in self.version but not yet in the counter
+            if self.loaded and (version == self.version or (version is not None and self.version is not None and version < self.version)):
+                return
+
+            self.rows = {}
+            self.by_normalias = {}
+            self.by_master = {}
+            self.c.execute('''SELECT master, alias, normalias FROM aliases''')
+            for master, alias, normalias in self.c.fetchall():
+                self.add(master, alias, normalias)
+            self.loaded = True
+            self.version = version
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = False
+
+    def add(self, master, alias, normalias):
+        # Aliases are unique, so a new row for an alias replaces the old one
+        self.remove(alias)
+        self.rows[alias] = (master, normalias)
+        self.by_normalias.setdefault(normalias, set()).add(alias)
+        self.by_master.setdefault(master, set()).add(alias)
+
+    def remove(self, alias):
+        if alias in self.rows:
+            master, normalias = self.rows.pop(alias)
+            self.by_normalias[normalias].discard(alias)
+            self.by_master[master].discard(alias)
+
+    def master_of(self, normalias):
+        """Returns the master nick for a normalised alias, or None if it has none"""
+        with self.lock:
+            self.refresh()
+            if normalias not in self.by_normalias or not self.by_normalias[normalias]:
+                return None
+            return min(self.rows[alias][0] for alias in self.by_normalias[normalias])
+
+    def aliases_of(self, master):
+        with self.lock:
+            self.refresh()
+            return sorted(self.by_master[master]) if master in self.by_master else []
+
+    def apply(self, operation, values):
+        """Updates the map for a write that has been made to the database"""
+        with self.lock:
+            self.apply_rows(operation, values if isinstance(values, list) else [values])
+
+    def apply_rows(self, operation, rows):
+        if operation == forseti.ALIAS_UPSERT:
+            for master, alias, normalias in rows:
+                self.add(master, alias, normalias)
+        elif operation == forseti.ALIAS_INSERT:
+            # Leaves an alias that's already stored as it is
+            for master, alias, normalias in rows:
+                if alias not in self.rows:
+                    self.add(master, alias, normalias)
+        elif operation == forseti.ALIAS_DELETE:
+            for normalias, in rows:
+                for alias in list(self.by_normalias[normalias] if normalias in self.by_normalias else []):
+                    self.remove(alias)
+        elif operation == forseti.ALIAS_REMASTER:
+            for new_master, old_master in rows:
+                for alias in list(self.by_master[old_master] if old_master in self.by_master else []):
+                    self.add(new_master, alias, self.rows[alias][1])
+
+        # Forseti bumps the counter once for each alias write, so this one doesn't call for reading the table again
+        if operation in forseti.ALIAS_WRITES and self.version is not None:
+            self.version += 1
 
 
 class Loki:
@@ -7,6 +115,7 @@ class Loki:
         self.normalise = normalise
         self.conn = sqlite3.connect(db)
         self.c = self.conn.cursor()
+        self.aliases = Aliases(self.c)
 
         self.should_return = should_return
 
@@ -33,12 +142,10 @@ class Loki:
             master = up_to_date_aliases[0]
 
             for alias in up_to_date_aliases:
-                self.c.execute('''SELECT master FROM aliases WHERE normalias=?''', (self.normalise(alias),))
-                try:
-                    master = self.c.fetchone()[0]
+                known_master = self.aliases.master_of(self.normalise(alias))
+                if known_master is not None:
+                    master = known_master
                     break
-                except TypeError:
-                    continue
 
             stored_aliases = set(self.get_aliases(sender))
             correct_aliases = set(up_to_date_aliases)
@@ -49,28 +156,18 @@ class Loki:
 
             queries = []
             for alias in add_aliases:
-                queries.append(('''INSERT INTO ALIASES VALUES(?, ?, ?)''', (master, alias, self.normalise(alias),),))
+                queries.append((forseti.ALIAS_INSERT, (master, alias, self.normalise(alias),),))
 
             for alias in remove_aliases:
-                queries.append(('''DELETE FROM aliases WHERE normalias=?''', (self.normalise(alias),),))
+                queries.append((forseti.ALIAS_DELETE, (self.normalise(alias),),))
 
             return queries
 
     def get_aliases(self, user):
         normnick = self.normalise(user)
-        self.c.execute('''SELECT master FROM aliases WHERE normalias = ?''', (normnick,))
-
-        try:
-            master = self.c.fetchall()[0][0]
-        except:
+        master = self.aliases.master_of(normnick)
+        if master is None:
             master = normnick
 
-        self.c.execute('''SELECT alias FROM aliases WHERE master = ?''', (master, ))
-        reply = self.c.fetchall()
-        if not reply:
-            reply = []
-        else:
-            reply = [alias[0] for alias in reply]
-        
-        return reply
+        return self.aliases.aliases_of(master)
 
@@ -0,0 +1,482 @@
+"""
+Mimir keeps the schema of Heimdall's database.
+
+Every change made to the database after its original tables is a
+migration, numbered in order. The number of the last migration a database
+has had is kept in its `PRAGMA user_version`, so each migration runs once
+per database however many times Heimdall starts. Migrations are made of
+steps, and a step that has to touch every row of a large table runs over
+it a chunk at a time, recording how far it has got in `migration_progress`
+after each chunk. An interrupted migration picks up where it stopped.
+
+Yggdrasil migrates the database once before any room starts. Every step
+can still be run twice without harm, and the version is read again before
+each step, so a room that reads the version just before another process
+finishes a migration doesn't trip over it.
+
+All writes go through Forseti, so a migration can run while the bot is up.
+To see how long pending migrations will take before running them:
+
+    python mimir.py --dry-run
+
+Tables derived from messages, such as the daily rollups, the posters table
+and the reply graph, can be rebuilt from scratch with `python mimir.py --rebuild <name>`.
+"""
+
+import argparse
+import os
+import queue
+import re
+import sqlite3
+import time
+
+import forseti
+
+
+class Statement:
+    """A step run as a single statement.
+
+    `table` is the table the step's runtime grows with, if any, which the
+    dry run uses to scale up its estimate. `compact` is the step to run
+    instead when the database has the compact layout."""
+
+    def __init__(self, sql, table=None, compact=None):
+        self.sql = sql
+        self.table = table
+        self.compact = compact
+
+
+class AddColumn(Statement):
+    """A step adding `column` to `table`.
+
+    SQLite has no ADD COLUMN IF NOT EXISTS, so the step is skipped if the
+    table already has the column, which makes running it again harmless."""
+
+    def __init__(self, table, column, definition):
+        super().__init__(f'''ALTER TABLE {table} ADD COLUMN {column} {definition}''')
+        self.altered = table
+        self.column = column
+
+
+class Chunked:
+    """A step run over `table` `chunk_size` rows at a time.
+
+    `sql` takes two parameters and should only touch rows with a rowid
+    greater than the first and no greater than the second. A chunk may be
+    run again if the migration is interrupted between the chunk and its
+    progress being recorded, so running it twice must leave the same result
+    as running it once. `compact` is the step to run instead when the
+    database has the compact layout, in which `messages` is a view with no
+    rowids to walk."""
+
+    def __init__(self, table, sql, chunk_size=10000, compact=None):
+        self.table = table
+        self.sql = sql
+        self.chunk_size = chunk_size
+        self.compact = compact
+
+
+class Migration:
+    def __init__(self, version, description, steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+
+# Tables derived from messages, which Forseti keeps up to date as messages
+# are inserted. Each can be rebuilt from scratch with
+# `python mimir.py --rebuild <name>`, and doing so is safe while the bot is
+# running: every chunk recounts the rows it touches from messages in full,
+# rather than adding to what is there.
+MESSAGE_DAYS_RECOUNT = Chunked('messages', f'''INSERT OR REPLACE INTO message_days
+                                                SELECT k.room, k.normname, k.day, COUNT(*), SUM({forseti.word_count('m.content')}), SUM(COALESCE(length(m.content), 0)), SUM(m.parent IS '')
+                                                FROM (SELECT DISTINCT room, normname, CAST(time / 86400 AS INT) AS day FROM messages WHERE rowid > ? AND rowid <= ?) k
+                                                JOIN messages m ON m.room IS k.room AND m.normname IS k.normname AND m.time >= k.day * 86400 AND m.time < (k.day + 1) * 86400
+                                                GROUP BY k.room, k.normname, k.day''',
+                               compact=Chunked('message_rows', f'''INSERT OR REPLACE INTO message_days
+                                                                   SELECT k.room, k.normname, k.day, COUNT(*), SUM({forseti.word_count('m.content')}), SUM(COALESCE(length(m.content), 0)), SUM(m.parent IS '')
+                                                                   FROM (SELECT DISTINCT r.name AS room, s.normname AS normname, CAST(m.time / 86400 AS INT) AS day
+                                                                         FROM message_rows m JOIN rooms r ON r.id = m.room JOIN senders s ON s.id = m.sender
+                                                                         WHERE m.rowid > ? AND m.rowid <= ?) k
+                                                                   JOIN messages m ON m.room IS k.room AND m.normname IS k.normname AND m.time >= k.day * 86400 AND m.time < (k.day + 1) * 86400
+                                                                   GROUP BY k.room, k.normname, k.day'''))
+
+MESSAGE_DAYS = Migration('message_days', "Rollup of the messages, words, characters and top level messages each sender sends in each room per UTC day", [
+    Statement('''CREATE TABLE IF NOT EXISTS message_days(room text, normname text, day integer, count integer, words integer DEFAULT 0, characters integer DEFAULT 0, top_level integer DEFAULT 0, PRIMARY KEY(room, normname, day)) WITHOUT ROWID'''),
+    Statement('''CREATE INDEX IF NOT EXISTS message_days_room_day ON message_days(room, day, count)'''),
+    Statement('''DELETE FROM message_days''', 'message_days'),
+    MESSAGE_DAYS_RECOUNT,
+])
+
+POSTERS = Migration('posters', "Messages each sender has sent in each room, with the name they're ranked under: their master nick if they have one, and the name they posted as otherwise", [
+    Statement('''CREATE TABLE IF NOT EXISTS posters(room text, normname text, sendername text, name text, count integer, PRIMARY KEY(room, normname, sendername)) WITHOUT ROWID'''),
+    Statement('''CREATE INDEX IF NOT EXISTS posters_room_name ON posters(room, name, count)'''),
+    Statement('''CREATE INDEX IF NOT EXISTS posters_normname ON posters(normname)'''),
+    Statement('''DELETE FROM posters''', 'posters'),
+    Chunked('messages', '''INSERT OR REPLACE INTO posters
+                            SELECT k.room, k.normname, k.sendername, COALESCE((SELECT master FROM aliases WHERE normalias = k.normname), k.sendername),
+                                   (SELECT COUNT(*) FROM messages m WHERE m.room IS k.room AND m.sendername IS k.sendername AND m.normname IS k.normname)
+                            FROM (SELECT DISTINCT room, normname, sendername FROM messages WHERE rowid > ? AND rowid <= ?) k''',
+            compact=Chunked('message_rows', '''INSERT OR REPLACE INTO posters
+                                                SELECT k.room, k.normname, k.sendername, COALESCE((SELECT master FROM aliases WHERE normalias = k.normname), k.sendername),
+                                                       (SELECT COUNT(*) FROM message_rows m WHERE m.room = k.room_id AND m.sender IN (SELECT id FROM senders WHERE sendername IS k.sendername AND normname IS k.normname))
+                                                FROM (SELECT DISTINCT r.id AS room_id, r.name AS room, s.normname AS normname, s.sendername AS sendername
+                                                      FROM message_rows m JOIN rooms r ON r.id = m.room JOIN senders s ON s.id = m.sender
+                                                      WHERE m.rowid > ? AND m.rowid <= ?) k''')),
+])
+
+# Replies are counted per UTC day of the reply, like message_days, so that
+# rebuilding only ever recounts one sender's replies on one day
+REPLY_EDGES = Migration('reply_edges', "Graph of how many times each sender replies to each other sender in each room per UTC day", [
+    Statement('''CREATE INDEX IF NOT EXISTS messages_room_parent ON messages(room, parent)''', 'messages',
+              compact=Statement('''CREATE INDEX IF NOT EXISTS message_rows_room_parent ON message_rows(room, parent)''', 'message_rows')),
+    Statement('''CREATE TABLE IF NOT EXISTS reply_edges(room text, replier text, normname text, sendername text, day integer, count integer, PRIMARY KEY(room, replier, normname, sendername, day)) WITHOUT ROWID'''),
+    Statement('''DELETE FROM reply_edges''', 'reply_edges'),
+    Chunked('messages', '''INSERT OR REPLACE INTO reply_edges
+                            SELECT k.room, k.replier, k.normname, k.sendername, k.day,
+                                   (SELECT COUNT(*) FROM messages c JOIN messages p ON p.room IS c.room AND p.id = c.parent
+                                    WHERE c.room IS k.room AND c.normname IS k.replier AND c.time >= k.day * 86400 AND c.time < (k.day + 1) * 86400
+                                    AND p.normname IS k.normname AND p.sendername IS k.sendername AND c.id IS NOT c.parent)
+                            FROM (SELECT DISTINCT c.room AS room, c.normname AS replier, p.normname AS normname, p.sendername AS sendername, CAST(c.time / 86400 AS INT) AS day
+                                  FROM messages c JOIN messages p ON p.room IS c.room AND p.id = c.parent
+                                  WHERE c.rowid > ? AND c.rowid <= ? AND c.id IS NOT c.parent) k''',
+            compact=Chunked('message_rows', '''INSERT OR REPLACE INTO reply_edges
+                                                SELECT r.name, k.replier, k.normname, k.sendername, k.day,
+                                                       (SELECT COUNT(*) FROM message_rows c JOIN message_rows p ON p.room = c.room AND p.id = c.parent JOIN senders ps ON ps.id = p.sender
+                                                        WHERE c.room = k.room AND c.sender IN (SELECT id FROM senders WHERE normname IS k.replier) AND c.time >= k.day * 86400 AND c.time < (k.day + 1) * 86400
+                                                        AND ps.normname IS k.normname AND ps.sendername IS k.sendername AND c.id IS NOT c.parent)
+                                                FROM (SELECT DISTINCT c.room AS room, cs.normname AS replier, ps.normname AS normname, ps.sendername AS sendername, CAST(c.time / 86400 AS INT) AS day
+                                                      FROM message_rows c JOIN senders cs ON cs.id = c.sender JOIN message_rows p ON p.room = c.room AND p.id = c.parent JOIN senders ps ON ps.id = p.sender
+                                                      WHERE c.rowid > ? AND c.rowid <= ? AND c.id IS NOT c.parent) k
+                                                JOIN rooms r ON r.id = k.room''')),
+])
+
+REBUILDS = {migration.version: migration for migration in [MESSAGE_DAYS, POSTERS, REPLY_EDGES]}
+
+MIGRATIONS = [
+    Migration(1, "Indexes for the stats queries, which all select by room and then by sender, time, or message id", [
+        Statement('''CREATE INDEX IF NOT EXISTS messages_room_time ON messages(room, time)''', 'messages'),
+        Statement('''CREATE INDEX IF NOT EXISTS messages_room_normname_time ON messages(room, normname, time)''', 'messages'),
+        Statement('''CREATE INDEX IF NOT EXISTS messages_room_sendername ON messages(room, sendername, normname)''', 'messages'),
+        Statement('''CREATE INDEX IF NOT EXISTS messages_room_id ON messages(room, id, sendername)''', 'messages'),
+        Statement('''CREATE INDEX IF NOT EXISTS aliases_normalias ON aliases(normalias, master)''', 'aliases'),
+        Statement('''CREATE INDEX IF NOT EXISTS aliases_master ON aliases(master, alias)''', 'aliases'),
+    ]),
+    # The rollup started out with counts alone. Migration 6 adds the other columns and fills the whole table in
+    Migration(2, "Rollup of the messages each sender sends in each room per UTC day", [
+        Statement('''CREATE TABLE IF NOT EXISTS message_days(room text, normname text, day integer, count integer, PRIMARY KEY(room, normname, day)) WITHOUT ROWID'''),
+        Statement('''CREATE INDEX IF NOT EXISTS message_days_room_day ON message_days(room, day, count)'''),
+    ]),
+    Migration(3, "Counters that Forseti bumps whenever a table that other processes keep a copy of changes", [
+        Statement('''CREATE TABLE IF NOT EXISTS counters(name text PRIMARY KEY, value integer)'''),
+        Statement('''INSERT OR IGNORE INTO counters VALUES('aliases', 0)'''),
+    ]),
+    Migration(4, POSTERS.description, POSTERS.steps),
+    Migration(5, REPLY_EDGES.description, REPLY_EDGES.steps),
+    Migration(6, "Words, characters and top level messages in the daily rollup, so that text stats are exact", [
+        AddColumn('message_days', 'words', 'integer DEFAULT 0'),
+        AddColumn('message_days', 'characters', 'integer DEFAULT 0'),
+        AddColumn('message_days', 'top_level', 'integer DEFAULT 0'),
+        MESSAGE_DAYS_RECOUNT,
+    ]),
+]
+
+
+# The optional compact layout. Rooms and senders move to tables of their own
+# and each message refers to them by number, which roughly halves the size of
+# a message. `messages` becomes a view over them in the original layout, so
+# every query reads and writes it as before, but lookups by message id
+# through the view can't use an index. Run it with the bot stopped, using
+# `python mimir.py --compact`.
+COMPACT = Migration('compact', "Compact layout, with rooms and senders stored once and message ids as numbers", [
+    Statement('''CREATE TABLE IF NOT EXISTS rooms(id integer PRIMARY KEY, name text UNIQUE)'''),
+    Statement('''CREATE TABLE IF NOT EXISTS senders(id integer PRIMARY KEY, senderid text, sendername text, normname text)'''),
+    Statement('''CREATE UNIQUE INDEX IF NOT EXISTS senders_identity ON senders(senderid, sendername, normname)'''),
+    Statement('''CREATE INDEX IF NOT EXISTS senders_normname ON senders(normname)'''),
+    Statement('''CREATE TABLE IF NOT EXISTS message_rows(content text, id, parent, sender integer, time real, room integer)'''),
+    Statement('''CREATE UNIQUE INDEX IF NOT EXISTS message_rows_room_id ON message_rows(room, id)'''),
+    Chunked('messages', '''INSERT OR IGNORE INTO rooms(name) SELECT DISTINCT room FROM messages WHERE rowid > ? AND rowid <= ?'''),
+    Chunked('messages', '''INSERT OR IGNORE INTO senders(senderid, sendername, normname) SELECT DISTINCT senderid, sendername, normname FROM messages WHERE rowid > ? AND rowid <= ?'''),
+    Chunked('messages', f'''INSERT OR IGNORE INTO message_rows(rowid, content, id, parent, sender, time, room)
+                                SELECT m.rowid, m.content, {forseti.encode_id('m.id')}, {forseti.encode_id('m.parent')}, s.id, m.time, r.id
+                                FROM messages m
+                                JOIN senders s ON s.senderid IS m.senderid AND s.sendername IS m.sendername AND s.normname IS m.normname
+                                JOIN rooms r ON r.name IS m.room
+                                WHERE m.rowid > ? AND m.rowid <= ?'''),
+    Statement('''CREATE INDEX IF NOT EXISTS message_rows_room_sender_time ON message_rows(room, sender, time)''', 'message_rows'),
+    Statement('''CREATE INDEX IF NOT EXISTS message_rows_room_time ON message_rows(room, time)''', 'message_rows'),
+    Statement('''CREATE INDEX IF NOT EXISTS message_rows_room_parent ON message_rows(room, parent)''', 'message_rows'),
+    Statement('''DROP TABLE messages''', 'messages'),
+    Statement(f'''CREATE VIEW messages AS
+                    SELECT m.content, {forseti.decode_id('m.id')} AS id, {forseti.decode_id('m.parent')} AS parent, s.senderid, s.sendername, s.normname, m.time, r.name AS room, r.name || {forseti.decode_id('m.id')} AS globalid
+                    FROM message_rows m
+                    JOIN senders s ON s.id = m.sender
+                    JOIN rooms r ON r.id = m.room'''),
+    # The conflict clause of an insert into the view, such as INSERT OR IGNORE, carries over to the insert into message_rows
+    Statement(f'''CREATE TRIGGER messages_insert INSTEAD OF INSERT ON messages BEGIN
+                    INSERT OR IGNORE INTO rooms(name) VALUES(NEW.room);
+                    INSERT OR IGNORE INTO senders(senderid, sendername, normname) VALUES(NEW.senderid, NEW.sendername, NEW.normname);
+                    INSERT INTO message_rows VALUES(NEW.content, {forseti.encode_id('NEW.id')}, {forseti.encode_id('NEW.parent')},
+                        (SELECT id FROM senders WHERE senderid IS NEW.senderid AND sendername IS NEW.sendername AND normname IS NEW.normname),
+                        NEW.time,
+                        (SELECT id FROM rooms WHERE name IS NEW.room));
+                END'''),
+    Statement(f'''CREATE TRIGGER messages_delete INSTEAD OF DELETE ON messages BEGIN
+                    DELETE FROM message_rows WHERE room = (SELECT id FROM rooms WHERE name IS OLD.room) AND id IS {forseti.encode_id('OLD.id')};
+                END'''),
+])
+
+
+class Mimir:
+    """Runs migrations against a database.
+
+    `cursor` is used to read the database, and `write` is called with an
+    SQL statement and its values for every change. It must not return until
+    the write has been committed, and should raise any error the write
+    caused. Pass `migrations` to run a list other than MIGRATIONS."""
+
+    def __init__(self, cursor, write, **kwargs):
+        self.c = cursor
+        self.write = write
+        self.migrations = kwargs['migrations'] if 'migrations' in kwargs else MIGRATIONS
+
+    def version(self):
+        self.c.execute('''PRAGMA user_version''')
+        return self.c.fetchone()[0]
+
+    def has_column(self, table, column):
+        self.c.execute('''SELECT COUNT(*) FROM pragma_table_info(?) WHERE name = ?''', (table, column, ))
+        return self.c.fetchone()[0] > 0
+
+    def done(self, migration):
+        """Returns whether a numbered migration has been run, which another process may have done since the pending migrations were read"""
+        return isinstance(migration.version, int) and self.version() >= migration.version
+
+    def create_tables(self):
+        """Creates the tables Heimdall started out with, which the migrations build on, if they don't exist yet"""
+        # A compact database keeps messages behind a view of the same name, see COMPACT
+        if not forseti.is_compact(self.c):
+            self.write('''  CREATE TABLE IF NOT EXISTS messages(
+                                content text,
+                                id text,
+                                parent text,
+                                senderid text,
+                                sendername text,
+                                normname text,
+                                time real,
+                                room text,
+                                globalid text
+                            )''', ())
+            self.write('''CREATE UNIQUE INDEX IF NOT EXISTS globalid ON messages(globalid)''', ())
+        self.write('''CREATE TABLE IF NOT EXISTS aliases(master text, alias text, normalias text)''', ())
+        self.write('''CREATE UNIQUE INDEX IF NOT EXISTS master ON aliases(alias)''', ())
+
+    def pending(self, target=None):
+        """Returns the migrations still to run, up to and including version `target` if given"""
+        version = self.version()
+        return [migration for migration in self.migrations if migration.version > version and (target is None or migration.version <= target)]
+
+    def progress(self, version):
+        """Returns the (step, position) an interrupted migration stopped at, or (0, 0) if it hasn't been started"""
+        try:
+            self.c.execute('''SELECT step, position FROM migration_progress WHERE migration = ?''', (version, ))
+        except sqlite3.OperationalError:
+            return 0, 0
+        row = self.c.fetchone()
+        return (row[0], row[1]) if row is not None else (0, 0)
+
+    def migrate(self, target=None, on_step=None, compact=False):
+        """Runs every pending migration in order, followed by COMPACT if `compact` is set and the database isn't compact yet.
+
+        `on_step`, if given, is called with the migration, the index of the
+        step, the step and the seconds it took, after each step is done."""
+        migrations = self.pending(target)
+        if compact and not forseti.is_compact(self.c):
+            migrations.append(COMPACT)
+        self.run_all(migrations, on_step)
+
+    def rebuild(self, name, on_step=None):
+        """Rebuilds one of the tables in REBUILDS from scratch"""
+        self.run_all([REBUILDS[name]], on_step)
+
+    def run_all(self, migrations, on_step=None):
+        if not migrations:
+            return
+
+        # The table is kept afterwards, as dropping it could pull it out from under another process still migrating
+        self.write('''CREATE TABLE IF NOT EXISTS migration_progress(migration PRIMARY KEY, step integer, position integer)''', ())
+        for migration in migrations:
+            self.run(migration, on_step)
+
+    def run(self, migration, on_step=None):
+        """Runs a single migration from wherever it last got to"""
+        first_step, position = self.progress(migration.version)
+        for index, step in enumerate(migration.steps):
+            if index < first_step:
+                continue
+            if self.done(migration):
+                return
+
+            started = time.monotonic()
+            if step.compact is not None and forseti.is_compact(self.c):
+                step = step.compact
+            if isinstance(step, Chunked):
+                self.run_chunks(migration, index, step, position if index == first_step else 0)
+            elif not (isinstance(step, AddColumn) and self.has_column(step.altered, step.column)):
+                self.write(step.sql, ())
+            self.write('''INSERT OR REPLACE INTO migration_progress VALUES(?, ?, ?)''', (migration.version, index + 1, 0))
+
+            if on_step is not None:
+                on_step(migration, index, step, time.monotonic() - started)
+
+        # Optional layouts are named rather than numbered, and are told apart by the schema itself
+        if isinstance(migration.version, int) and not self.done(migration):
+            self.write(f'''PRAGMA user_version = {migration.version}''', ())
+        self.write('''DELETE FROM migration_progress WHERE migration = ?''', (migration.version, ))
+
+    def run_chunks(self, migration, index, step, position):
+        """Runs a chunked step from `position` up to the end of its table, as it stands when each chunk starts"""
+        while True:
+            self.c.execute(f'''SELECT MAX(rowid) FROM {step.table}''')
+            last = self.c.fetchone()[0]
+            if last is None or position >= last:
+                return
+
+            upto = position + step.chunk_size
+            self.write(step.sql, (position, upto))
+            self.write('''INSERT OR REPLACE INTO migration_progress VALUES(?, ?, ?)''', (migration.version, index, upto))
+            position = upto
+
+    def estimate(self, target=None, sample=10000, compact=False, rebuild=None):
+        """Dry run: returns a (migration, index, step, seconds) tuple for every step still to run.
+
+        The pending migrations are run against an in-memory copy of the
+        database holding the schema and the first `sample` rows of each
+        table, and each step's time is scaled up by the number of rows its
+        table has left to go through. Nothing is written to the database.
+        With `rebuild`, estimates that rebuild instead of the migrations."""
+        self.c.execute('''PRAGMA database_list''')
+        file = [row[2] for row in self.c.fetchall() if row[1] == 'main'][0]
+
+        memory = sqlite3.connect(':memory:', isolation_level=None, uri=True)
+        m = memory.cursor()
+        m.execute('''ATTACH DATABASE ? AS source''', (f'file:{file}?mode=ro', ))
+        m.execute('''SELECT type, name, sql FROM source.sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ''')
+        schema = m.fetchall()
+
+        # Indexes and triggers come after the rows, so that copying the sample is quick and fires nothing.
+        # Rollups such as message_days are WITHOUT ROWID tables, which are copied and counted without one
+        sampled = {}
+        without_rowid = set()
+        for kind, name, sql in schema:
+            if kind == 'table':
+                m.execute(sql)
+                columns = ', '.join(f'"{row[1]}"' for row in m.execute(f'''PRAGMA source.table_info("{name}")''').fetchall())
+                if re.search(r'\bWITHOUT\s+ROWID\s*$', sql, re.IGNORECASE):
+                    without_rowid.add(name)
+                    m.execute(f'''INSERT INTO main."{name}"({columns}) SELECT {columns} FROM source."{name}" LIMIT ?''', (sample, ))
+                else:
+                    m.execute(f'''INSERT INTO main."{name}"(rowid, {columns}) SELECT rowid, {columns} FROM source."{name}" ORDER BY rowid LIMIT ?''', (sample, ))
+                sampled[name] = m.rowcount
+        for kind, name, sql in schema:
+            if kind != 'table':
+                m.execute(sql)
+
+        m.execute(f'''PRAGMA user_version = {int(self.version())}''')
+        if 'migration_progress' in sampled:
+            m.execute('''UPDATE migration_progress SET position = 0''')
+
+        estimates = []
+
+        def on_step(migration, index, step, seconds):
+            if step.table in sampled and sampled[step.table]:
+                self.c.execute(f'''SELECT {'COUNT(*)' if step.table in without_rowid else 'MAX(rowid)'} FROM {step.table}''')
+                rows = self.c.fetchone()[0] or 0
+                first_step, position = self.progress(migration.version)
+                if isinstance(step, Chunked) and index == first_step:
+                    rows -= position
+                seconds *= max(rows, 0) / sampled[step.table]
+            estimates.append((migration, index, step, seconds))
+
+        runner = Mimir(memory.cursor(), lambda statement, values: m.execute(statement, values).rowcount, migrations=self.migrations)
+        if rebuild is not None:
+            runner.rebuild(rebuild, on_step)
+        else:
+            runner.migrate(target, on_step, compact)
+        m.execute('''DETACH DATABASE source''')
+        memory.close()
+        return estimates
+
+
+def forseti_writer(database):
+    """Returns a write function for Mimir that runs each write through a Forseti of its own, for use while the bot isn't running"""
+    replies = queue.Queue()
+    writer = forseti.Forseti(queue.Queue(), targets={forseti.HEIMDALL: database}, replies={'mimir': replies}, maintenance=False)
+
+    def write(statement, values):
+        writer.write_batch([(forseti.HEIMDALL, statement, values, 'mimir', 0)])
+        ticket, rows, error = replies.get_nowait()
+        if error is not None:
+            raise error
+        return rows
+
+    return write
+
+
+def main():
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+    parser = argparse.ArgumentParser(description="Runs any pending migrations against Heimdall's database")
+    parser.add_argument("--database", default=os.path.join(BASE_DIR, forseti.DATABASES[forseti.HEIMDALL]))
+    parser.add_argument("--to", type=int, default=None, dest="target", help="Stop after migrating to this version")
+    parser.add_argument("--dry-run", action="store_true", dest="dry_run", help="Report what would run and roughly how long it would take, without changing anything")
+    parser.add_argument("--compact", action="store_true", help="Also move the database to the compact layout, then vacuum it. Stop the bot first")
+    parser.add_argument("--incremental-vacuum", action="store_true", dest="incremental_vacuum", help="Also turn on incremental auto-vacuum, which Forseti uses to give free pages back while idle, then vacuum. Stop the bot first")
+    parser.add_argument("--rebuild", choices=list(REBUILDS), help="Rebuild one of the tables derived from messages from scratch, instead of migrating")
+    parser.add_argument("--sample", type=int, default=10000, help="Rows of each table the dry run times the migrations against")
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.database)
+    mimir = Mimir(conn.cursor(), forseti_writer(args.database))
+
+    if args.rebuild is not None:
+        print(f"Rebuilding {args.rebuild} in {args.database}")
+    else:
+        migrations = mimir.pending(args.target)
+        if args.compact and not forseti.is_compact(conn.cursor()):
+            migrations.append(COMPACT)
+        print(f"{args.database} is at version {mimir.version()}, with {len(migrations)} migrations to run")
+
+    def on_step(migration, index, step, seconds):
+        print(f"{migration.version}.{index + 1}/{len(migration.steps)} took {seconds:.1f}s")
+
+    if args.dry_run:
+        total = 0
+        last = None
+        for migration, index, step, seconds in mimir.estimate(args.target, args.sample, args.compact, args.rebuild):
+            if migration is not last:
+                print(f"\n{migration.version}: {migration.description}")
+                last = migration
+            print(f"    {' '.join(step.sql.split())[:80]:<80} ~{seconds:.1f}s")
+            total += seconds
+        print(f"\nEstimated total: ~{total:.1f}s")
+    elif args.rebuild is not None:
+        mimir.rebuild(args.rebuild, on_step)
+        print("Done")
+    else:
+        mimir.migrate(args.target, on_step, args.compact)
+        print(f"Now at version {mimir.version()}")
+
+        if args.incremental_vacuum:
+            # A database only changes to or from auto-vacuum when it's vacuumed
+            conn.execute('''PRAGMA auto_vacuum = INCREMENTAL''')
+        if args.compact or args.incremental_vacuum:
+            # Rows moved out of the old table leave free pages behind, which only a vacuum gives back
+            print("Vacuuming...")
+            conn.execute('''VACUUM''')
+
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+The Norns keep time for Heimdall's stats.
+
+A Series holds the number of messages sent on every UTC day in a range, as
+a NumPy array indexed from the first day, so that a user or room's whole
+history can be bucketed, windowed and searched without a Python loop per
+day. Days are numbered from the epoch, as in message_days.
+"""
+
+import numpy as np
+
+DAY = 60 * 60 * 24
+HOUR = 60 * 60
+
+
+class Series:
+    """Messages sent on each UTC day from day `first` on, with `counts[i]` being the count for day `first + i`"""
+
+    def __init__(self, first, counts):
+        self.first = first
+        self.counts = counts
+
+    @classmethod
+    def from_days(cls, rows, first=None, last=None):
+        """Builds a series from (day, count) rows, such as those summed from message_days.
+
+        The series runs from the earliest of `first` and the rows to the
+        latest of `last` and the rows, with no messages on the days the rows
+        leave out."""
+        rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+        days = rows[:, 0]
+        bounds = [day for day in (first, last) if day is not None]
+        if len(days):
+            bounds += [int(days.min()), int(days.max())]
+        start, end = min(bounds), max(bounds)
+        counts = np.bincount(days - start, weights=rows[:, 1], minlength=end - start + 1).astype(np.int64)
+        return cls(start, counts)
+
+    @classmethod
+    def from_timestamps(cls, timestamps, first=None, last=None):
+        """Builds a series from the times messages were sent"""
+        days, counts = np.unique(np.floor_divide(np.asarray(timestamps, dtype=np.float64), DAY).astype(np.int64), return_counts=True)
+        return cls.from_days(np.column_stack((days, counts)), first, last)
+
+    def __len__(self):
+        return len(self.counts)
+
+    @property
+    def last(self):
+        return self.first + len(self.counts) - 1
+
+    def days(self):
+        return np.arange(self.first, self.first + len(self.counts))
+
+    def dates(self):
+        """Returns each day as a numpy.datetime64, which matplotlib plots as a date"""
+        return self.days().astype('datetime64[D]')
+
+    def on(self, day):
+        """Returns the number of messages sent on a day"""
+        index = day - self.first
+        return int(self.counts[index]) if 0 <= index < len(self.counts) else 0
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def window(self, first, last):
+        """Returns the series from day `first` to day `last`, with no messages on any day outside this one"""
+        counts = np.zeros(last - first + 1, dtype=np.int64)
+        start, end = max(first, self.first), min(last, self.last)
+        if start <= end:
+            counts[start - first:end - first + 1] = self.counts[start - self.first:end - self.first + 1]
+        return Series(first, counts)
+
+    def busiest(self):
+        """Returns the date of the busiest day, as YYYY-MM-DD, and its count. Ties go to the earliest day"""
+        index = int(np.argmax(self.counts))
+        return str(np.datetime64(self.first + index, 'D')), int(self.counts[index])
+
+    def weeks(self):
+        """Returns the dates of the Mondays starting each week the series touches, and the messages sent in each"""
+        # Day 0, 1970-01-01, was a Thursday
+        weeks = (self.days() + 3) // 7
+        counts = np.bincount(weeks - weeks[0], weights=self.counts).astype(np.int64)
+        return (np.arange(weeks[0], weeks[0] + len(counts)) * 7 - 3).astype('datetime64[D]'), counts
+
+
+def hours(timestamps):
+    """Returns the number of messages sent in each UTC hour of the day, from the times they were sent"""
+    hour = np.floor_divide(np.asarray(timestamps, dtype=np.float64), HOUR).astype(np.int64) % 24
+    return np.bincount(hour, minlength=24)
@@ -0,0 +1,148 @@
+"""
+Skirnir carries Heimdall's graphs to wherever they're hosted.
+
+A Courier uploads graphs concurrently on a small pool of threads, so that a
+command with several graphs waits for the slowest upload rather than for
+all of them in turn. Failed uploads are retried with backoff, and after
+enough failures in a row the Courier stops trying for a while, so that a
+host that's down fails commands quickly instead of holding each one up for
+the length of its timeouts. Where the graphs go is up to the backend:
+imgur in production, or a local directory, which can be served over HTTP,
+so that the whole stats path can be load-tested offline.
+"""
+
+import base64
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class UploadError(Exception):
+    pass
+
+
+class ImgurBackend:
+    """Uploads graphs to imgur anonymously, reusing connections across uploads"""
+
+    url = 'https://api.imgur.com/3/image'
+
+    def __init__(self, client_id, timeout=10, connections=4):
+        # Imported here so that only processes uploading to imgur need requests
+        import requests
+
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Client-ID {client_id}'
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=connections))
+
+    def upload(self, png):
+        response = self.session.post(self.url, data={'image': base64.b64encode(png), 'type': 'base64'}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['data']['link']
+
+
+class DirectoryBackend:
+    """Writes graphs to a directory, named by their hash.
+
+    URLs point at the file, or, if the directory is being served (say, by
+    `python -m http.server`), at `base_url` followed by the file's name."""
+
+    def __init__(self, directory, base_url=None):
+        self.directory = directory
+        self.base_url = base_url
+        os.makedirs(directory, exist_ok=True)
+
+    def upload(self, png):
+        name = hashlib.sha256(png).hexdigest()[:16] + '.png'
+        path = os.path.join(self.directory, name)
+        # Written under a temporary name first, so that a file at a URL is always a whole graph
+        with open(f'{path}.{threading.get_ident()}', 'wb') as f:
+            f.write(png)
+        os.replace(f'{path}.{threading.get_ident()}', path)
+        return f'{self.base_url.rstrip("/")}/{name}' if self.base_url is not None else f'file://{os.path.abspath(path)}'
+
+
+class Breaker:
+    """Stops uploads once `failures` have failed in a row.
+
+    After `cooldown` seconds, one upload is let through to find out whether
+    the host is back: if it succeeds, uploads start again, and if it fails,
+    the breaker waits another `cooldown`."""
+
+    def __init__(self, failures=5, cooldown=60):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.failed_in_a_row = 0
+        self.opened = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened >= self.cooldown:
+                self.probing = True
+                return True
+            return False
+
+    def succeeded(self):
+        with self.lock:
+            self.failed_in_a_row = 0
+            self.opened = None
+            self.probing = False
+
+    def failed(self):
+        with self.lock:
+            self.failed_in_a_row += 1
+            if self.probing or self.failed_in_a_row >= self.failures:
+                self.opened = time.monotonic()
+            self.probing = False
+
+
+class Courier:
+    """Uploads graphs through a backend, `workers` at a time.
+
+    Each upload is tried up to `retries` more times after it fails, waiting
+    `backoff` seconds before the first retry and twice as long before each
+    one after. See Breaker for `failures` and `cooldown`."""
+
+    def __init__(self, backend, **kwargs):
+        self.backend = backend
+        self.retries = kwargs['retries'] if 'retries' in kwargs else 2
+        self.backoff = kwargs['backoff'] if 'backoff' in kwargs else 0.5
+        self.breaker = Breaker(kwargs['failures'] if 'failures' in kwargs else 5, kwargs['cooldown'] if 'cooldown' in kwargs else 60)
+        self.executor = ThreadPoolExecutor(kwargs['workers'] if 'workers' in kwargs else 4, thread_name_prefix='skirnir')
+
+    def upload(self, png):
+        """Uploads a graph and returns its URL, raising UploadError if it can't be uploaded"""
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise UploadError("Uploads are paused after repeated failures")
+            try:
+                url = self.backend.upload(png)
+            except Exception as e:
+                self.breaker.failed()
+                if attempt == self.retries:
+                    raise UploadError(f"Upload failed after {attempt + 1} attempts: {e!r}") from e
+                time.sleep(self.backoff * 2 ** attempt)
+            else:
+                self.breaker.succeeded()
+                return url
+
+    def upload_all(self, graphs, timeout=None):
+        """Uploads graphs concurrently, returning the URL of each, in order, or the exception that stopped it being uploaded.
+
+        If `timeout` is given, uploads still running that many seconds after
+        the call are given up on."""
+        futures = [self.executor.submit(self.upload, png) for png in graphs]
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        urls = []
+        for future in futures:
+            try:
+                urls.append(future.result(max(0, deadline - time.monotonic()) if deadline is not None else None))
+            except Exception as e:
+                urls.append(e)
+        return urls
@@ -1,6 +1,10 @@
+import os
+import sqlite3
 import unittest
 
+import forseti
 import heimdall
+import loki
 
 
 class TestAllFunctionsRun(unittest.TestCase):
@@ -45,3 +49,84 @@ class TestAllFunctionsRun(unittest.TestCase):
 
     def test_get_user_at_unknown_rank(self):
         assert self.heimdall.get_user_at_position(1000, 'xkcd') == "Position not found; there have been 145 posters in &xkcd."
+
+
+class TestAliases(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.c = self.conn.cursor()
+        self.c.execute('''CREATE TABLE aliases(master text, alias text, normalias text)''')
+        self.c.execute('''CREATE UNIQUE INDEX master ON aliases(alias)''')
+        self.c.execute('''CREATE TABLE counters(name text PRIMARY KEY, value integer)''')
+        self.c.execute('''CREATE TABLE posters(room text, normname text, sendername text, name text, count integer, PRIMARY KEY(room, normname, sendername)) WITHOUT ROWID''')
+        self.c.execute('''CREATE TABLE reply_edges(room text, replier text, normname text, sendername text, day integer, count integer, PRIMARY KEY(room, replier, normname, sendername, day)) WITHOUT ROWID''')
+        forseti.run(self.c, forseti.ALIAS_UPSERT, [('Xyzzy', 'Xyzzy', 'xyzzy'), ('Xyzzy', 'Plugh', 'plugh')])
+        self.aliases = loki.Aliases(self.c)
+
+    def test_writes_are_applied_in_place(self):
+        assert self.aliases.master_of('plugh') == 'Xyzzy'
+        assert self.aliases.aliases_of('Xyzzy') == ['Plugh', 'Xyzzy']
+
+        for operation, values in [(forseti.ALIAS_UPSERT, ('Xyzzy', 'Plover', 'plover')),
+                                  (forseti.ALIAS_REMASTER, ('Plugh', 'Xyzzy')),
+                                  (forseti.ALIAS_DELETE, ('xyzzy', ))]:
+            self.aliases.apply(operation, values)
+        assert self.aliases.master_of('plover') == 'Plugh'
+        assert self.aliases.master_of('xyzzy') is None
+        assert self.aliases.aliases_of('Plugh') == ['Plover', 'Plugh']
+
+    def test_changes_by_other_processes_are_picked_up(self):
+        assert self.aliases.master_of('plover') is None
+        forseti.run(self.conn.cursor(), forseti.ALIAS_UPSERT, ('Xyzzy', 'Plover', 'plover'))
+        assert self.aliases.master_of('plover') == 'Xyzzy'
+
+    def test_inserts_leave_stored_aliases_alone(self):
+        for operation, values in [(forseti.ALIAS_INSERT, ('Plover', 'Plugh', 'plugh')),
+                                  (forseti.ALIAS_INSERT, ('Plover', 'Plover', 'plover'))]:
+            forseti.run(self.c, operation, values)
+            self.aliases.apply(operation, values)
+        assert self.c.execute('''SELECT master FROM aliases WHERE alias = 'Plugh' ''').fetchone() == ('Xyzzy', )
+        assert self.aliases.master_of('plugh') == 'Xyzzy'
+        assert self.aliases.master_of('plover') == 'Plover'
+
+    def test_own_writes_are_not_read_again(self):
+        self.aliases.refresh()
+        reads = []
+        self.conn.set_trace_callback(lambda statement: reads.append(statement) if statement.startswith('SELECT master, alias') else None)
+        forseti.run(self.c, forseti.ALIAS_UPSERT, ('Xyzzy', 'Plover', 'plover'))
+        self.aliases.apply(forseti.ALIAS_UPSERT, ('Xyzzy', 'Plover', 'plover'))
+        assert self.aliases.master_of('plover') == 'Xyzzy'
+        assert reads == []
+
+        # A write that wasn't applied here moves the counter past what was
+        forseti.run(self.conn.cursor(), forseti.ALIAS_DELETE, ('plover', ))
+        assert self.aliases.master_of('plover') is None
+        assert len(reads) == 1
+
+
+class TestLeaderboardReloads(unittest.TestCase):
+    def setUp(self):
+        self.heimdall = heimdall.Heimdall('test')
+        self.heimdall.use_logs = 'test'
+        self.heimdall.database = "_test.db"
+        self.heimdall.connect_to_database()
+        messages = [(f"Message {i}", f"id{i}", '', "senderid", ['Xyzzy', 'Plugh'][i % 2], ['xyzzy', 'plugh'][i % 2], 1534774799 + i * 3600, 'test', f"testid{i}") for i in range(5)]
+        self.heimdall.write_to_database(forseti.INSERT_MESSAGES_BULK, values=messages, mode='executemany')
+
+    def tearDown(self):
+        self.heimdall.conn.close()
+        if os.path.exists("_test.db"):
+            os.remove("_test.db")
+
+    def test_only_other_processes_alias_writes_reload_it(self):
+        leaderboard = self.heimdall.get_leaderboard('test')
+        self.heimdall.write_to_database(forseti.ALIAS_INSERT, values=('Xyzzy', 'Plugh', 'plugh'))
+        assert self.heimdall.get_leaderboard('test') is leaderboard
+        assert leaderboard.top(1) == [(5, 'Xyzzy')]
+
+        conn = sqlite3.connect("_test.db")
+        forseti.run(conn.cursor(), forseti.ALIAS_DELETE, ('plugh', ))
+        conn.commit()
+        conn.close()
+        assert self.heimdall.get_leaderboard('test') is not leaderboard
+        assert self.heimdall.get_leaderboard('test').top(1) == [(3, 'Xyzzy')]
@@ -0,0 +1,102 @@
+import queue
+import threading
+import unittest
+
+import numpy as np
+
+import bragi
+
+PNG = b'\x89PNG\r\n\x1a\n'
+
+
+class TestBragi(unittest.TestCase):
+    def setUp(self):
+        self.dates = np.arange(20000, 20028).astype('datetime64[D]')
+        self.counts = np.arange(28)
+
+    def test_draws_in_process(self):
+        canvas = bragi.Canvas('test')
+        first = canvas.draw("First", self.dates, self.counts)
+        second = canvas.draw("Second", self.dates, self.counts)
+        assert first.png.startswith(PNG) and second.png.startswith(PNG)
+        # The figure is reused and cleared after each graph
+        assert canvas.renderer.figure.axes == []
+
+    def test_identical_graphs_are_drawn_once(self):
+        renderer = bragi.Renderer()
+        drawn = []
+        draw = renderer.draw
+        renderer.draw = lambda panels: drawn.append(panels) or draw(panels)
+
+        first = renderer.render([("Messages", self.dates, self.counts)])
+        assert renderer.render([("Messages", self.dates.copy(), self.counts.copy())]) == first
+        renderer.render([("Other messages", self.dates, self.counts)])
+        renderer.render([("Messages", self.dates, self.counts[::-1])])
+        assert len(drawn) == 3
+
+    def test_draws_panels_in_one_graph(self):
+        canvas = bragi.Canvas('test')
+        single = canvas.draw("Messages", self.dates, self.counts)
+        combined = canvas.draw_panels([("All time", self.dates, self.counts), ("Sorted", self.dates, np.sort(self.counts)), ("Last week", self.dates[-7:], self.counts[-7:])])
+        assert combined.png.startswith(PNG)
+        # The PNG header holds the image's height, and each panel is as tall as a single graph
+        assert int.from_bytes(combined.png[20:24], 'big') == 3 * int.from_bytes(single.png[20:24], 'big')
+        # The figure goes back to its usual size afterwards
+        assert int.from_bytes(canvas.draw("Messages", self.dates, np.arange(1, 29)).png[20:24], 'big') == int.from_bytes(single.png[20:24], 'big')
+
+    def test_uploaded_urls_are_kept_with_graphs(self):
+        canvas = bragi.Canvas('test')
+        graph = canvas.draw("Messages", self.dates, self.counts)
+        assert graph.url is None
+        canvas.uploaded(graph, 'https://i.imgur.com/abc.png')
+        assert canvas.draw("Messages", self.dates.copy(), self.counts.copy()).url == 'https://i.imgur.com/abc.png'
+        assert canvas.draw("Other messages", self.dates, self.counts).url is None
+
+    def test_uploaded_urls_are_shared_between_producers(self):
+        requests = queue.Queue()
+        replies = {'first': queue.Queue(), 'second': queue.Queue()}
+        server = bragi.Bragi(requests, replies=replies)
+        first = bragi.Canvas('first', requests, replies['first'], timeout=5)
+        second = bragi.Canvas('second', requests, replies['second'], timeout=5)
+
+        worker = threading.Thread(target=server.step)
+        worker.start()
+        graph = first.draw("Messages", self.dates, self.counts)
+        worker.join()
+        first.uploaded(graph, 'https://i.imgur.com/abc.png')
+        server.step()
+        assert replies['first'].empty()
+
+        worker = threading.Thread(target=server.step)
+        worker.start()
+        assert second.draw("Messages", self.dates, self.counts) == graph._replace(url='https://i.imgur.com/abc.png')
+        worker.join()
+
+    def test_cache_is_bounded(self):
+        cache = bragi.GraphCache(10)
+        cache.put('a', b'1234')
+        cache.put('b', b'1234')
+        cache.get('a')
+        cache.put('c', b'1234')
+        assert cache.get('b') is None and cache.get('a') == b'1234' and cache.get('c') == b'1234'
+        assert cache.used == 8
+
+    def test_draws_in_bragi(self):
+        requests = queue.Queue()
+        replies = {'test': queue.Queue()}
+        server = bragi.Bragi(requests, replies=replies)
+        canvas = bragi.Canvas('test', requests, replies['test'], timeout=5)
+
+        # A reply left over from a graph that timed out is skipped
+        replies['test'].put((0, b'stale', None))
+        worker = threading.Thread(target=server.step)
+        worker.start()
+        assert canvas.draw("Messages", self.dates, self.counts).png.startswith(PNG)
+        worker.join()
+
+        # Dates and counts that don't line up can't be drawn
+        worker = threading.Thread(target=server.step)
+        worker.start()
+        with self.assertRaises(RuntimeError):
+            canvas.draw("Broken", self.dates, self.counts[:1])
+        worker.join()
@@ -0,0 +1,100 @@
+import os
+import threading
+import unittest
+
+import forseti
+import heimdall
+
+
+class TestCommandPool(unittest.TestCase):
+    def test_limits_commands_per_user(self):
+        lock = threading.Lock()
+        release = threading.Event()
+        started = threading.Semaphore(0)
+        running = {}
+        most = {}
+        order = []
+
+        def run(user, number):
+            with lock:
+                running[user] = running[user] + 1 if user in running else 1
+                most[user] = max(most[user] if user in most else 0, running[user])
+                order.append((user, number))
+            started.release()
+            release.wait(5)
+            with lock:
+                running[user] -= 1
+
+        pool = heimdall.CommandPool(run, workers=4, per_user=1)
+        for number in range(3):
+            pool.submit('xyzzy', 'xyzzy', number)
+        pool.submit('plugh', 'plugh', 0)
+
+        # Plugh's command doesn't wait behind Xyzzy's
+        assert started.acquire(timeout=5) and started.acquire(timeout=5)
+        assert sorted(order) == [('plugh', 0), ('xyzzy', 0)]
+
+        release.set()
+        pool.shutdown()
+        assert [number for user, number in order if user == 'xyzzy'] == [0, 1, 2]
+        assert most == {'xyzzy': 1, 'plugh': 1}
+        assert pool.running == {} and pool.waiting == {}
+
+
+class TestRunCommand(unittest.TestCase):
+    def setUp(self):
+        self.heimdall = heimdall.Heimdall('test')
+        self.heimdall.use_logs = 'test'
+        self.heimdall.database = "_test.db"
+        self.heimdall.connect_to_database()
+
+        messages = [(f"Message {i}", f"id{i}", '', "senderid", 'Xyzzy', 'xyzzy', 1534774799 + i * 3600, 'test', f"testid{i}") for i in range(5)]
+        self.heimdall.write_to_database(forseti.INSERT_MESSAGES_BULK, values=messages, mode='executemany')
+        self.heimdall.conn.commit()
+
+        self.sent = []
+        self.heimdall.heimdall.send = lambda message, parent: self.sent.append((message, parent))
+
+    def tearDown(self):
+        if os.path.exists("_test.db"):
+            os.remove("_test.db")
+
+    def packet(self, id, content):
+        class Packet:
+            pass
+
+        packet = Packet()
+        packet.packet = {}
+        packet.data = Packet()
+        packet.data.id = id
+        packet.data.content = content
+        packet.data.sender = Packet()
+        packet.data.sender.name = 'Xyzzy'
+        return packet
+
+    def test_replies_to_the_command(self):
+        self.heimdall.commands.submit('xyzzy', self.packet('first', '!rank'))
+        self.heimdall.commands.submit('xyzzy', self.packet('second', '!rank 1'))
+        self.heimdall.commands.shutdown()
+
+        assert self.sent == [("Position 1", 'first'), ("The user at position 1 is @Xyzzy.", 'second')]
+
+    def test_workers_keep_leaderboards_after_our_own_alias_writes(self):
+        leaderboard = self.heimdall.get_leaderboard('test')
+
+        # Through Forseti, the write is applied here well before it's committed
+        class Queue:
+            def __init__(self):
+                self.writes = []
+
+            def put(self, *write):
+                self.writes.append(write)
+
+        self.heimdall.queue = Queue()
+        self.heimdall.write_to_database(forseti.ALIAS_INSERT, values=('Xyzzy', 'Plugh', 'plugh'))
+        assert len(self.heimdall.queue.writes) == 1
+
+        self.heimdall.commands.submit('xyzzy', self.packet('first', '!rank'))
+        self.heimdall.commands.shutdown()
+        assert self.sent == [("Position 1", 'first')]
+        assert self.heimdall.leaderboards['test'] is leaderboard
@@ -21,7 +21,7 @@ class TestDatabaseFunctions(unittest.TestCase):
         assert c.fetchall() == []
         self.heimdall.connect_to_database()
         c.execute("SELECT name FROM sqlite_master WHERE type='table';")
-        assert c.fetchall() == [('messages',), ('aliases',)]
+        assert c.fetchall() == [('messages',), ('aliases',), ('migration_progress',), ('message_days',), ('counters',), ('posters',), ('reply_edges',)]
         c.execute('select * from messages')
         assert list(map(lambda x: x[0], c.description)) == ['content', 'id', 'parent', 'senderid', 'sendername', 'normname', 'time', 'room', 'globalid']
         c.execute('select * from aliases')
@@ -100,7 +100,7 @@ class TestDatabaseFunctions(unittest.TestCase):
         conn = sqlite3.connect('_test.db')
         c = conn.cursor()
         c.execute('''select name from sqlite_master where type = "table"''')
-        assert c.fetchall() == [('messages',), ('aliases',)]
+        assert c.fetchall() == [('messages',), ('aliases',), ('migration_progress',), ('message_days',), ('counters',), ('posters',), ('reply_edges',)]
 
     def test_func_check_or_create_tables_with_tables(self):
         self.heimdall.connect_to_database()
@@ -110,5 +110,12 @@ class TestDatabaseFunctions(unittest.TestCase):
         conn = sqlite3.connect('_test.db')
         c = conn.cursor()
         c.execute('''select name from sqlite_master where type = "table"''')
-        assert c.fetchall() == [('messages',), ('aliases',)]
+        assert c.fetchall() == [('messages',), ('aliases',), ('migration_progress',), ('message_days',), ('counters',), ('posters',), ('reply_edges',)]
 
+
+    def test_func_check_or_create_tables_writes_nothing_when_current(self):
+        self.heimdall.connect_to_database()
+        writes = []
+        self.heimdall.write_to_database = lambda statement, **kwargs: writes.append(statement)
+        self.heimdall.check_or_create_tables()
+        assert writes == []
@@ -1,8 +1,10 @@
 import doctest
 import unittest
 
+import forseti
 import heimdall
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(heimdall))
+    tests.addTests(doctest.DocTestSuite(forseti))
     return tests
@@ -0,0 +1,278 @@
+import json
+import os
+import queue
+import sqlite3
+import unittest
+
+import forseti
+import mimir
+
+
+class TestForseti(unittest.TestCase):
+    def setUp(self):
+        self.queue = queue.Queue()
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db', 'yggdrasil': '_test_two.db'}, batch_size=10, batch_time=0.01)
+        self.forseti.write_batch([('heimdall', '''CREATE TABLE messages(content text, globalid text)''', ()),
+                                  ('heimdall', '''CREATE UNIQUE INDEX globalid ON messages(globalid)''', ())])
+
+    def tearDown(self):
+        for target in self.forseti.targets.values():
+            target.conn.close()
+        for file in ['_test.spool', '_test_spill.spool', '_test_metrics.json']:
+            if os.path.exists(file):
+                os.remove(file)
+        for file in ['_test.db', '_test_two.db']:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.exists(f"{file}{suffix}"):
+                    os.remove(f"{file}{suffix}")
+
+    def count_messages(self):
+        conn = sqlite3.connect('_test.db')
+        count = conn.execute('''SELECT COUNT(*) FROM messages''').fetchone()[0]
+        conn.close()
+        return count
+
+    def test_commits_when_batch_is_full(self):
+        for i in range(25):
+            self.queue.put(('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', str(i))))
+        for i in range(25):
+            self.forseti.step()
+        assert self.count_messages() == 20
+        assert len(self.forseti.targets['heimdall'].pending) == 5
+
+    def test_commits_when_batch_time_is_spent(self):
+        self.queue.put(('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', 'one')))
+        self.forseti.step()
+        assert self.count_messages() == 0
+        self.forseti.step()
+        assert self.count_messages() == 1
+
+    def test_write_batch_commits_whole_batch(self):
+        batch = [('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', str(i))) for i in range(5)]
+        self.forseti.write_batch(batch)
+        assert self.count_messages() == 5
+
+    def test_failed_item_does_not_discard_batch(self):
+        batch = [('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', 'one')),
+                 ('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', 'one')),
+                 ('heimdall', '''INSERT INTO messages VALUES(?, ?)''', [('content', 'two'), ('content', 'one')]),
+                 ('heimdall', '''INSERT INTO nowhere VALUES(?, ?)''', ('content', 'three')),
+                 ('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', 'four'))]
+        self.forseti.write_batch(batch)
+        assert self.count_messages() == 2
+
+    def test_acknowledges_writes_that_ask(self):
+        replies = queue.Queue()
+        self.forseti.replies = {'test': replies}
+        batch = [('heimdall', '''INSERT INTO messages VALUES(?, ?)''', [('content', 'one'), ('content', 'two')], 'test', 1),
+                 ('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', 'one'), 'test', 2),
+                 ('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', 'three')),
+                 ('heimdall', '''INSERT OR IGNORE INTO messages VALUES(?, ?)''', [('content', 'three'), ('content', 'four')], 'test', 3)]
+        self.forseti.write_batch(batch)
+
+        assert replies.get_nowait() == (1, 2, None)
+        ticket, rows, error = replies.get_nowait()
+        assert (ticket, rows) == (2, 0) and isinstance(error, sqlite3.IntegrityError)
+        assert replies.get_nowait() == (3, 1, None)
+        assert replies.empty()
+
+    def test_typed_operations(self):
+        self.forseti.write_batch([('heimdall', '''CREATE TABLE aliases(master text, alias text, normalias text)''', ()),
+                                  ('heimdall', '''CREATE UNIQUE INDEX master ON aliases(alias)''', ()),
+                                  ('heimdall', '''CREATE TABLE counters(name text PRIMARY KEY, value integer)''', ()),
+                                  ('heimdall', '''CREATE TABLE posters(room text, normname text, sendername text, name text, count integer, PRIMARY KEY(room, normname, sendername)) WITHOUT ROWID''', ()),
+                                  ('heimdall', '''INSERT INTO posters VALUES('test', 'plugh', 'Plugh', 'Plugh', 3), ('test', 'plover', 'Plover', 'Plover', 2)''', ())])
+        self.forseti.write_batch([('heimdall', forseti.ALIAS_UPSERT, ('Xyzzy', 'Xyzzy', 'xyzzy')),
+                                  ('heimdall', forseti.ALIAS_UPSERT, [('Xyzzy', 'Plugh', 'plugh'), ('Xyzzy', 'Plover', 'plover')]),
+                                  ('heimdall', forseti.ALIAS_UPSERT, ('Xyzzy', 'Plugh', 'plugh')),
+                                  ('heimdall', forseti.ALIAS_DELETE, ('plover',)),
+                                  ('heimdall', forseti.ALIAS_REMASTER, ('Plugh', 'Xyzzy'))])
+
+        conn = sqlite3.connect('_test.db')
+        aliases = conn.execute('''SELECT master, alias FROM aliases ORDER BY alias''').fetchall()
+        counter = conn.execute('''SELECT value FROM counters WHERE name = 'aliases' ''').fetchone()[0]
+        names = conn.execute('''SELECT normname, name FROM posters ORDER BY normname''').fetchall()
+        conn.close()
+        assert aliases == [('Plugh', 'Plugh'), ('Plugh', 'Xyzzy')]
+        assert counter == 5
+        assert names == [('plover', 'Plover'), ('plugh', 'Plugh')]
+
+    def test_writes_are_routed_to_their_target(self):
+        self.forseti.write_batch([('yggdrasil', '''CREATE TABLE groups(groupname text, members text)''', ()),
+                                  ('yggdrasil', forseti.GROUP_UPSERT, ('group', 'member')),
+                                  ('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', 'one'))])
+
+        conn = sqlite3.connect('_test_two.db')
+        assert conn.execute('''SELECT * FROM groups''').fetchall() == [('group', 'member')]
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'messages'").fetchall() == []
+        conn.close()
+        assert self.count_messages() == 1
+
+    def test_spooled_writes_are_replayed_after_a_crash(self):
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, batch_size=10, batch_time=60, spool='_test.spool')
+        for i in range(5):
+            self.queue.put(('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', str(i))))
+            self.forseti.step()
+        assert self.count_messages() == 0
+
+        # Closing the connection without committing loses the open transaction, as a crash would
+        self.forseti.targets['heimdall'].conn.close()
+        with open('_test.spool', 'ab') as f:
+            f.write(b'\x00\x00\x01\x00torn')
+
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, spool='_test.spool')
+        assert self.count_messages() == 5
+        assert self.forseti.spool.records == 5
+
+        # Replaying twice leaves the same state behind
+        self.forseti.targets['heimdall'].conn.close()
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, spool='_test.spool')
+        assert self.count_messages() == 5
+
+        # The torn record was cut off, so writes spooled after it are replayed too
+        self.queue.put(('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', '5')))
+        self.forseti.step()
+        self.forseti.targets['heimdall'].conn.close()
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, spool='_test.spool')
+        assert self.count_messages() == 6
+        assert self.forseti.spool.records == 6
+
+    def test_committed_writes_are_not_replayed(self):
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, batch_size=10, batch_time=60, spool='_test.spool')
+        self.forseti.write_batch([('heimdall', '''CREATE TABLE counter(value integer)''', ()),
+                                  ('heimdall', '''INSERT INTO counter VALUES(0)''', ()),
+                                  ('heimdall', '''UPDATE counter SET value = value + 1''', ())])
+        self.queue.put(('heimdall', '''UPDATE counter SET value = value + 10''', ()))
+        self.forseti.step()
+
+        # Only the write that hadn't been committed when Forseti stopped is run again
+        self.forseti.targets['heimdall'].conn.close()
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, spool='_test.spool')
+        conn = sqlite3.connect('_test.db')
+        assert conn.execute('''SELECT value FROM counter''').fetchone()[0] == 11
+        conn.close()
+        assert self.forseti.spool.records == 4
+
+    def test_spool_is_emptied_when_idle(self):
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, batch_size=10, batch_time=0, idle_time=0.01, spool='_test.spool')
+        self.queue.put(('heimdall', '''INSERT INTO messages VALUES(?, ?)''', ('content', 'one')))
+        self.forseti.step()
+        assert self.forseti.spool.records == 1
+        self.forseti.step()
+        assert self.forseti.spool.records == 0
+        assert os.path.getsize('_test.spool') == 0
+        assert self.count_messages() == 1
+
+    def test_write_queue_coalesces_message_inserts_when_full(self):
+        bounded = queue.Queue(1)
+        write_queue = forseti.WriteQueue(bounded, 'test', 'coalesce')
+        for i in range(4):
+            write_queue.put('heimdall', forseti.INSERT_MESSAGE, ('content', str(i)))
+        write_queue.put('heimdall', forseti.ALIAS_DELETE, ('alias',))
+
+        assert bounded.get_nowait()[2] == ('content', '0')
+        assert write_queue.flush() is False
+        target, operation, values = bounded.get_nowait()[:3]
+        assert operation == forseti.INSERT_MESSAGES_BULK
+        assert values == [('content', '1'), ('content', '2'), ('content', '3')]
+        assert write_queue.flush() is True
+        assert bounded.get_nowait()[1] == forseti.ALIAS_DELETE
+
+    def test_write_queue_spills_to_disk_when_full(self):
+        bounded = queue.Queue(2)
+        write_queue = forseti.WriteQueue(bounded, 'test', 'spill', spill='_test_spill.spool')
+        for i in range(5):
+            write_queue.put('heimdall', forseti.INSERT_MESSAGE, ('content', str(i)))
+        assert write_queue.spill.records == 3
+
+        received = []
+        while len(received) < 5:
+            received.append(bounded.get_nowait()[2][1])
+            write_queue.flush()
+        assert received == ['0', '1', '2', '3', '4']
+        assert write_queue.spill.records == 0
+        assert os.path.getsize('_test_spill.spool') == 0
+
+    def test_metrics_are_exported(self):
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, batch_size=1, metrics='_test_metrics.json', metrics_interval=0)
+        write_queue = forseti.WriteQueue(self.queue, 'test')
+        write_queue.put('heimdall', '''INSERT INTO messages VALUES(?, ?)''', [('content', 'one'), ('content', 'two')])
+        self.forseti.step()
+
+        with open('_test_metrics.json') as f:
+            metrics = json.loads(f.read())
+        assert metrics['writes'] == 1
+        assert metrics['queue_depth'] == 0
+        assert metrics['producers']['test']['rows'] == 2
+
+    def test_maintenance_truncates_a_large_wal(self):
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, checkpoint_size=0, truncate_size=0, checkpoint_interval=0)
+        self.forseti.write_batch([('heimdall', '''INSERT INTO messages VALUES(?, ?)''', [('content', str(i)) for i in range(1000)])])
+        assert self.forseti.targets['heimdall'].wal_size() > 0
+
+        self.forseti.maintain()
+        assert self.forseti.targets['heimdall'].wal_size() == 0
+        assert self.count_messages() == 1000
+
+    def test_maintenance_gives_free_pages_back(self):
+        self.forseti = forseti.Forseti(self.queue, targets={'heimdall': '_test.db'}, vacuum_interval=0, vacuum_pages=10)
+        target = self.forseti.targets['heimdall']
+        assert target.c.execute('''PRAGMA auto_vacuum''').fetchone()[0] == 2
+
+        self.forseti.write_batch([('heimdall', '''INSERT INTO messages VALUES(?, ?)''', [('x' * 1000, str(i)) for i in range(1000)]),
+                                  ('heimdall', '''DELETE FROM messages''', ())])
+        free = target.c.execute('''PRAGMA freelist_count''').fetchone()[0]
+        assert free > 10
+
+        assert self.forseti.vacuum(target)
+        assert target.c.execute('''PRAGMA freelist_count''').fetchone()[0] == free - 10
+
+    def create_message_tables(self):
+        self.forseti.write_batch([('yggdrasil', '''CREATE TABLE messages(content text, id text, parent text, senderid text, sendername text, normname text, time real, room text, globalid text)''', ()),
+                                  ('yggdrasil', '''CREATE UNIQUE INDEX globalid ON messages(globalid)''', ()),
+                                  ('yggdrasil', '''CREATE TABLE message_days(room text, normname text, day integer, count integer, words integer DEFAULT 0, characters integer DEFAULT 0, top_level integer DEFAULT 0, PRIMARY KEY(room, normname, day)) WITHOUT ROWID''', ()),
+                                  ('yggdrasil', '''CREATE TABLE aliases(master text, alias text, normalias text)''', ()),
+                                  ('yggdrasil', '''CREATE TABLE posters(room text, normname text, sendername text, name text, count integer, PRIMARY KEY(room, normname, sendername)) WITHOUT ROWID''', ()),
+                                  ('yggdrasil', '''CREATE TABLE reply_edges(room text, replier text, normname text, sendername text, day integer, count integer, PRIMARY KEY(room, replier, normname, sendername, day)) WITHOUT ROWID''', ())])
+
+    def test_message_inserts_keep_daily_rollup(self):
+        self.create_message_tables()
+
+        def message(i, sender, day):
+            return (f"Message {i}", f"id{i}", '', 'agent:1', sender, sender.lower(), day * 86400 + i, 'test', f"testid{i}")
+
+        replies = queue.Queue()
+        self.forseti.replies = {'test': replies}
+        self.forseti.write_batch([('yggdrasil', forseti.INSERT_MESSAGE, message(1, 'Xyzzy', 10), 'test', 1),
+                                  ('yggdrasil', forseti.INSERT_MESSAGE, message(1, 'Xyzzy', 10), 'test', 2),
+                                  ('yggdrasil', forseti.INSERT_MESSAGES_BULK, [message(1, 'Xyzzy', 10), message(2, 'Xyzzy', 10), message(3, 'Plugh', 11)], 'test', 3)])
+
+        assert replies.get_nowait() == (1, 1, None)
+        assert replies.get_nowait()[:2] == (2, 0)
+        assert replies.get_nowait() == (3, 2, None)
+
+        conn = sqlite3.connect('_test_two.db')
+        assert conn.execute('''SELECT * FROM message_days ORDER BY day''').fetchall() == [('test', 'xyzzy', 10, 2, 4, 18, 2), ('test', 'plugh', 11, 1, 2, 9, 1)]
+        assert conn.execute('''SELECT * FROM posters ORDER BY normname''').fetchall() == [('test', 'plugh', 'Plugh', 'Plugh', 1), ('test', 'xyzzy', 'Xyzzy', 'Xyzzy', 2)]
+        conn.close()
+
+    def test_layout_is_looked_up_once_per_schema_change(self):
+        self.create_message_tables()
+        target = self.forseti.targets['yggdrasil']
+        lookups = []
+        target.conn.set_trace_callback(lambda statement: lookups.append(statement) if 'sqlite_master' in statement else None)
+
+        def message(i):
+            return (f"Message {i}", f"0{i:012d}", '', 'agent:1', 'Xyzzy', 'xyzzy', i * 5000.0, 'test', f"test0{i:012d}")
+
+        for i in range(5):
+            self.forseti.write_batch([('yggdrasil', forseti.INSERT_MESSAGE, message(i))])
+        assert len(lookups) == 1
+
+        # The compact layout is made with raw SQL, after which the layout is looked up again
+        conn = sqlite3.connect('_test_two.db')
+        mimir.Mimir(conn.cursor(), lambda statement, values: self.forseti.write_batch([('yggdrasil', statement, values)]), migrations=[]).migrate(compact=True)
+        self.forseti.write_batch([('yggdrasil', forseti.INSERT_MESSAGE, message(5))])
+        assert target.compact
+        assert conn.execute('''SELECT COUNT(*) FROM message_rows''').fetchone()[0] == 6
+        conn.close()
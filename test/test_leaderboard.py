@@ -0,0 +1,65 @@
+import sqlite3
+import unittest
+
+import forseti
+import heimdall
+
+
+def normalise(nick):
+    return ''.join(nick.split()).lower()
+
+
+class TestLeaderboard(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.c = self.conn.cursor()
+        self.c.execute('''CREATE TABLE messages(content text, id text, parent text, senderid text, sendername text, normname text, time real, room text, globalid text)''')
+        self.c.execute('''CREATE TABLE aliases(master text, alias text, normalias text)''')
+        self.c.execute('''CREATE TABLE message_days(room text, normname text, day integer, count integer, words integer DEFAULT 0, characters integer DEFAULT 0, top_level integer DEFAULT 0, PRIMARY KEY(room, normname, day)) WITHOUT ROWID''')
+        self.c.execute('''CREATE TABLE counters(name text PRIMARY KEY, value integer)''')
+        self.c.execute('''CREATE TABLE posters(room text, normname text, sendername text, name text, count integer, PRIMARY KEY(room, normname, sendername)) WITHOUT ROWID''')
+        self.c.execute('''CREATE TABLE reply_edges(room text, replier text, normname text, sendername text, day integer, count integer, PRIMARY KEY(room, replier, normname, sendername, day)) WITHOUT ROWID''')
+        self.messages = 0
+        for sender, count in [('Xyzzy', 5), ('Plugh', 3), ('Plover', 4), ('plover', 1), ('Dog Barrier', 2)]:
+            for i in range(count):
+                self.write(forseti.INSERT_MESSAGE, self.message(sender))
+        self.leaderboard = heimdall.Leaderboard('test', normalise)
+        self.leaderboard.load(self.c)
+
+    def message(self, sender, room='test'):
+        self.messages += 1
+        return ("Content", f"id{self.messages}", '', 'agent:1', sender, normalise(sender), 1534774799, room, f"{room}id{self.messages}")
+
+    def write(self, operation, values):
+        forseti.run(self.c, operation, values)
+
+    def assert_matches_database(self):
+        loaded = heimdall.Leaderboard('test', normalise)
+        loaded.load(self.c)
+        assert self.leaderboard.ranking == loaded.ranking
+        assert self.leaderboard.counts == loaded.counts
+
+    def test_ranks_by_name_posted_under(self):
+        assert self.leaderboard.top(10) == [(5, 'Xyzzy'), (4, 'Plover'), (3, 'Plugh'), (2, 'Dog Barrier'), (1, 'plover')]
+        assert self.leaderboard.position('plover') == 2
+        assert self.leaderboard.position('dogbarrier') == 4
+        assert self.leaderboard.position('nobody') is None
+        assert self.leaderboard.at(3) == (3, 'Plugh')
+        assert len(self.leaderboard) == 5
+
+    def test_updates_match_a_fresh_load(self):
+        writes = [(forseti.INSERT_MESSAGE, self.message('Plugh')),
+                  (forseti.INSERT_MESSAGE, self.message('Plugh', 'elsewhere')),
+                  (forseti.ALIAS_UPSERT, ('Xyzzy', 'Xyzzy', 'xyzzy')),
+                  (forseti.ALIAS_UPSERT, ('Xyzzy', 'Plover', 'plover')),
+                  (forseti.INSERT_MESSAGE, self.message('plover')),
+                  (forseti.ALIAS_REMASTER, ('Plover', 'Xyzzy')),
+                  (forseti.ALIAS_DELETE, ('xyzzy', )),
+                  (forseti.INSERT_MESSAGE, self.message('New Poster'))]
+
+        for operation, values in writes:
+            self.write(operation, values)
+            self.leaderboard.apply(operation, values)
+            self.assert_matches_database()
+
+        assert self.leaderboard.top(2) == [(6, 'Plover'), (5, 'Xyzzy')]
@@ -0,0 +1,231 @@
+import os
+import sqlite3
+import unittest
+
+import forseti
+import mimir
+
+
+class Interrupted(Exception):
+    pass
+
+
+class TestMimir(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect('_test.db', isolation_level=None)
+        self.c = self.conn.cursor()
+        self.c.execute('''CREATE TABLE messages(content text, length integer)''')
+        self.c.executemany('''INSERT INTO messages VALUES(?, NULL)''', [(f"Message {i}", ) for i in range(250)])
+
+        self.migrations = [
+            mimir.Migration(1, "Index", [mimir.Statement('''CREATE INDEX IF NOT EXISTS content ON messages(content)''', 'messages')]),
+            mimir.Migration(2, "Lengths", [mimir.Chunked('messages', '''UPDATE messages SET length = LENGTH(content) WHERE rowid > ? AND rowid <= ?''', chunk_size=100)]),
+        ]
+        self.writes = []
+
+    def tearDown(self):
+        self.conn.close()
+        if os.path.exists("_test.db"):
+            os.remove("_test.db")
+
+    def write(self, statement, values):
+        self.writes.append((statement, values))
+        return self.c.execute(statement, values).rowcount
+
+    def tables(self):
+        self.c.execute('''SELECT name FROM sqlite_master WHERE type = 'table' ''')
+        return [row[0] for row in self.c.fetchall()]
+
+    def test_runs_pending_migrations_once(self):
+        migrator = mimir.Mimir(self.c, self.write, migrations=self.migrations)
+        migrator.migrate(target=1)
+        assert migrator.version() == 1
+        assert [migration.version for migration in migrator.pending()] == [2]
+
+        migrator.migrate()
+        assert migrator.version() == 2
+        self.c.execute('''SELECT COUNT(*) FROM messages WHERE length IS NULL''')
+        assert self.c.fetchone()[0] == 0
+        assert self.tables() == ['messages', 'migration_progress']
+
+        writes = len(self.writes)
+        migrator.migrate()
+        assert len(self.writes) == writes
+
+    def test_interrupted_migration_resumes(self):
+        def interrupt(statement, values):
+            if statement.startswith('UPDATE') and values[0] >= 100:
+                raise Interrupted
+            return self.write(statement, values)
+
+        with self.assertRaises(Interrupted):
+            mimir.Mimir(self.c, interrupt, migrations=self.migrations).migrate()
+        assert mimir.Mimir(self.c, self.write).progress(2) == (0, 100)
+
+        self.writes = []
+        migrator = mimir.Mimir(self.c, self.write, migrations=self.migrations)
+        migrator.migrate()
+        assert migrator.version() == 2
+        assert [values for statement, values in self.writes if statement.startswith('UPDATE')] == [(100, 200), (200, 300)]
+
+    def test_stale_handles_migrate_safely(self):
+        self.c.execute('''DROP TABLE messages''')
+        first = mimir.Mimir(self.c, self.write)
+        first.create_tables()
+
+        other = sqlite3.connect('_test.db', isolation_level=None)
+        second = mimir.Mimir(other.cursor(), self.write)
+        stale = second.pending()
+        first.migrate()
+
+        # Migrations another process has finished since they were read are skipped
+        writes = len(self.writes)
+        second.run_all(stale)
+        assert [statement for statement, values in self.writes[writes:] if 'migration_progress' not in statement] == []
+
+        # A version left behind runs the last migration again, which finds its columns already there
+        self.c.execute('''PRAGMA user_version = 5''')
+        second.migrate()
+        assert second.version() == mimir.MIGRATIONS[-1].version
+        self.c.execute('''SELECT COUNT(*) FROM pragma_table_info('message_days')''')
+        assert self.c.fetchone()[0] == 7
+        other.close()
+
+    def test_dry_run_changes_nothing(self):
+        migrator = mimir.Mimir(self.c, self.write, migrations=self.migrations)
+        estimates = migrator.estimate(sample=50)
+        assert [(migration.version, index) for migration, index, step, seconds in estimates] == [(1, 0), (2, 0)]
+        assert all(seconds >= 0 for migration, index, step, seconds in estimates)
+
+        assert self.writes == []
+        assert migrator.version() == 0
+        assert self.tables() == ['messages']
+        self.c.execute('''SELECT COUNT(*) FROM messages WHERE length IS NULL''')
+        assert self.c.fetchone()[0] == 250
+
+    def test_dry_run_on_a_migrated_database(self):
+        self.c.execute('''DROP TABLE messages''')
+        migrator = mimir.Mimir(self.c, self.write)
+        migrator.create_tables()
+        migrator.migrate()
+        forseti.run(self.c, forseti.INSERT_MESSAGES_BULK, [("Message", f"0{i:012d}", "", "agent:1", "Xyzzy", "xyzzy", i * 5000.0, "xkcd", f"xkcd0{i:012d}") for i in range(100)])
+
+        assert migrator.estimate(sample=50) == []
+        estimates = migrator.estimate(sample=50, rebuild='message_days')
+        assert [index for migration, index, step, seconds in estimates] == [0, 1, 2, 3]
+        assert all(seconds >= 0 for migration, index, step, seconds in estimates)
+
+        # The rollups are copied into the sample too
+        self.c.execute('''PRAGMA user_version = 5''')
+        assert [(migration.version, index) for migration, index, step, seconds in migrator.estimate(sample=50)] == [(6, 0), (6, 1), (6, 2), (6, 3)]
+
+    def test_compact_layout_reads_and_writes_like_the_original(self):
+        self.c.execute('''DROP TABLE messages''')
+        self.c.execute('''CREATE TABLE messages(content text, id text, parent text, senderid text, sendername text, normname text, time real, room text, globalid text)''')
+        self.c.execute('''CREATE UNIQUE INDEX globalid ON messages(globalid)''')
+        messages = [("Hello", "0000000000001", "", "agent:1", "Xyzzy", "xyzzy", 1.0, "xkcd", "xkcd0000000000001"),
+                    ("Hi", "0zzzzzzzzzzzz", "0000000000001", "agent:2", "Plugh", "plugh", 2.5, "xkcd", "xkcd0zzzzzzzzzzzz"),
+                    ("Odd id", "1000000000000", "0zzzzzzzzzzzz", "agent:1", "Xyzzy", "xyzzy", 3.0, "test", "test1000000000000"),
+                    ("Short id", "randomid", None, "agent:1", "Xyzzy", "xyzzy", 4.0, "test", "testrandomid")]
+        self.c.executemany('''INSERT INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', messages)
+
+        migrator = mimir.Mimir(self.c, self.write, migrations=[])
+        migrator.migrate(compact=True)
+        assert forseti.is_compact(self.c)
+        self.c.execute('''SELECT * FROM messages ORDER BY time''')
+        assert self.c.fetchall() == messages
+        self.c.execute('''SELECT typeof(id) FROM message_rows ORDER BY time''')
+        assert [row[0] for row in self.c.fetchall()] == ['integer', 'integer', 'text', 'text']
+
+        new = ("New", "0000000000002", "0000000000001", "agent:3", "Plover", "plover", 5.0, "xkcd", "xkcd0000000000002")
+        self.c.executemany('''INSERT OR IGNORE INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', [messages[0], new])
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.c.execute('''INSERT INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', new)
+        self.c.execute('''SELECT * FROM messages WHERE room IS ? AND id = ?''', ('xkcd', '0000000000002'))
+        assert self.c.fetchall() == [new]
+
+        self.c.execute('''DELETE FROM messages WHERE room IS ?''', ('test', ))
+        self.c.execute('''SELECT COUNT(*) FROM message_rows''')
+        assert self.c.fetchone()[0] == 3
+
+    def test_rebuilt_rollup_matches_messages(self):
+        self.c.execute('''DROP TABLE messages''')
+        self.c.execute('''CREATE TABLE messages(content text, id text, parent text, senderid text, sendername text, normname text, time real, room text, globalid text)''')
+        contents = ["Message", "  Two  words ", "Tabs\tand\nnew lines", "", "x\r\n\r\ny"]
+        messages = [(contents[i % 5], f"0{i:012d}", "" if i % 3 else f"0{i - 1:012d}", "agent:1", f"User {i % 7}", f"user{i % 7}", i * 5000.0, ['xkcd', 'test'][i % 2], f"room0{i:012d}") for i in range(300)]
+        self.c.executemany('''INSERT INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', messages)
+        self.c.execute('''CREATE TABLE aliases(master text, alias text, normalias text)''')
+
+        days = {}
+        for content, id, parent, senderid, sendername, normname, time, room, globalid in messages:
+            key = (room, normname, int(time // 86400))
+            day = days[key] if key in days else [0, 0, 0, 0]
+            days[key] = [day[0] + 1, day[1] + len(content.split()), day[2] + len(content), day[3] + (parent == '')]
+        counts = sorted((*key, *day) for key, day in days.items())
+
+        migrator = mimir.Mimir(self.c, self.write)
+        migrator.migrate()
+        self.c.execute('''SELECT * FROM message_days ORDER BY 1, 2, 3''')
+        assert self.c.fetchall() == counts
+
+        migrator.migrate(compact=True)
+        self.c.execute('''UPDATE message_days SET count = 0''')
+        migrator.rebuild('message_days')
+        self.c.execute('''SELECT * FROM message_days ORDER BY 1, 2, 3''')
+        assert self.c.fetchall() == counts
+
+    def test_rebuilt_posters_match_messages(self):
+        self.c.execute('''DROP TABLE messages''')
+        self.c.execute('''CREATE TABLE messages(content text, id text, parent text, senderid text, sendername text, normname text, time real, room text, globalid text)''')
+        self.c.executemany('''INSERT INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', [("Message", f"0{i:012d}", "", f"agent:{i % 2}", ['Xyzzy', 'xyzzy', 'Plugh', 'Plover'][i % 4], ['xyzzy', 'xyzzy', 'plugh', 'plover'][i % 4], i * 5000.0, ['xkcd', 'test'][i % 3 // 2], f"room0{i:012d}") for i in range(300)])
+        self.c.execute('''CREATE TABLE aliases(master text, alias text, normalias text)''')
+        self.c.execute('''INSERT INTO aliases VALUES('Xyzzy', 'Plugh', 'plugh')''')
+        expected = '''SELECT room, normname, sendername, COALESCE(master, sendername), COUNT(*) FROM messages LEFT JOIN aliases ON normname = normalias GROUP BY 1, 2, 3 ORDER BY 1, 2, 3'''
+
+        migrator = mimir.Mimir(self.c, self.write)
+        migrator.migrate()
+        self.c.execute(expected)
+        posters = self.c.fetchall()
+        self.c.execute('''SELECT * FROM posters ORDER BY 1, 2, 3''')
+        assert self.c.fetchall() == posters
+
+        migrator.migrate(compact=True)
+        self.c.execute('''DELETE FROM posters''')
+        migrator.rebuild('posters')
+        self.c.execute('''SELECT * FROM posters ORDER BY 1, 2, 3''')
+        assert self.c.fetchall() == posters
+
+    def test_reply_edges_match_messages(self):
+        self.c.execute('''DROP TABLE messages''')
+        self.c.execute('''CREATE TABLE messages(content text, id text, parent text, senderid text, sendername text, normname text, time real, room text, globalid text)''')
+        self.c.execute('''CREATE UNIQUE INDEX globalid ON messages(globalid)''')
+        self.c.execute('''CREATE TABLE aliases(master text, alias text, normalias text)''')
+        migrator = mimir.Mimir(self.c, self.write)
+        migrator.migrate()
+
+        def message(i):
+            sender = ['Xyzzy', 'xyzzy', 'Plugh', 'Plover'][i % 4]
+            parent = f"0{i * 7 % 400:012d}" if i % 3 else ''
+            return ("Message", f"0{i:012d}", parent, "agent:1", sender, sender.lower(), i * 5000.0, ['xkcd', 'test'][i % 5 // 4], f"room0{i:012d}")
+
+        # Replies arrive both before and after the messages they reply to
+        forseti.run(self.c, forseti.INSERT_MESSAGES_BULK, [message(i) for i in range(300, 0, -2)])
+        forseti.run(self.c, forseti.INSERT_MESSAGES_BULK, [message(i) for i in range(1, 300, 2)])
+        expected = '''SELECT c.room, c.normname, p.normname, p.sendername, CAST(c.time / 86400 AS INT), COUNT(*) FROM messages c JOIN messages p ON p.room IS c.room AND p.id = c.parent WHERE c.id IS NOT c.parent GROUP BY 1, 2, 3, 4, 5 ORDER BY 1, 2, 3, 4, 5'''
+        self.c.execute(expected)
+        edges = self.c.fetchall()
+        assert len(edges) > 0
+        self.c.execute('''SELECT * FROM reply_edges ORDER BY 1, 2, 3, 4, 5''')
+        assert self.c.fetchall() == edges
+
+        migrator.migrate(compact=True)
+        self.c.execute('''DELETE FROM reply_edges''')
+        migrator.rebuild('reply_edges')
+        self.c.execute('''SELECT * FROM reply_edges ORDER BY 1, 2, 3, 4, 5''')
+        assert self.c.fetchall() == edges
+
+        forseti.run(self.c, forseti.INSERT_MESSAGES_BULK, [message(i) for i in range(300, 400)])
+        self.c.execute(expected)
+        edges = self.c.fetchall()
+        self.c.execute('''SELECT * FROM reply_edges ORDER BY 1, 2, 3, 4, 5''')
+        assert self.c.fetchall() == edges
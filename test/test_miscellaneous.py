@@ -28,3 +28,9 @@ class TestMiscellaneous(unittest.TestCase):
 
     def test_ability_to_recover_from_missing_config_file(self):
         assert True
+
+    def test_startup_profile_covers_each_stage(self):
+        stages = [stage for stage, taken in self.heimdall.profile.stages]
+        assert stages == ['imports', 'setup', 'files', 'database', 'connect', 'backfill', 'count']
+        report = self.heimdall.profile.report()
+        assert 'backfill' in report and 'total' in report and 'Peak memory' in report
@@ -0,0 +1,33 @@
+import unittest
+
+import norns
+
+
+class TestNorns(unittest.TestCase):
+    def setUp(self):
+        # 2024-10-04 was a Friday
+        self.series = norns.Series.from_days([(20000, 3), (20003, 5), (20010, 5)], last=20012)
+
+    def test_fills_in_missing_days(self):
+        assert self.series.first == 20000 and self.series.last == 20012
+        assert list(self.series.counts) == [3, 0, 0, 5, 0, 0, 0, 0, 0, 0, 5, 0, 0]
+        assert str(self.series.dates()[3]) == '2024-10-07'
+        assert self.series.on(20003) == 5 and self.series.on(20012) == 0 and self.series.on(19999) == 0
+        assert self.series.total() == 13
+
+    def test_busiest_day_goes_to_the_earliest_tie(self):
+        assert self.series.busiest() == ('2024-10-07', 5)
+
+    def test_windows_are_padded(self):
+        window = self.series.window(19998, 20003)
+        assert window.first == 19998
+        assert list(window.counts) == [0, 0, 3, 0, 0, 5]
+
+    def test_buckets(self):
+        mondays, counts = self.series.weeks()
+        assert [str(monday) for monday in mondays] == ['2024-09-30', '2024-10-07', '2024-10-14']
+        assert list(counts) == [3, 5, 5]
+
+        timestamps = [20000 * norns.DAY + 30, 20000 * norns.DAY + 60, 20003 * norns.DAY + 13 * norns.HOUR]
+        assert list(norns.Series.from_timestamps(timestamps).counts) == [2, 0, 0, 1]
+        assert list(norns.hours(timestamps)[[0, 13]]) == [2, 1]
@@ -0,0 +1,82 @@
+import os
+import unittest
+
+import heimdall
+
+
+class ExplainingCursor:
+    """Wraps a cursor, recording the query plan of every SELECT run through it"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.plans = []
+
+    def execute(self, query, values=()):
+        if query.lstrip().upper().startswith('SELECT'):
+            plan = self.cursor.connection.execute(f'EXPLAIN QUERY PLAN {query}', values).fetchall()
+            self.plans.append((query, [row[3] for row in plan]))
+        return self.cursor.execute(query, values)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class TestQueryPlans(unittest.TestCase):
+    def setUp(self):
+        self.heimdall = heimdall.Heimdall('test')
+        self.heimdall.use_logs = 'test'
+        self.heimdall.database = "_test.db"
+        self.heimdall.connect_to_database()
+
+        messages = []
+        for i in range(100):
+            sender = ['Xyzzy', 'Plugh', 'dog barrier'][i % 3]
+            messages.append((f"Message {i}", f"id{i}", f"id{i - 1}" if i % 2 else '', "senderid", sender, self.heimdall.heimdall.normalise_nick(sender), 1534774799 + i * 3600, 'test', f"testid{i}"))
+        self.heimdall.write_to_database('''INSERT INTO messages VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)''', values=messages, mode='executemany')
+        self.heimdall.write_to_database('''INSERT INTO aliases VALUES(?, ?, ?)''', values=[('Xyzzy', 'Xyzzy', 'xyzzy'), ('Xyzzy', 'Plugh', 'plugh')], mode='executemany')
+
+        class Packet:
+            def __init__(self):
+                self.content = ""
+                self.name = ""
+
+        self.decoy_packet = Packet()
+        self.decoy_packet.data = Packet()
+        self.decoy_packet.data.sender = Packet()
+        self.decoy_packet.packet = {}
+
+        self.heimdall.heimdall.reply = lambda string: None
+        self.heimdall.heimdall.packet = self.decoy_packet
+
+        # The leaderboard reads every alias once when it's loaded, as main() does at startup
+        self.heimdall.get_leaderboard('test')
+        self.heimdall.c = ExplainingCursor(self.heimdall.c)
+        self.heimdall.aliases.c = self.heimdall.c
+
+    def tearDown(self):
+        if os.path.exists("_test.db"):
+            os.remove("_test.db")
+
+    def assert_no_table_scans(self):
+        assert len(self.heimdall.c.plans) > 0
+        for query, plan in self.heimdall.c.plans:
+            for step in plan:
+                assert not step.startswith('SCAN messages'), f"{query} scans messages: {plan}"
+                assert not step.startswith('SCAN aliases'), f"{query} scans aliases: {plan}"
+
+    def test_user_stats_queries_use_indexes(self):
+        self.decoy_packet.data.content = "!stats -meta"
+        self.decoy_packet.data.sender.name = "Xyzzy"
+        self.heimdall.get_user_stats()
+        self.assert_no_table_scans()
+
+    def test_room_stats_queries_use_indexes(self):
+        self.decoy_packet.data.content = "!roomstats"
+        self.heimdall.get_room_stats()
+        self.assert_no_table_scans()
+
+    def test_rank_queries_use_indexes(self):
+        self.decoy_packet.data.content = "!rank @dogbarrier"
+        self.heimdall.get_rank()
+        self.decoy_packet.data.content = "!rank 2"
+        self.heimdall.get_rank()
+        self.assert_no_table_scans()
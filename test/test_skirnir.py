@@ -0,0 +1,69 @@
+import os
+import shutil
+import threading
+import time
+import unittest
+
+import skirnir
+
+
+class FlakyBackend:
+    """Fails the first `failures` uploads, then returns a URL for each"""
+    def __init__(self, failures=0, delay=0):
+        self.failures = failures
+        self.delay = delay
+        self.attempts = 0
+        self.lock = threading.Lock()
+
+    def upload(self, png):
+        time.sleep(self.delay)
+        with self.lock:
+            self.attempts += 1
+            if self.attempts <= self.failures:
+                raise ConnectionError("Host unreachable")
+        return f"https://example.com/{png.decode()}"
+
+
+class TestSkirnir(unittest.TestCase):
+    def tearDown(self):
+        shutil.rmtree('_test_uploads', ignore_errors=True)
+
+    def test_retries_failed_uploads(self):
+        courier = skirnir.Courier(FlakyBackend(failures=2), retries=2, backoff=0)
+        assert courier.upload(b'graph') == "https://example.com/graph"
+
+        courier = skirnir.Courier(FlakyBackend(failures=3), retries=2, backoff=0)
+        with self.assertRaises(skirnir.UploadError):
+            courier.upload(b'graph')
+
+    def test_breaker_stops_uploads_until_cooldown(self):
+        backend = FlakyBackend(failures=3)
+        courier = skirnir.Courier(backend, retries=0, failures=3, cooldown=0.2)
+        for i in range(4):
+            with self.assertRaises(skirnir.UploadError):
+                courier.upload(b'graph')
+        # The fourth upload never reached the backend
+        assert backend.attempts == 3
+
+        time.sleep(0.2)
+        assert courier.upload(b'graph') == "https://example.com/graph"
+        assert courier.upload(b'again') == "https://example.com/again"
+
+    def test_uploads_run_concurrently(self):
+        courier = skirnir.Courier(FlakyBackend(delay=0.3), workers=3)
+        start = time.monotonic()
+        urls = courier.upload_all([b'a', b'b', b'c'])
+        assert time.monotonic() - start < 0.6
+        assert urls == ["https://example.com/a", "https://example.com/b", "https://example.com/c"]
+
+        urls = courier.upload_all([b'd'], timeout=0.05)
+        assert isinstance(urls[0], Exception)
+
+    def test_directory_backend(self):
+        backend = skirnir.DirectoryBackend('_test_uploads', 'http://localhost:8000/')
+        url = backend.upload(b'\x89PNG')
+        name = url.rsplit('/', 1)[1]
+        assert url == f"http://localhost:8000/{name}"
+        with open(os.path.join('_test_uploads', name), 'rb') as f:
+            assert f.read() == b'\x89PNG'
+        assert os.listdir('_test_uploads') == [name]
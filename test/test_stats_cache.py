@@ -0,0 +1,47 @@
+import unittest
+
+import forseti
+import heimdall
+
+
+class TestStatsCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = heimdall.StatsCache(size=2)
+        self.cache.apply(forseti.INSERT_MESSAGE, self.message('xyzzy'))
+
+    def message(self, normname, room='test'):
+        return ("Content", "id", '', 'agent:1', normname, normname, 1534774799, room, f"{room}id")
+
+    def test_replies_last_until_what_they_depend_on_is_written_to(self):
+        user = self.cache.stamp('test', ['xyzzy'], 1)
+        room = self.cache.stamp('test', None, 1)
+        self.cache.put('user', user, "User reply")
+        self.cache.put('room', room, "Room reply")
+
+        self.cache.apply(forseti.INSERT_MESSAGES_BULK, [self.message('plugh'), self.message('xyzzy', 'elsewhere')])
+        assert self.cache.get('user', self.cache.stamp('test', ['xyzzy'], 1)) == "User reply"
+        assert self.cache.get('room', self.cache.stamp('test', None, 1)) is None
+
+        self.cache.apply(forseti.INSERT_MESSAGE, self.message('xyzzy'))
+        assert self.cache.get('user', self.cache.stamp('test', ['xyzzy'], 1)) is None
+
+    def test_alias_changes_and_age_invalidate(self):
+        self.cache.put('user', self.cache.stamp('test', ['xyzzy'], 1), "User reply")
+        assert self.cache.get('user', self.cache.stamp('test', ['xyzzy'], 2)) is None
+
+        self.cache.put('user', self.cache.stamp('test', ['xyzzy'], 1), "User reply")
+        self.cache.apply(forseti.ALIAS_UPSERT, ('Xyzzy', 'Plugh', 'plugh'))
+        assert self.cache.get('user', self.cache.stamp('test', ['xyzzy'], 1)) is None
+
+        self.cache.max_age = -1
+        self.cache.put('user', self.cache.stamp('test', ['xyzzy'], 1), "User reply")
+        assert self.cache.get('user', self.cache.stamp('test', ['xyzzy'], 1)) is None
+
+    def test_least_recently_used_is_dropped(self):
+        stamp = self.cache.stamp('test', None, 1)
+        self.cache.put('first', stamp, "First")
+        self.cache.put('second', stamp, "Second")
+        assert self.cache.get('first', stamp) == "First"
+        self.cache.put('third', stamp, "Third")
+        assert self.cache.get('second', stamp) is None
+        assert self.cache.get('first', stamp) == "First"
@@ -5,14 +5,17 @@ import json
 import multiprocessing as mp
 import os
 import hermothr
+import sqlite3
 import subprocess
 import sys
 import time
 
 import karelia
 
+import bragi
 import forseti
 import heimdall
+import mimir
 
 
 class UpdateDone(Exception):
@@ -32,6 +35,13 @@ class Yggdrasil:
         parser.add_argument("--force-new-logs", help="If enabled, Heimdall will delete any current logs for the room", action="store_true", dest="new_logs")
         parser.add_argument("--use-logs", type=str, dest="use_logs")
         parser.add_argument("--fill-in", "-f", action="store_true", dest="fill_in")
+        parser.add_argument("--write-batch-size", type=int, default=500, dest="write_batch_size", help="Maximum number of writes Forseti commits in a single transaction")
+        parser.add_argument("--write-batch-time", type=float, default=0.1, dest="write_batch_time", help="Seconds Forseti waits to fill a batch before committing it")
+        parser.add_argument("--write-queue-size", type=int, default=10000, dest="write_queue_size", help="Maximum number of writes waiting for Forseti")
+        parser.add_argument("--write-policy", choices=['block', 'coalesce', 'spill'], default='block', dest="write_policy", help="What Heimdall does when Forseti's queue is full")
+        parser.add_argument("--workers", type=int, default=4, dest="workers", help="Maximum number of commands each Heimdall runs at once")
+        parser.add_argument("--commands-per-user", type=int, default=1, dest="commands_per_user", help="Maximum number of commands each user can have running at once")
+        parser.add_argument("--profile-startup", action="store_true", dest="profile_startup", help="Have each Heimdall report how long each stage of its startup takes")
 
         args = parser.parse_args()
 
@@ -41,11 +51,25 @@ class Yggdrasil:
         self.use_logs = args.use_logs
         self.verbose = args.verbose
         self.fill_in = args.fill_in
+        self.write_batch_size = args.write_batch_size
+        self.write_batch_time = args.write_batch_time
+        self.write_queue_size = args.write_queue_size
+        self.write_policy = args.write_policy
+        self.workers = args.workers
+        self.commands_per_user = args.commands_per_user
+        self.profile_startup = args.profile_startup
 
         with open('rooms.json') as f:
             self.rooms = json.loads(f.read())
 
-        self.queue = mp.Queue()
+        # Heimdall's message writes and Hermothr's notification writes go to different databases, each with a Forseti of its own so that bulk logging never holds up a notification
+        self.queue = mp.Queue(self.write_queue_size)
+        self.notification_queue = mp.Queue(self.write_queue_size)
+        self.replies = {room: mp.Queue() for room in self.rooms}
+
+        # Bragi draws every room's graphs, so that only it has to import matplotlib
+        self.graph_queue = mp.Queue()
+        self.graph_replies = {room: mp.Queue() for room in self.rooms}
 
         log_format = logging.Formatter(f'\n\n--------------------\n%(asctime)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
         self.logger = logging.getLogger(__name__)
@@ -58,16 +82,29 @@ class Yggdrasil:
         try:
 
             self.instances = []
-            instance = mp.Process(target=self.run_forseti)
+            instance = mp.Process(target=self.run_forseti, args=(self.queue, {forseti.HEIMDALL: forseti.DATABASES[forseti.HEIMDALL]}, self.write_batch_size, self.write_batch_time))
             instance.daemon = True
             instance.name = "forseti"
             self.instances.append(instance)
+
+            instance = mp.Process(target=self.run_forseti, args=(self.notification_queue, {forseti.YGGDRASIL: forseti.DATABASES[forseti.YGGDRASIL]}, 1, 0))
+            instance.daemon = True
+            instance.name = "forseti_yggdrasil"
+            self.instances.append(instance)
         except:
             self.logger.exception("Error initialising forseti.")
 
+        try:
+            instance = mp.Process(target=self.run_bragi, args=(self.graph_queue, ))
+            instance.daemon = True
+            instance.name = "bragi"
+            self.instances.append(instance)
+        except:
+            self.logger.exception("Error initialising bragi.")
+
         for room in self.rooms:
             try:
-                instance = mp.Process(target=self.run_heimdall, args=(room, self.stealth, self.new_logs, self.use_logs, self.verbose, self.fill_in, self.queue))
+                instance = mp.Process(target=self.run_heimdall, args=(room, self.stealth, self.new_logs, self.use_logs, self.verbose, self.fill_in, self.queue, self.replies[room], self.graph_replies[room]))
                 instance.daemon = True
                 instance.name = room
                 self.instances.append(instance)
@@ -76,7 +113,7 @@ class Yggdrasil:
 
             try:
 
-                instance = mp.Process(target=self.run_hermothr, args=())
+                instance = mp.Process(target=self.run_hermothr, args=(room,))
                 instance.daemon = True
                 instance.name = f"hermothr_{room}"
                 self.instances.append(instance)
@@ -84,25 +121,32 @@ class Yggdrasil:
                 self.logger.exception(f"Error initialising hermothr in {room}")
 
 
-    def run_forseti(self):
+    def run_forseti(self, queue, targets, batch_size, batch_time):
         try:
-            forseti.main(self.queue)
+            name = '_'.join(targets)
+            forseti.main(queue, targets=targets, replies=self.replies, batch_size=batch_size, batch_time=batch_time, spool=f"_forseti_{name}.spool", metrics=f"forseti_{name}_metrics.json")
         except:
             self.logger.exception(f"Error initialising forseti")
 
 
-    def run_heimdall(self, room, stealth, new_logs, use_logs, verbose, fill_in, queue):
+    def run_bragi(self, queue):
+        try:
+            bragi.main(queue, replies=self.graph_replies)
+        except:
+            self.logger.exception(f"Error initialising bragi")
+
+    def run_heimdall(self, room, stealth, new_logs, use_logs, verbose, fill_in, queue, reply_queue, graph_replies):
         try:
             if room == "test":
-                heimdall.main((room, queue), stealth=stealth, new_logs=new_logs, use_logs="xkcd", verbose=verbose, fill_in=fill_in)
+                heimdall.main((room, queue, reply_queue), stealth=stealth, new_logs=new_logs, use_logs="xkcd", verbose=verbose, fill_in=fill_in, write_policy=self.write_policy, workers=self.workers, commands_per_user=self.commands_per_user, graphs=(self.graph_queue, graph_replies), profile_startup=self.profile_startup)
             else:
-                heimdall.main((room, queue), stealth=stealth, new_logs=new_logs, use_logs=use_logs, verbose=verbose, fill_in=fill_in)
+                heimdall.main((room, queue, reply_queue), stealth=stealth, new_logs=new_logs, use_logs=use_logs, verbose=verbose, fill_in=fill_in, write_policy=self.write_policy, workers=self.workers, commands_per_user=self.commands_per_user, graphs=(self.graph_queue, graph_replies), profile_startup=self.profile_startup)
         except:
             self.logger.exception(f"Error initialising heimdall in {room}")
 
-    def run_hermothr(self):
+    def run_hermothr(self, room):
         try:
-            #hermothr.main(self.queue)
+            #hermothr.main((room, self.notification_queue))
             pass
         except:
             self.logger.exception(f"Error initialising hermothr")
@@ -116,7 +160,21 @@ class Yggdrasil:
         finally:
             sys.exit(0)
 
+    def migrate(self):
+        """Brings Heimdall's database up to date before any room starts, so that the rooms never migrate it at the same time"""
+        database = forseti.DATABASES[forseti.HEIMDALL]
+        conn = sqlite3.connect(database)
+        migrations = mimir.Mimir(conn.cursor(), mimir.forseti_writer(database))
+        migrations.create_tables()
+        migrations.migrate()
+        conn.close()
+
     def start(self):
+        try:
+            self.migrate()
+        except:
+            self.logger.exception("Error migrating the database.")
+
         for instance in self.instances:
             instance.start()
 
@@ -143,6 +201,7 @@ def run_deploy():
 
 
 def main():
+    importlib.reload(bragi)
     importlib.reload(forseti)
     importlib.reload(heimdall)
     importlib.reload(karelia)